@@ -0,0 +1,517 @@
+#!/usr/bin/python
+"""
+Licensed under MIT (../LICENSE)
+
+AMODEM.py
+
+Non blocking Iridium modem driver, the same operations as jacs.py. The
+serial port is opened non blocking and a reader thread collects what
+the modem says with select(), so waiting for an answer is waiting on a
+condition, not sleeping and polling the port. Long operations (the
+registration wait, an SBDIX session, a dial) can run in the background
+with background() while the caller keeps going: sensor sampling,
+cutting and compressing parts, logging.
+
+	m = amodem.modem('/dev/ttyS1')
+	m.open()
+	job = amodem.background(m.coverage)
+	... other work ...
+	status = job.result()
+
+MT messages are fetched when the network announces them (ring alerts,
+SBDRING) or with the MO messages sent anyway, never with empty mailbox
+checks; watch() answers the rings as they come.
+
+Only POSIX serial ports (termios), no pyserial needed. Works with
+Python 2 and 3.
+
+Usage: amodem.py <port> csq|watch|sbd <message>|send <file>|dial <number>
+"""
+
+import errno
+import os
+import select
+import sys
+import termios
+import threading
+import time
+
+baudrate = 19200
+# Result codes that end an AT command.
+final = (b'OK', b'ERROR', b'READY', b'CONNECT', b'NO CARRIER', b'BUSY',
+	b'NO ANSWER', b'NO DIALTONE')
+# Seconds to discharge the modem when it is switched off, and to boot.
+off_time = 30
+boot_time = 5
+# Seconds the reader thread waits in select() before checking close().
+poll_time = 0.5
+
+_bauds = {9600: termios.B9600, 19200: termios.B19200, 38400: termios.B38400,
+	57600: termios.B57600, 115200: termios.B115200}
+
+
+class ModemError(Exception):
+	"""The modem did not answer as expected."""
+	pass
+
+
+class background():
+	"""Runs f(*args) in its own thread. result() waits for it and gives
+	its value, or raises its exception."""
+	def __init__(self, f, *args):
+		self.value = None
+		self.error = None
+		self.thread = threading.Thread(target=self._run, args=(f, args))
+		self.thread.daemon = True
+		self.thread.start()
+		return
+
+	def _run(self, f, args):
+		try:
+			self.value = f(*args)
+		except Exception as e:
+			self.error = e
+		return
+
+	def done(self):
+		"""True once f has returned."""
+		return not self.thread.is_alive()
+
+	def result(self, timeout=None):
+		self.thread.join(timeout)
+		if self.thread.is_alive():
+			raise ModemError('Still running after %s s' % timeout)
+		if self.error != None:
+			raise self.error
+		return self.value
+
+
+class modem():
+	"""One modem on a serial port."""
+	def __init__(self, port, baudrate=baudrate, pin=None):
+		"""
+		Input:
+			port: serial device
+			baudrate: port speed
+			pin: power pin name (hal.py), None if the modem is not
+				switched by this process
+		"""
+		self.port = port
+		self.baudrate = baudrate
+		self.pin = pin
+		self.fd = None
+		self.reader = None
+		self.buf = b''
+		# Guards buf, notified when data arrives.
+		self.data = threading.Condition()
+		# One command at a time on the port, whatever the thread.
+		self.lock = threading.RLock()
+		# Set by an unsolicited SBDRING, cleared once the MT queue is empty.
+		self.ring = threading.Event()
+		return
+
+	def open(self):
+		"""Opens the port raw and non blocking, starts the reader, then
+		checks AT."""
+		self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+		attr = termios.tcgetattr(self.fd)
+		attr[0] = 0 #iflag
+		attr[1] = 0 #oflag
+		attr[2] = termios.CS8 | termios.CREAD | termios.CLOCAL #cflag
+		attr[3] = 0 #lflag
+		attr[4] = attr[5] = _bauds[self.baudrate]
+		termios.tcsetattr(self.fd, termios.TCSANOW, attr)
+		termios.tcflush(self.fd, termios.TCIOFLUSH)
+		self.reader = threading.Thread(target=self._read_loop, args=(self.fd,))
+		self.reader.daemon = True
+		self.reader.start()
+		return self.at()
+
+	def close(self):
+		if self.fd != None:
+			fd = self.fd
+			self.fd = None
+			self.reader.join()
+			os.close(fd)
+		return
+
+	def _read_loop(self, fd):
+		"""Reader thread, until close()."""
+		while self.fd == fd:
+			try:
+				r, w, x = select.select([fd], [], [], poll_time)
+				if not r:
+					continue
+				chunk = os.read(fd, 4096)
+			except (OSError, select.error) as e:
+				if e.args[0] in (errno.EAGAIN, errno.EINTR):
+					continue
+				raise
+			self.data.acquire()
+			try:
+				self.buf += chunk
+				if b'SBDRING' in self.buf:
+					self.buf = self.buf.replace(b'SBDRING', b'')
+					self.ring.set()
+				self.data.notify_all()
+			finally:
+				self.data.release()
+		return
+
+	def write(self, data):
+		"""Writes everything, waiting for the port when it is full."""
+		while data:
+			try:
+				n = os.write(self.fd, data)
+				data = data[n:]
+			except OSError as e:
+				if e.errno != errno.EAGAIN:
+					raise
+				select.select([], [self.fd], [], poll_time)
+		return
+
+	def _flush(self):
+		"""Forgets what the modem said so far."""
+		self.data.acquire()
+		self.buf = b''
+		self.data.release()
+		return
+
+	def readline(self, deadline):
+		"""Next non empty line (bytes, stripped). Raises ModemError at the
+		deadline."""
+		self.data.acquire()
+		try:
+			while True:
+				i = self.buf.find(b'\n')
+				if i >= 0:
+					line, self.buf = self.buf[:i].strip(), self.buf[i + 1:]
+					if line:
+						return line
+					continue
+				left = deadline - time.time()
+				if left <= 0:
+					raise ModemError('No answer')
+				self.data.wait(left)
+		finally:
+			self.data.release()
+
+	def command(self, cmd, timeout=10):
+		"""
+		Issues an AT command.
+		Input:
+			cmd: command without the carriage return, i.e. 'AT+CSQ'
+			timeout: seconds for the final result code
+		Output:
+			(result code, lines before it without the echo), bytes.
+			Raises ModemError on timeout.
+		"""
+		if not isinstance(cmd, bytes):
+			cmd = cmd.encode('ascii')
+		self.lock.acquire()
+		try:
+			self._flush()
+			self.write(cmd + b'\r')
+			deadline = time.time() + timeout
+			lines = []
+			try:
+				while True:
+					line = self.readline(deadline)
+					if line == cmd:
+						continue #Echo
+					for code in final:
+						if line.startswith(code):
+							return line, lines
+					lines.append(line)
+			except ModemError:
+				raise ModemError('%s: no answer in %d s' % (cmd.decode('ascii', 'replace'), timeout))
+		finally:
+			self.lock.release()
+
+	def expect(self, cmd, timeout=10):
+		"""Lines of a command that has to end in OK."""
+		code, lines = self.command(cmd, timeout)
+		if code != b'OK':
+			raise ModemError('%s: %s' % (cmd, code.decode('ascii', 'replace')))
+		return lines
+
+	@staticmethod
+	def _value(lines, label):
+		"""Value of '+LABEL: value' in the answer lines, str."""
+		for line in lines:
+			if line.startswith(label + b':'):
+				return line[len(label) + 1:].strip().decode('ascii', 'replace')
+		raise ModemError('No %s in the answer' % label.decode('ascii'))
+
+	#### Operations of jacs.py
+
+	def power(self, on=True):
+		"""Power cycle as modemT(): off for off_time, then on and boot.
+		Nothing to do without a pin, the modem is switched elsewhere."""
+		if self.pin == None:
+			return on
+		import hal
+		p = hal.pin(self.pin)
+		p.off()
+		time.sleep(off_time)
+		if on:
+			p.on()
+			time.sleep(boot_time)
+		return on
+
+	def at(self, tries=3):
+		"""True if the modem answers AT."""
+		for i in range(tries):
+			try:
+				code, lines = self.command('AT', 2)
+				if code == b'OK':
+					return True
+			except ModemError:
+				pass
+		return False
+
+	def setup(self):
+		"""Initial settings as iSSet(): echo on, verbose codes, no flow
+		control, DTR ignored."""
+		for cmd in ('ATE1', 'ATV1', 'AT&K0', 'AT&D0'):
+			self.expect(cmd)
+		return
+
+	def csq(self):
+		"""Signal quality, 0 to 5."""
+		return int(self._value(self.expect('AT+CSQ', 20), b'+CSQ'))
+
+	def creg(self):
+		"""Registration status code of AT+CREG? (dSIMr())."""
+		return int(self._value(self.expect('AT+CREG?'), b'+CREG').split(',')[-1])
+
+	def coverage(self, tout=300, minimum=4, wait=10):
+		"""
+		Waits for coverage and registration, as coverageTest().
+		Output:
+			(registered, coverage, registration code)
+		"""
+		deadline = time.time() + tout
+		status = (False, 0, 0)
+		while time.time() < deadline:
+			cov = self.csq()
+			status = (False, cov, status[2])
+			if cov >= minimum:
+				reg = self.creg()
+				status = (reg in (1, 5), cov, reg)
+				if status[0]:
+					break
+			time.sleep(wait)
+		return status
+
+	def sbd_clear(self):
+		"""Clears the MO and MT buffers (AT+SBDD2)."""
+		self.expect('AT+SBDD2')
+		return
+
+	def sbd_write(self, msg):
+		"""Binary message to the MO buffer (AT+SBDWB), bytes."""
+		self.lock.acquire()
+		try:
+			code, lines = self.command('AT+SBDWB=%d' % len(msg))
+			if code != b'READY':
+				raise ModemError('AT+SBDWB: %s' % code.decode('ascii', 'replace'))
+			crc = sum(bytearray(msg)) & 0xffff
+			self._flush()
+			self.write(msg + bytes(bytearray([crc >> 8, crc & 0xff])))
+			deadline = time.time() + 10
+			try:
+				result = self.readline(deadline)
+				self.readline(deadline) #OK
+			except ModemError:
+				raise ModemError('AT+SBDWB: no answer')
+		finally:
+			self.lock.release()
+		if result != b'0':
+			raise ModemError('AT+SBDWB: error %s' % result.decode('ascii', 'replace'))
+		return
+
+	def ring_alerts(self, on=True):
+		"""Turns SBD ring alerts on (AT+SBDMTA) with the automatic
+		registration the network needs to find the modem (AT+SBDAREG)."""
+		self.expect('AT+SBDMTA=%d' % int(on))
+		if on:
+			self.expect('AT+SBDAREG=1', 60)
+		return
+
+	def ring_pending(self):
+		"""True if an MT message was announced: SBDRING seen, or the
+		ring indicator of AT+CRIS (<tri>,<sri>) set, i.e. a ring that
+		came before the port was opened. Local, no satellite session."""
+		if self.ring.is_set():
+			return True
+		try:
+			v = self._value(self.expect('AT+CRIS'), b'+CRIS')
+			# Zero padded, i.e. 000,001.
+			tri, sri = [int(x) for x in v.split(',')]
+		except (ModemError, ValueError):
+			return False
+		return sri == 1
+
+	def sbdix(self, location=None, timeout=60, answer=False):
+		"""
+		One SBD session, AT+SBDIXA when it answers a ring.
+		Output:
+			(MO status, MOMSN, MT status, MTMSN, MT length, MT queued),
+			ints, see decodeStatusSBD() in jacs.py.
+		"""
+		cmd = 'AT+SBDIX'
+		if answer:
+			cmd += 'A'
+		if location != None:
+			cmd += '=' + location
+		v = self._value(self.expect(cmd, timeout), b'+SBDIX')
+		return tuple([int(x) for x in v.split(',')])
+
+	def sbd_read(self):
+		"""Mobile terminated message as text (AT+SBDRT)."""
+		lines = self.expect('AT+SBDRT')
+		if lines and lines[0].startswith(b'+SBDRT:'):
+			lines = lines[1:]
+		return b'\n'.join(lines)
+
+	def sbd_session(self, msg=None, location=None, tries=10, wait=10):
+		"""
+		Sends a message (bytes, None to answer a ring) and fetches the
+		mobile terminated ones, as sbdMessage(). Without a message and
+		without a ring there is no session at all. MT messages still
+		queued at the gateway are fetched with more sessions, the MO
+		buffer cleared once the message is sent; a message that could not
+		be sent stays in it.
+		Output:
+			(SBDIX status of the session that sent the message, of the
+			last one without a message; None if there was none, [MT
+			messages])
+		"""
+		ring = self.ring_pending()
+		if msg == None and not ring:
+			return None, []
+		self.sbd_clear()
+		if msg != None:
+			self.sbd_write(msg)
+		mts = []
+		status = None
+		mo = None
+		while True:
+			for i in range(tries):
+				try:
+					status = self.sbdix(location, answer=ring)
+				except ModemError:
+					status = None
+				if status != None and (status[0] <= 4 or msg == None):
+					break
+				time.sleep(wait)
+			if status == None or status[2] == 2:
+				return mo or status, mts
+			if status[2] == 1:
+				mts.append(self.sbd_read())
+			if msg != None:
+				if status[0] > 4:
+					# Not sent, the caller sees the failure.
+					return status, mts
+				mo = status
+			if status[5] == 0:
+				self.ring.clear()
+				return mo or status, mts
+			# More MT messages queued, the MO one is already sent.
+			self.expect('AT+SBDD0')
+			msg = None
+			ring = True
+
+	def sbd_send(self, payload, location=None, tries=10):
+		"""
+		Sends a payload larger than the MO buffer in segments (sbdseg.py),
+		back to back in this session; the ground joins them.
+		Output:
+			(segments sent, segments, [MT messages fetched on the way])
+		"""
+		import sbdseg
+		segs = sbdseg.split(payload, sbdseg.next_id())
+		mts = []
+		for n, seg in enumerate(segs):
+			status, got = self.sbd_session(seg, location, tries)
+			mts.extend(got)
+			if status == None or status[0] > 4:
+				return n, len(segs), mts
+		return len(segs), len(segs), mts
+
+	def watch(self, handler):
+		"""Answers ring alerts forever, handler(MT message) for every
+		message fetched, i.e. mtcmd.dispatch."""
+		while True:
+			# With a timeout, so the wait can be interrupted.
+			self.ring.wait(60)
+			if not self.ring.is_set():
+				continue
+			status, mts = self.sbd_session()
+			for mt in mts:
+				handler(mt.decode('ascii', 'replace'))
+			if status == None or status[2] == 2:
+				# Gateway error, the ring stays set, try again later.
+				time.sleep(60)
+
+	def dial(self, number, timeout=60):
+		"""Data call to the RUDICS gateway (callR()), True once
+		connected; the port is in data mode then."""
+		code, lines = self.command('ATDT%s' % number, timeout)
+		return code.startswith(b'CONNECT')
+
+	def hangup(self):
+		"""Back to command mode and hang up."""
+		time.sleep(1)
+		self.write(b'+++')
+		time.sleep(1)
+		try:
+			self.expect('ATH')
+		except ModemError:
+			return False
+		return True
+
+	def send(self, data):
+		"""Raw bytes in data mode, at the pace of the port."""
+		self.write(data)
+		termios.tcdrain(self.fd)
+		return len(data)
+
+
+def _main(args):
+	m = modem(args[0])
+	if not m.open():
+		print('No AT answer on %s' % args[0])
+		return 1
+	try:
+		if args[1] == 'csq':
+			print('Coverage %d of 5' % m.csq())
+		elif args[1] == 'sbd':
+			print('SBDIX %s, MT %s' % m.sbd_session(args[2].encode('ascii')))
+		elif args[1] == 'send':
+			f = open(args[2], 'rb')
+			print('%d of %d segments sent, MT %s' % m.sbd_send(f.read()))
+			f.close()
+		elif args[1] == 'watch':
+			import mtcmd
+			m.ring_alerts()
+			def show(mt):
+				print(mtcmd.dispatch(mt))
+			m.watch(show)
+		elif args[1] == 'dial':
+			if m.dial(args[2]):
+				print('Connected')
+			else:
+				print('No connection')
+			m.hangup()
+	finally:
+		m.close()
+	return 0
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3 or (sys.argv[2] not in ('csq', 'watch') and len(sys.argv) < 4):
+		print(__doc__)
+		sys.exit(1)
+	sys.exit(_main(sys.argv[1:]))
@@ -23,13 +23,15 @@ A configuration file is used containing the following setup:
 
 V0. Raul Bardaji & Oriol Sanchez, ICM-CSIC
 """
-import fox #Access to the GPIO of the PCB to power the modem, import hardware library of your device (i.e. Raspberry Pi)
-#import ablib #Acme boards library, udated library for fox kernel 3 and newer boards.
-#import RPi.GPIO as GPIO
-import send5.py as lv #Review
+import hal #GPIO of the PCB to power the modem, board library (fox, ablib, RPi.GPIO) set in hal.conf and loaded on first use
 import time #Used to create sleeps
 import serial #Required to use the serial ports, creation of sockets
 import datetime #Timestamps require this library
+import logme #Buffered logger
+import planner #Daily energy plan, link history
+import tracer #Per command timing traces
+import mtcmd #Remote settings from MT messages
+import amodem #Non blocking modem driver, the long waits run in a thread
 import glob
 import sys
 
@@ -40,7 +42,7 @@ confile="/home/satice/conf/coms.conf" #where your configuration file is
 
 def logMe(home,log="Null",msg="Null")
 	"""
-	Writes a given message to a given log file.
+	Writes a given message to a given log file (JSON lines, see logme.py).
 	Example: 
 		logMe(home,"coms",msg)
 	Input:
@@ -50,12 +52,8 @@ def logMe(home,log="Null",msg="Null")
 	Output: 
 		None.
 	"""
-	wrote=False
-	now = datetime.datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S') #timestamp, case we want to log
-	f = open(home+'log/'+log".log", 'a')
-	f.write(now+' '+msg+'\n')
-	wrote=True
-	f.close()
+	#Queued, written by the logger thread (logme.py), never waits for the card.
+	logme.get(home,log).log(msg)
 
 def read_config(confile):
 	"""
@@ -99,12 +97,13 @@ def modemT(mode=false,type="fox"):
         Return true/false for on/off case the power status is required.
 	Default call: modemT(0) #Powers off, fox type..
     """
+	sp=tracer.begin('power cycle',state=mode)
 	#Generic switch off for 30 seconds.
 	if (debug): 
 		print('Modem OFF \r') #Debug is a global boolean variable.
 		logMe(home,"coms","Modem OFF")
 	if type=="fox": #Add cases for other devices...
-		fox.Pin('J7.35','low') #For mk3 satice PCB with Fox Board microP unit
+		hal.pin('modem').off() #For mk3 satice PCB with Fox Board microP unit
     time.sleep(30) #required to discharge charge pump on the modem, according to manufacturer.
 	mON=False
 	
@@ -113,9 +112,10 @@ def modemT(mode=false,type="fox"):
 			print('Modem ON \r')
 			logMe(home,"coms","Modem ON")
 		if type=="fox":
-			fox.Pin('J7.35','high') #For mk3 satice PCB with Fox Board microP unit
+			hal.pin('modem').on() #For mk3 satice PCB with Fox Board microP unit
 		time.sleep(5)
 		mON=True
+	tracer.end(sp,mON)
 	return mON
 
 def serial_ports(): 
@@ -125,6 +125,7 @@ def serial_ports():
         Result: A list of the serial ports, compatible with AT, available on the system. 
 				If no serial ports are available with a modem, returns false (To Be Implemented).
     """
+    sp = tracer.begin('port probe')
     if sys.platform.startswith('win'):
         ports = ['COM%s' % (i + 1) for i in range(256)]
     elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
@@ -159,6 +160,7 @@ def serial_ports():
 			print('Available ports:', result)
 			logMe(home,"coms",('Available ports:', result))
 		
+	tracer.end(sp,len(result))
 	#Case result is empty...
 	if (len(result) ==0): #If no AT ports in the list
 		return False #vector with serial ports with AT command friendly devices
@@ -227,6 +229,7 @@ def writeMod(ser,frase,wait=1):
 	***-> Need feedback about the encoding stuff, is it really necessary? 
 	"""
 	#By default wait time is 1 second
+	sp = tracer.begin(frase.strip().split('=')[0].split('?')[0]) #Verb only, AT+SBDWT=<message> would make a span per message
 	ser.write(bytes(frase, encoding="UTF-8"))
     out = ''
     # let's wait 'espera' second before reading output (let's give device time to answer)
@@ -234,11 +237,13 @@ def writeMod(ser,frase,wait=1):
     while ser.inWaiting() > 0:
 		out = ser.read(ser.inWaiting()).decode(encoding='UTF-8')
     if out == '':
+        tracer.end(sp,'No answer',len(frase))
         return 'No answer'
     else:
         # Modem returns the issued command by default (can be disabled by ATE=0), 
 		# next line is the answer to issued command. This soft works with echo enabled.
 		# The order is \r\nIssuedComm\r\nanswer\r\nblank\r\nok\r\n !!!!
+        tracer.end(sp,out.strip()[-16:],len(frase)+len(out))
         out_ = out.split('\r\n')
         return out_[2]
 def query(ser,phrase='AT\r\n',splitch=' '): 
@@ -358,6 +363,46 @@ def nR(ser,ringNumber = 1):
 		answer=True
     return answer
 
+def sRA(ser,opt=1):
+    """
+    Set SBD ring alerts. The network announces MT messages with an unsolicited
+	SBDRING (and the ring indicator), so they are only fetched when there is one.
+	Automatic registration (AT+SBDAREG=1) is required for the network to find the modem.
+    Input: 
+        ser: Serial socket
+		opt: Option, 0 to disable, 1 to enable. Enabled by default.
+    Output:
+        answer: Boolean marking succes of operation
+    """
+    answer = query(ser,'AT+SBDMTA='+str(opt)+'\r\n',"")
+	if answer=='OK\n' and opt==1:
+		answer = query(ser,'AT+SBDAREG=1\r\n',"")
+	if answer=='OK\n' and debug:
+		msg='SBD ring alerts set to {}'.format(opt)
+		print(msg+'\r')
+		logMe(home,"coms",msg)
+	if answer!='OK\n':
+		answer=False
+	else:
+		answer=True
+    return answer
+
+def ringSBD(ser):
+    """
+    Checks the SBD ring indicator (AT+CRIS answers <tri>,<sri>), a local query,
+	no satellite session.
+    Input: 
+        ser: Serial socket
+    Output:
+        True if the network announced an MT message (SBDRING).
+    """
+    answer = query(ser,'AT+CRIS\r\n',':')
+	try:
+		tri,sri = [int(x) for x in answer.strip().split(',')] #Zero padded, i.e. 000,001
+	except ValueError:
+		return False
+    return sri==1
+
 def sAcP(ser,opt=0):
     """
     Saves current setup as active profile, acording to AT command reference manual
@@ -478,6 +523,7 @@ def iSSet(ser):
 		if not(answer): manswer=False #false
 		time.sleep(0.5)
 
+	sRA(ser) #SBD ring alerts, not supported by every model so it does not fail the setup
 	answer = sAcP(ser) #Save as active configuration 
 	if not(answer): manswer=False #false
 	time.sleep(0.5)
@@ -705,6 +751,7 @@ def coverageTest(ser,tout=300,mode="data"):
 				3rd field: registry status code (use dSIMr(code) ) to decode message.
     """
 	print 'Initializing modem:\n'
+    sp = tracer.begin('registration')
     timeout = time.time() + tout   # By default 300s
     status=(False,0,0) #Init return vector
     while time.time()<timeout: #For 5 minutes
@@ -726,6 +773,7 @@ def coverageTest(ser,tout=300,mode="data"):
           print 'SIM registered\n'
 		  status[0]=False
           break #Don't wait for the timeout once we are registered
+    tracer.end(sp,status[2],coverage=status[1])
     return status
 	
 def sbdMessage(ser,input="nop",lat="nop",lon="nop")
@@ -750,14 +798,28 @@ def sbdMessage(ser,input="nop",lat="nop",lon="nop")
 	"""
 	location=str(lat)+','+str(lon)
 	answer=query(ser,'AT+SBDD2\r\n') #Clear mobile originated and terminated buffer
+	ack=mtcmd.peek_ack() #Acknowledge of the last MT commands, sent with this message, cleared once it is out
+	if ack!='':
+		if input=='nop': input=ack
+		else: input=input+ack
+	ring=ringSBD(ser) #MT message announced by the network
+	if input=='nop' and not ring:
+		return 'No mail' #No empty mailbox checks, MT messages come with the MO sessions or a ring
+	if not ring: #A ring is always answered, a message only if today's energy plan has a session at this hour
+		ok,why=planner.allowed('sbd')
+		if not ok: return why
+	session='AT+SBDIX' #AT+SBDIXA answers a ring alert
+	if ring: session='AT+SBDIXA'
 	if input<>'nop':  #If its not a nop, then write message to the mobile originated buffer
 		respuesta = sMSBD(ser,input,"") 
 	for i in range (0,10) #Ten tries
+		sp=tracer.begin('SBD session',attempt=i)
 		if (lat=="nop" or lon=="nop"): #Case no location data is provided
-			RXstr=query(ser,'AT+SBDI',':') #Returns something like "3,0,0,0,0,0" from "+SBDI:3,0,0,0,0,0"
+			RXstr=query(ser,session,':') #Returns something like "3,0,0,0,0,0" from "+SBDIX:3,0,0,0,0,0"
 		else:
-			RXstr=query(ser,'AT+SBDIX='+location,':') #Returns something like "3,0,0,0,0,0" from "+SBDIX:3,0,0,0,0,0"
+			RXstr=query(ser,session+'='+location,':') #Returns something like "3,0,0,0,0,0" from "+SBDIX:3,0,0,0,0,0"
 		if len(RXstr)<8 : RXstr="3,0,0,0,0,0" #Double check that the answer is of desired length, othersiwe use a default output
+		tracer.end(sp,RXstr.split(',')[0],len(input))
 		RXfrags=RXstr.split(',',5)
 		#decodeStatusSBD(RXstr) #Uncomment to see definition of status messages, or ad if debug=true 
 		MO_Status=RXfrags[0] 
@@ -771,7 +833,13 @@ def sbdMessage(ser,input="nop",lat="nop",lon="nop")
 				#This means I can receive multiple commands: f.i. RESET!LEFT!RIGHT!UP!SLEEP!...
 				#A decoding answer routine may be required to asign each command to a desired task
 				#Would I need to strip() all vector cells? case there are empty spaces inside?
+				if RX_message[0]!='':
+					mtcmd.dispatch('*'+RXstr) #Settings commands (mtcmd.py), the rest are ignored
+					break
 				
+		if ack!='' and int(MO_Status)<=4: #MO statuses 0-4, the message and the acknowledge in it went out
+			mtcmd.clear_ack(ack)
+			ack=''
 		if MO_Status <=1 or input == 'nop': break #Case correctly sent or input message was 'nop' message
 		else : time.sleep(10) #wait 10 seconds... and try to send it again.
 		
@@ -895,6 +963,7 @@ def callR(ser,tlf):
 	'''
 	connected = False
 	while(connected == False): #Add a timeout so the modem is not trying to call for more than half an hour for instance?
+		sp=tracer.begin('dial')
 		ser.write("ATDT+"+str(tlf)+"\r\n")
 		time.sleep(0.5)  #give the serial port sometime to receive the data
 		res1 = ""	
@@ -917,13 +986,43 @@ def callR(ser,tlf):
 			connected = True
 		else:
 			connected = False		
+		tracer.end(sp,connected,len(res1))
 	time.sleep(1)  #give the serial port sometime to receive the data	
 	return connected
 	
+def sbdExchange(m):
+	"""
+	Answers a ring alert and sends the acknowledge of the last MT commands
+	with the non blocking driver. No session when there is neither.
+	Input:
+		m: amodem.modem, open and registered
+	Output:
+		SBDIX status of the last session, None if there was none
+	"""
+	ack=mtcmd.peek_ack() #Cleared once the MO carrying it is out
+	msg=None
+	if ack!='':
+		ok,why=planner.allowed('sbd')
+		if ok: msg=ack.encode('ascii')
+	try:
+		status,mts=m.sbd_session(msg)
+	except amodem.ModemError as e:
+		logMe(home,"coms",str(e))
+		return None
+	for mt in mts:
+		mtcmd.dispatch(mt.decode('ascii','replace')) #Settings commands (mtcmd.py), the rest are ignored
+	if msg!=None and status!=None and status[0]<=4:
+		mtcmd.clear_ack(ack)
+	return status
+
 #### MAIN PROGRAM FOR TEST.   
 if __name__ == '__main__':
 	#LOAD CONF FILES
 	mtu,home,numphone,debug=read_config(confile):	
+	#Only call if today's energy plan has a session at this hour.
+	ok,why=planner.allowed('rudics')
+	logMe(home,"coms",why)
+	if not ok: sys.exit()
 	#COMBLOCK
     #On sequence for the modem including setup.
     modemT(True,"Fox") #Powers on the modem, case GPIO is used. IMPLEMENTED	
@@ -932,7 +1031,17 @@ if __name__ == '__main__':
 	ser = connect(listS[0]) #Connect to the first one
 	resp = iSSet(ser) #Initial setup of the modem
 	#dSIMP(ser)	#Unlock sim card, only first time a new SIM is used.
-    status = coverageTest(ser) #See if registered with coverage, tries for 300 seconds 
+	disconnect(ser) #Registration and SBD with the non blocking driver
+	m = amodem.modem(listS[0])
+	m.open()
+	sp = tracer.begin('registration')
+	wait = amodem.background(m.coverage) #See if registered with coverage, tries for 300 seconds, in its own thread
+	import send5 as lv #Loaded meanwhile, not after connecting
+	status = wait.result()
+	tracer.end(sp,status[2],coverage=status[1])
+	if (status[0]): sbdExchange(m) #Ring alerts and acknowledges of MT commands
+	m.close()
+	ser = connect(listS[0]) #pyserial again for the data call
 		if (debug):
 		#print(dSIMr(status[1])) #Use a log function !!! COVERAGE
 		msg=dSIMr(status[1])
@@ -943,18 +1052,22 @@ if __name__ == '__main__':
 	if (status[0]): #if status is true (coverage and registry)
 	#Call gateway
 	connected=callR(ser,tlf)	
+	planner.record_link(status[1],connected) #Link history for the planner
 	
 	#FILEBLOCK
 	if connected:
 		# read all files in directiory and try to send them
 		logMe(home,"coms","Connected to RUDICS Gateway")
 		dir1 = "/home/satice/new/shortlist";
+		sp=tracer.begin('send files','rudics')
 		lv.readFiles(dir1);
+		tracer.end(sp)
 
 	#END COMBLOCK
 	logMe(home,"coms","Disconnected from network")
 	disconnect(ser) #Close serial port
 	modemT(False,"Fox") #Powers off the modem.
+	tracer.save() #Session timing trace, tracer.py <file> for the table
 	sys.exit() #Kill the program
 	
 	
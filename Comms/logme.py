@@ -0,0 +1,237 @@
+#!/usr/bin/python
+"""
+Licensed under MIT (../LICENSE)
+
+LOGME.py
+
+Buffered logger. Callers only put records in a bounded queue and return;
+a background thread writes them in batches, fsyncs on a policy and
+rotates the files by size, so serial exchanges never wait for the SD
+card and the logs never fill it.
+
+Records are JSON lines:
+	{"m": monotonic seconds, "t": UTC epoch seconds, "l": log name, "msg": ...}
+plus any extra fields given. Monotonic time orders the records even if
+the clock is set by the GPS in between.
+
+When the queue is full new records are dropped and counted, the count is
+logged as soon as there is room again.
+
+Usage:
+	log = logme.get('/home/satice/', 'coms')
+	log.log('Modem ON', csq=4)
+	logme.py <log file> (prints it in a readable way)
+"""
+
+import atexit
+import ctypes
+import ctypes.util
+import json
+import os
+import Queue
+import threading
+import time
+
+# Rotate at this size (bytes), keeping this many old files (file.1, ...).
+maxsize = 512 * 1024
+backups = 3
+# Records waiting to be written, more are dropped.
+queuesize = 2048
+# Records written per batch.
+batch = 128
+# Write at least every flush_interval seconds, fsync every fsync_interval.
+flush_interval = 1.0
+fsync_interval = 30.0
+
+
+class _timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+	_librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+	_clock_gettime = _librt.clock_gettime
+	_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+except (OSError, AttributeError):
+	_clock_gettime = None
+CLOCK_MONOTONIC = 1
+
+
+def monotonic():
+	"""Seconds from an arbitrary point, never going backwards."""
+	if _clock_gettime != None:
+		ts = _timespec()
+		if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) == 0:
+			return ts.tv_sec + ts.tv_nsec * 1e-9
+	# Elapsed real time since boot, 10 ms resolution.
+	return os.times()[4]
+
+
+class logger():
+	"""Background writer of one log file."""
+	def __init__(self, path, maxsize=maxsize, backups=backups,
+		queuesize=queuesize, batch=batch, flush_interval=flush_interval,
+		fsync_interval=fsync_interval):
+		self.path = path
+		self.name = os.path.splitext(os.path.basename(path))[0]
+		self.maxsize = maxsize
+		self.backups = backups
+		self.batch = batch
+		self.flush_interval = flush_interval
+		self.fsync_interval = fsync_interval
+		self.queue = Queue.Queue(queuesize)
+		self.dropped = 0
+		self.f = None
+		self.lastsync = monotonic()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+		return
+
+	def log(self, msg, **fields):
+		"""Queues a record, never blocks. Returns False if it was dropped."""
+		fields['m'] = monotonic()
+		fields['t'] = time.time()
+		fields['l'] = self.name
+		fields['msg'] = msg
+		try:
+			self.queue.put_nowait(fields)
+		except Queue.Full:
+			self.dropped += 1
+			return False
+		return True
+
+	def close(self, timeout=5.0):
+		"""Writes what is queued, fsyncs and stops the writer."""
+		try:
+			self.queue.put(None, timeout=timeout)
+		except Queue.Full:
+			pass
+		self.thread.join(timeout)
+		return
+
+	def _open(self):
+		"""Opens the file for appending, creating the directory."""
+		d = os.path.dirname(self.path)
+		if d and not os.path.exists(d):
+			os.makedirs(d)
+		self.f = open(self.path, 'ab')
+		return
+
+	def _sync(self):
+		"""Flushes and fsyncs the file."""
+		self.f.flush()
+		os.fsync(self.f.fileno())
+		self.lastsync = monotonic()
+		return
+
+	def _rotate(self):
+		"""file -> file.1 -> file.2 ..., the oldest one is removed."""
+		self._sync()
+		self.f.close()
+		for i in range(self.backups - 1, 0, -1):
+			old = '%s.%d' % (self.path, i)
+			if os.path.exists(old):
+				os.rename(old, '%s.%d' % (self.path, i + 1))
+		if self.backups > 0:
+			os.rename(self.path, self.path + '.1')
+		else:
+			os.remove(self.path)
+		self._open()
+		return
+
+	def _write(self, records):
+		"""Writes a batch of records, rotating and fsyncing as due."""
+		if self.dropped:
+			n = self.dropped
+			self.dropped = 0
+			records.append({'m': monotonic(), 't': time.time(), 'l': self.name,
+				'msg': 'Logger queue full', 'dropped': n})
+		lines = [json.dumps(r, separators=(',', ':'), default=repr) for r in records]
+		if self.f == None:
+			self._open()
+		self.f.write('\n'.join(lines) + '\n')
+		self.f.flush()
+		if self.f.tell() >= self.maxsize:
+			self._rotate()
+		elif monotonic() - self.lastsync >= self.fsync_interval:
+			self._sync()
+		return
+
+	def _run(self):
+		"""Writer thread: waits for records, drains them in batches."""
+		stop = False
+		while not stop:
+			try:
+				r = self.queue.get(timeout=self.flush_interval)
+			except Queue.Empty:
+				if self.dropped:
+					self._safe_write([])
+				continue
+			records = []
+			while r != None:
+				records.append(r)
+				if len(records) >= self.batch:
+					break
+				try:
+					r = self.queue.get_nowait()
+				except Queue.Empty:
+					break
+			if r == None:
+				stop = True
+			if records or self.dropped:
+				self._safe_write(records)
+		if self.f != None:
+			try:
+				self._sync()
+				self.f.close()
+			except (IOError, OSError):
+				pass
+		return
+
+	def _safe_write(self, records):
+		"""_write, a full or missing card must not kill the thread."""
+		try:
+			self._write(records)
+		except (IOError, OSError):
+			self.dropped += len(records)
+			try:
+				self.f.close()
+			except (IOError, OSError, AttributeError):
+				pass
+			self.f = None
+		return
+
+
+_loggers = {}
+_lock = threading.Lock()
+
+
+def get(home, log):
+	"""Shared logger of home/log/<log>.log, started on first use."""
+	path = home + 'log/' + log + '.log'
+	_lock.acquire()
+	try:
+		if path not in _loggers:
+			_loggers[path] = logger(path)
+		return _loggers[path]
+	finally:
+		_lock.release()
+
+
+def close():
+	"""Writes and closes every logger, called at exit."""
+	for l in _loggers.values():
+		l.close()
+	return
+
+atexit.register(close)
+
+
+#### MAIN PROGRAM FOR TEST.
+if __name__ == '__main__':
+	import sys
+	for line in open(sys.argv[1], 'r'):
+		r = json.loads(line)
+		when = time.strftime('%Y-%m-%d_%H:%M:%S', time.gmtime(r.pop('t')))
+		extra = ' '.join(['%s=%s' % (k, r[k]) for k in sorted(r) if k not in ('m', 'l', 'msg')])
+		print('%s %12.3f %s %s %s' % (when, r['m'], r['l'], r['msg'], extra))
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""
+Licensed under MIT (../LICENSE)
+
+MTCMD.py
+
+Remote settings of the DMU, changed by the ground with mobile terminated
+(MT) SBD messages. The message holds commands in the format the CR1000
+already uses, "*COMMAND!", several in a row:
+
+	*#12!*PERIOD=300!*RUDICS_MAX=2!*CLASSES=data+log!
+	*DEFAULT!
+
+	#n: sequence number of the message, echoed in the acknowledge
+	NAME=value: changes a setting (table below)
+	DEFAULT: every setting back to its default
+
+Settings are kept in settings.json and read by the scripts that use
+them. Every message is acknowledged on the next mobile originated one
+(peek_ack()) with the values applied, "*ACK12:PERIOD=300,...!", and the
+rejected commands, "*NAK12:FOO=1!"; the acknowledge is kept until that
+message is sent (clear_ack()). Commands of the CR1000 (RESET, FBS,
+BURN, NORMAL) are not for the DMU and are ignored.
+
+ Settings:
+           * PERIOD: seconds between sensor samples (sensord.py)
+           * SBD_MAX, RUDICS_MAX, PHOTO_MAX: sessions and photos per
+             day at most (planner.py)
+           * COMPRESS: 1 to bz2 the photo parts (ucam.py)
+           * CLASSES: files queued for transfer, data, photo and log
+             joined by + (outbox.register)
+
+Usage:
+	mtcmd.py (current settings)
+	mtcmd.py '<MT message>' (applies it, prints the acknowledge)
+"""
+
+import json
+import os
+import sys
+
+settingsfile = '/home/satice/conf/settings.json'
+classes = ['data', 'photo', 'log']
+
+# Name -> (type, minimum, maximum, default). Sets have their members as
+# minimum and maximum.
+table = {'period': ('int', 10, 3600, 60),
+	'sbd_max': ('int', 0, 24, 24),
+	'rudics_max': ('int', 0, 24, 6),
+	'photo_max': ('int', 0, 4, 2),
+	'compress': ('bool', 0, 1, False),
+	'classes': ('set', classes, classes, list(classes))}
+# Key of the acknowledges not sent yet.
+ackkey = '_ack'
+
+
+def defaults():
+	return dict([(k, v[3]) for k, v in table.items()])
+
+
+def load(path=settingsfile):
+	"""Settings, defaults for the missing ones."""
+	s = defaults()
+	try:
+		f = open(path, 'r')
+		try:
+			s.update(json.load(f))
+		finally:
+			f.close()
+	except (IOError, ValueError):
+		pass
+	return s
+
+
+def save(s, path=settingsfile):
+	"""Writes the settings (temporary name, then rename)."""
+	d = os.path.dirname(path)
+	if d and not os.path.exists(d):
+		os.makedirs(d)
+	tmp = path + '.tmp'
+	f = open(tmp, 'w')
+	json.dump(s, f, sort_keys=True)
+	f.flush()
+	os.fsync(f.fileno())
+	f.close()
+	os.rename(tmp, path)
+	return
+
+
+def get(name, path=settingsfile):
+	"""Value of a setting."""
+	return load(path)[name]
+
+
+def parse(name, text):
+	"""Value of a setting from its text, ValueError if out of range."""
+	kind, lo, hi, default = table[name]
+	if kind == 'int':
+		v = int(text)
+		if v < lo or v > hi:
+			raise ValueError(text)
+		return v
+	if kind == 'bool':
+		if text not in ('0', '1'):
+			raise ValueError(text)
+		return text == '1'
+	v = [m for m in text.lower().split('+') if m]
+	for m in v:
+		if m not in lo:
+			raise ValueError(m)
+	return v
+
+
+def show(name, v):
+	"""Text of a value, as parse() reads it."""
+	if table[name][0] == 'bool':
+		return str(int(v))
+	if table[name][0] == 'set':
+		return '+'.join(v)
+	return str(v)
+
+
+def dispatch(message, path=settingsfile):
+	"""
+	Applies an MT message.
+	Input:
+		message: text of the MT message, as AT+SBDRT gives it
+	Output:
+		(applied, rejected): lists of 'NAME=value' and commands. The
+		acknowledge is stored for peek_ack().
+	"""
+	s = load(path)
+	seq = ''
+	applied = []
+	rejected = []
+	for token in message.split('!'):
+		token = token.strip().lstrip('*').strip()
+		if not token:
+			continue
+		if token.startswith('#'):
+			seq = token[1:]
+			continue
+		if token.upper() == 'DEFAULT':
+			for k, v in defaults().items():
+				s[k] = v
+			applied.append('DEFAULT')
+			continue
+		name, sep, value = token.partition('=')
+		name = name.strip().lower()
+		if not sep:
+			# CR1000 command or unknown, nothing to do here.
+			if name not in ('reset', 'fbs', 'burn', 'normal'):
+				rejected.append(token)
+			continue
+		try:
+			s[name] = parse(name, value.strip())
+			applied.append('%s=%s' % (name.upper(), show(name, s[name])))
+		except (KeyError, ValueError):
+			rejected.append(token)
+	if not applied and not rejected:
+		return applied, rejected
+	ack = s.get(ackkey, '')
+	if applied:
+		ack += '*ACK%s:%s!' % (seq, ','.join(applied))
+	if rejected:
+		ack += '*NAK%s:%s!' % (seq, ','.join(rejected))
+	s[ackkey] = ack
+	save(s, path)
+	return applied, rejected
+
+
+def peek_ack(path=settingsfile):
+	"""Acknowledges not sent yet (text), kept until clear_ack()."""
+	return load(path).get(ackkey, '')
+
+
+def clear_ack(sent, path=settingsfile):
+	"""Forgets the acknowledges of peek_ack() once the message carrying
+	them is sent. Those stored since stay."""
+	s = load(path)
+	ack = s.get(ackkey, '')
+	if not sent or not ack.startswith(sent):
+		return
+	s[ackkey] = ack[len(sent):]
+	if not s[ackkey]:
+		del s[ackkey]
+	save(s, path)
+	return
+
+
+def take_ack(path=settingsfile):
+	"""Acknowledges not sent yet (text), and forgets them."""
+	ack = peek_ack(path)
+	clear_ack(ack, path)
+	return ack
+
+
+#### MAIN PROGRAM FOR TEST.
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		applied, rejected = dispatch(sys.argv[1])
+		print(take_ack())
+	s = load()
+	for name in sorted(table):
+		print('%s=%s' % (name.upper(), show(name, s[name])))
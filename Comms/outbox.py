@@ -0,0 +1,365 @@
+#!/usr/bin/python
+"""
+Licensed under MIT (../LICENSE)
+
+OUTBOX.py
+
+Hands files to the outbox (/home/satice/new) without shell copies.
+A file is written once from a stream of chunks while its CRC and size
+are computed, then published to the outbox with a hard link (the bytes
+are not copied) and registered in the transfer queue (flist.csv, see
+csvme.py) straight away.
+
+CRC is the POSIX one, the same cksum gives (see shellme.fetchme).
+
+Photos can also go through a generator pipeline (send): camera chunks
+are checked, kept in the archive, optionally compressed and cut in MTU
+sized transfer parts with a header, written straight to the temp folder
+of the outbox, and queued once the last one is written. Nothing holds
+more than one part and the photo is never read back from flash.
+
+ Transfer part (little endian), at most MTU bytes in all:
+           * header: magic, part number, flags (1 last part, 2 bz2),
+             payload length, CRC32 (zlib) of the payload
+           * payload
+           * last part only: cksum CRC and size of the original file
+Only an empty file has a last part with an empty payload.
+"""
+
+import bz2
+import csv
+import os
+import struct
+import zlib
+
+import mtcmd #Classes of files the ground wants
+
+outdir = '/home/satice/new/'
+partdir = '/home/satice/new/temp/'
+queue = '/home/satice/conf/flist.csv'
+mtu = 7000
+header = ['FILENAME', 'TSENT', 'PART', 'CRC', 'SIZE', 'PATH', 'ACK']
+
+part_fmt = '<4sHBHI'
+part_size = struct.calcsize(part_fmt)
+part_magic = 'SPT1'
+trailer_fmt = '<II'
+trailer_size = struct.calcsize(trailer_fmt)
+flag_last = 0x01
+flag_bz2 = 0x02
+
+
+def _table():
+	"""CRC table of the POSIX cksum polynomial (MSB first)."""
+	t = []
+	for i in range(256):
+		c = i << 24
+		for j in range(8):
+			if c & 0x80000000:
+				c = ((c << 1) ^ 0x04C11DB7) & 0xffffffff
+			else:
+				c = (c << 1) & 0xffffffff
+		t.append(c)
+	return t
+
+crctable = _table()
+
+
+class cksum():
+	"""Incremental POSIX cksum. Feed it with update(), read value()."""
+	def __init__(self):
+		self.crc = 0
+		self.size = 0
+		return
+
+	def update(self, data):
+		"""Adds a chunk of bytes (string)."""
+		crc = self.crc
+		t = crctable
+		for ch in data:
+			crc = ((crc << 8) & 0xffffffff) ^ t[((crc >> 24) ^ ord(ch)) & 0xff]
+		self.crc = crc
+		self.size += len(data)
+		return
+
+	def value(self):
+		"""CRC of everything so far, as cksum prints it."""
+		crc = self.crc
+		n = self.size
+		# cksum appends the length, least significant byte first.
+		while n:
+			crc = ((crc << 8) & 0xffffffff) ^ crctable[((crc >> 24) ^ n) & 0xff]
+			n >>= 8
+		return (~crc) & 0xffffffff
+
+
+def write(chunks, path):
+	"""
+	Writes a stream of chunks to path (temporary name, then rename),
+	computing the CRC on the way.
+	Input:
+		chunks: iterable of strings
+		path: destination file
+	Output:
+		crc, size
+	"""
+	d = os.path.dirname(path)
+	if d and not os.path.exists(d):
+		os.makedirs(d)
+	ck = cksum()
+	tmp = path + '.part'
+	f = open(tmp, 'wb')
+	try:
+		for chunk in chunks:
+			ck.update(chunk)
+			f.write(chunk)
+		f.flush()
+		os.fsync(f.fileno())
+	finally:
+		f.close()
+	os.rename(tmp, path)
+	return ck.value(), ck.size
+
+
+def publish(path, outdir=outdir):
+	"""
+	Makes path visible in the outbox. Hard link when possible, otherwise
+	(different file system) a copy under a temporary name then renamed,
+	so the outbox never shows a partial file.
+	Output:
+		Path of the file in the outbox.
+	"""
+	dest = os.path.join(outdir, os.path.basename(path))
+	if os.path.exists(dest):
+		os.remove(dest)
+	try:
+		os.link(path, dest)
+	except OSError:
+		src = open(path, 'rb')
+		tmp = dest + '.part'
+		f = open(tmp, 'wb')
+		while True:
+			chunk = src.read(8192)
+			if not chunk:
+				break
+			f.write(chunk)
+		f.close()
+		src.close()
+		os.rename(tmp, dest)
+	return dest
+
+
+def register(path, crc, size, part=0, queue=queue, kind='data'):
+	"""Appends a file to the transfer queue, not sent yet (TSENT 0.0).
+	Files of a class (data, photo, log) the ground turned off (mtcmd.py)
+	stay in the outbox unqueued, returns False then."""
+	if kind not in mtcmd.get('classes'):
+		return False
+	new = not os.path.exists(queue)
+	f = open(queue, 'ab')
+	w = csv.writer(f)
+	if new:
+		w.writerow(header)
+	w.writerow([os.path.basename(path), 0.0, part, crc, size, path, 0])
+	f.close()
+	return True
+
+
+def store(chunks, path, outdir=outdir, queue=queue):
+	"""
+	Writes a file once from a stream of chunks, publishes it to the
+	outbox and registers it in the transfer queue.
+	Output:
+		crc, size
+	"""
+	crc, size = write(chunks, path)
+	register(publish(path, outdir), crc, size, queue=queue)
+	return crc, size
+
+
+def crc_stage(chunks, ck):
+	"""Passes chunks through, adding them to the cksum ck."""
+	for chunk in chunks:
+		ck.update(chunk)
+		yield chunk
+
+
+def tee_stage(chunks, f):
+	"""Passes chunks through, writing them to the open file f."""
+	for chunk in chunks:
+		f.write(chunk)
+		yield chunk
+
+
+def compress_stage(chunks, level=9):
+	"""Compresses a stream of chunks (bz2)."""
+	comp = bz2.BZ2Compressor(level)
+	for chunk in chunks:
+		out = comp.compress(chunk)
+		if out:
+			yield out
+	yield comp.flush()
+
+
+def cut_stage(chunks, mtu=mtu):
+	"""
+	Cuts a stream of chunks in payloads for parts of mtu bytes, header
+	included, and the trailer too on the last one.
+	Output:
+		Yields (payload, last). The last payload is empty only if the
+		stream is.
+	"""
+	room = mtu - part_size
+	lastroom = room - trailer_size
+	buf = ''
+	for chunk in chunks:
+		buf += chunk
+		# More data behind, so these are not the last part.
+		while len(buf) > room:
+			yield buf[:room], False
+			buf = buf[room:]
+	if len(buf) > lastroom:
+		# No room left for the trailer, its own part for the tail.
+		yield buf[:lastroom], False
+		buf = buf[lastroom:]
+	yield buf, True
+
+
+def send(chunks, path, mtu=mtu, compress=False, partdir=partdir, queue=queue):
+	"""
+	Photo pipeline: writes the archive copy to path and the transfer
+	parts (path name + _000, _001...) to partdir while the chunks
+	arrive. The parts are queued once the last one is written (CRC
+	column is the CRC32 of its payload, as in its header), and removed
+	with the archive copy if the stream fails before. An empty stream
+	raises IOError, nothing is queued.
+	Input:
+		chunks: iterable of strings, i.e. vc0706.stream_photo()
+		path: archive copy, i.e. /home/satice/img/<photo>
+		mtu: bytes per part, header and trailer included
+		compress: bz2 the parts (.bz2 is added to their name)
+	Output:
+		crc, size (of the original bytes, cksum) and number of parts.
+	"""
+	for d in (os.path.dirname(path), partdir):
+		if d and not os.path.exists(d):
+			os.makedirs(d)
+	name = os.path.basename(path)
+	flags = 0
+	if compress:
+		name += '.bz2'
+		flags |= flag_bz2
+	ck = cksum()
+	tmp = path + '.part'
+	f = open(tmp, 'wb')
+	parts = []
+	done = False
+	try:
+		stream = tee_stage(crc_stage(chunks, ck), f)
+		if compress:
+			stream = compress_stage(stream)
+		part = 0
+		for payload, last in cut_stage(stream, mtu):
+			crc = zlib.crc32(payload) & 0xffffffff
+			fl = flags
+			if last:
+				fl |= flag_last
+			data = struct.pack(part_fmt, part_magic, part, fl, len(payload), crc) + payload
+			if last:
+				data += struct.pack(trailer_fmt, ck.value(), ck.size)
+			dest = os.path.join(partdir, '%s_%03d' % (name, part))
+			p = open(dest + '.part', 'wb')
+			p.write(data)
+			p.close()
+			os.rename(dest + '.part', dest)
+			parts.append((dest, crc, len(data), part))
+			part += 1
+		if ck.size == 0:
+			raise IOError('%s: no data from the stream' % path)
+		f.flush()
+		os.fsync(f.fileno())
+		done = True
+	finally:
+		f.close()
+		if not done:
+			# No last part, the ground could never complete the file.
+			for dest in [tmp] + [p[0] for p in parts]:
+				try:
+					os.remove(dest)
+				except OSError:
+					pass
+	os.rename(tmp, path)
+	for dest, crc, size, n in parts:
+		register(dest, crc, size, n, queue, 'photo')
+	return ck.value(), ck.size, part
+
+
+def read_part(data):
+	"""
+	Decodes a transfer part.
+	Output:
+		part, flags, payload and (crc, size) of the file for the last
+		part, None otherwise. Raises ValueError if it is corrupted.
+	"""
+	hsize = struct.calcsize(part_fmt)
+	if len(data) < hsize:
+		raise ValueError('Short part')
+	magic, part, flags, length, crc = struct.unpack(part_fmt, data[:hsize])
+	if magic != part_magic:
+		raise ValueError('Not a transfer part')
+	payload = data[hsize:hsize + length]
+	if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+		raise ValueError('Bad CRC on part %d' % part)
+	total = None
+	if flags & flag_last:
+		total = struct.unpack(trailer_fmt, data[hsize + length:hsize + length + struct.calcsize(trailer_fmt)])
+	return part, flags, payload, total
+
+
+def test(tmpdir):
+	"""Checks send() in tmpdir: a photo in parts, a stream failing half
+	way and an empty one, neither leaving parts, archive or queue rows."""
+	partdir = os.path.join(tmpdir, 'temp')
+	queue = os.path.join(tmpdir, 'flist.csv')
+	data = ''.join([chr(i % 251) for i in range(3 * mtu)])
+
+	def chunks(fail=False):
+		for i in range(0, len(data), 4096):
+			if fail and i > mtu:
+				raise IOError('camera gone')
+			yield data[i:i + 4096]
+
+	crc, size, n = send(chunks(), os.path.join(tmpdir, 'ok'), partdir=partdir, queue=queue)
+	assert (size, n) == (len(data), 4)
+	queued = open(queue, 'rb').read()
+	for name, stream in (('failed', chunks(True)), ('empty', iter([]))):
+		try:
+			send(stream, os.path.join(tmpdir, name), partdir=partdir, queue=queue)
+			raise AssertionError(name + ' sent')
+		except IOError:
+			pass
+	assert sorted(os.listdir(tmpdir)) == ['flist.csv', 'ok', 'temp']
+	assert len(os.listdir(partdir)) == n
+	assert open(queue, 'rb').read() == queued
+	print('send: %d parts, failed and empty streams left nothing' % n)
+	return
+
+
+#### MAIN PROGRAM FOR TEST.
+if __name__ == '__main__':
+	import sys
+	if sys.argv[1] == 'test':
+		import shutil
+		import tempfile
+		tmpdir = tempfile.mkdtemp()
+		try:
+			test(tmpdir)
+		finally:
+			shutil.rmtree(tmpdir)
+		sys.exit(0)
+	fle = sys.argv[1]
+	ck = cksum()
+	f = open(fle, 'rb')
+	ck.update(f.read())
+	f.close()
+	print(str(ck.value()) + ' ' + str(ck.size) + ' ' + fle)
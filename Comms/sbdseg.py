@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""
+Licensed under MIT (../LICENSE)
+
+SBDSEG.py
+
+Payloads larger than one SBD message (a day of records, a status dump, a
+thumbnail) cut in segments that fit the MO buffer, to be sent back to
+back in one SBD session (amodem.sbd_send) instead of a RUDICS call. The
+ground puts them together again in any order, repeats ignored
+(Ground/reassemble.py, segments).
+
+ Segment (little endian, binary SBD, AT+SBDWB):
+           * header: magic 0xA5, payload id, segment number, segments
+           * first segment only: CRC32 (zlib) of the whole payload
+           * data
+The magic is not ASCII, so segments never look like the text messages
+of the CR1000.
+
+Works with Python 2 and 3.
+
+Usage: sbdseg.py <file> (segments it would take)
+"""
+
+import os
+import struct
+import sys
+import zlib
+
+# MO buffer of the 9602/9603 (bytes).
+mtu = 340
+seg_fmt = '<BHBB'
+seg_size = struct.calcsize(seg_fmt)
+crc_fmt = '<I'
+crc_size = struct.calcsize(crc_fmt)
+magic = 0xA5
+# Last payload id, kept so ids don't repeat after a reboot.
+idfile = '/home/satice/conf/sbdseg.id'
+
+
+def next_id(path=idfile):
+	"""Next payload id (16 bits, wraps)."""
+	n = 0
+	try:
+		f = open(path, 'r')
+		n = (int(f.read().strip() or 0) + 1) & 0xffff
+		f.close()
+	except (IOError, ValueError):
+		pass
+	d = os.path.dirname(path)
+	if d and not os.path.exists(d):
+		os.makedirs(d)
+	f = open(path, 'w')
+	f.write('%d\n' % n)
+	f.close()
+	return n
+
+
+def split(payload, pid, mtu=mtu):
+	"""
+	Cuts a payload in segments.
+	Input:
+		payload: bytes
+		pid: payload id, next_id()
+		mtu: bytes per SBD message
+	Output:
+		List of segments (bytes). ValueError if it takes more than 255.
+	"""
+	crc = struct.pack(crc_fmt, zlib.crc32(payload) & 0xffffffff)
+	data = crc + payload
+	room = mtu - seg_size
+	count = max(1, (len(data) + room - 1) // room)
+	if count > 255:
+		raise ValueError('%d bytes take more than 255 segments' % len(payload))
+	return [struct.pack(seg_fmt, magic, pid, i, count) + data[i * room:(i + 1) * room]
+		for i in range(count)]
+
+
+def is_segment(msg):
+	"""True if an SBD message is a segment."""
+	if len(msg) < seg_size:
+		return False
+	m, pid, n, count = struct.unpack(seg_fmt, msg[:seg_size])
+	return m == magic and n < count
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print(__doc__)
+		sys.exit(1)
+	f = open(sys.argv[1], 'rb')
+	payload = f.read()
+	f.close()
+	segs = split(payload, 0)
+	print('%d bytes, %d segments of %d bytes at most, %d bytes sent' % (len(payload),
+		len(segs), mtu, sum([len(s) for s in segs])))
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+"""
+Licensed under MIT (../LICENSE)
+
+TRACER.py
+
+Timing traces of the modem sessions. Every operation (power on, port
+probe, AT command, registration, SBD session, dial, file sent) is a span
+with monotonic start and end, bytes and result, kept in memory while the
+session runs and saved at the end as a Chrome trace (open it in
+chrome://tracing or Perfetto). The table mode aggregates any number of
+traces into percentiles per operation, to see where sessions spend
+their time.
+
+Usage:
+	sp = tracer.begin('AT+CSQ')
+	...
+	tracer.end(sp, nbytes=12, result='4')
+	tracer.save()
+	tracer.py <trace.json> [...] (percentile table per operation)
+"""
+
+import json
+import os
+import time
+
+import logme #monotonic()
+
+tracedir = '/home/satice/log/trace/'
+# False makes begin() and end() do nothing.
+enabled = True
+
+events = []
+_origin = logme.monotonic()
+_wall = time.time()
+
+
+def begin(name, cat='modem', **args):
+	"""Starts a span, returns it for end()."""
+	if not enabled:
+		return None
+	return {'name': name, 'cat': cat, 'start': logme.monotonic(), 'args': args}
+
+
+def end(span, result=None, nbytes=0, **args):
+	"""Ends a span with its result and the bytes it moved."""
+	if span == None:
+		return
+	t = logme.monotonic()
+	span['args'].update(args)
+	if result != None:
+		span['args']['result'] = str(result)
+	span['args']['bytes'] = nbytes
+	events.append({'name': span['name'], 'cat': span['cat'], 'ph': 'X',
+		'ts': int((span['start'] - _origin) * 1e6),
+		'dur': int((t - span['start']) * 1e6),
+		'pid': os.getpid(), 'tid': 1, 'args': span['args']})
+	return
+
+
+def traced(name, cat='modem'):
+	"""Decorator, a span for every call of the function, the return
+	value is the result."""
+	def wrap(f):
+		def call(*a, **k):
+			sp = begin(name, cat)
+			ret = None
+			try:
+				ret = f(*a, **k)
+			finally:
+				end(sp, ret)
+			return ret
+		call.__name__ = f.__name__
+		call.__doc__ = f.__doc__
+		return call
+	return wrap
+
+
+def save(path=None):
+	"""Writes the session as a Chrome trace, returns its path."""
+	if path == None:
+		if not os.path.exists(tracedir):
+			os.makedirs(tracedir)
+		path = tracedir + time.strftime('%Y%m%d_%H%M%S', time.gmtime(_wall)) + '.json'
+	f = open(path, 'w')
+	json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+		'otherData': {'start': _wall}}, f)
+	f.close()
+	return path
+
+
+def load(paths):
+	"""Spans of several trace files."""
+	ret = []
+	for path in paths:
+		f = open(path, 'r')
+		ret.extend([e for e in json.load(f)['traceEvents'] if e.get('ph') == 'X'])
+		f.close()
+	return ret
+
+
+def table(spans, ps=(50, 90, 99)):
+	"""
+	Aggregates spans per operation.
+	Output:
+		Rows sorted by total time: (name, count, total s, percentiles of
+		the duration in ms..., max ms, bytes)
+	"""
+	durs = {}
+	nbytes = {}
+	for e in spans:
+		durs.setdefault(e['name'], []).append(e['dur'] / 1000.0)
+		nbytes[e['name']] = nbytes.get(e['name'], 0) + e['args'].get('bytes', 0)
+	rows = []
+	for name, d in durs.items():
+		d.sort()
+		pct = [d[min(len(d) - 1, len(d) * p // 100)] for p in ps]
+		rows.append((name, len(d), sum(d) / 1000.0) + tuple(pct) + (d[-1], nbytes[name]))
+	rows.sort(key=lambda r: -r[2])
+	return rows
+
+
+#### MAIN PROGRAM FOR TEST.
+if __name__ == '__main__':
+	import sys
+	print('%-16s %6s %9s %9s %9s %9s %9s %9s' % ('operation', 'count', 'total s',
+		'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'bytes'))
+	for r in table(load(sys.argv[1:])):
+		print('%-16s %6d %9.1f %9.1f %9.1f %9.1f %9.1f %9d' % r)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+fleetsim.py
+
+Fleet load generator for the ground station. A process pool simulates N
+buoys for some hours: hourly SBD messages (CR1000 format), hourly data
+files cut in plain parts (shellme.scomp) and dawn/dusk photos in outbox
+parts (Comms/outbox.py), each transmission lost with some probability,
+delayed at random (so parts arrive out of order) and retransmitted until
+it gets through, sometimes twice when the acknowledge is lost. The
+traffic of the fleet is then played, in arrival order and as fast as it
+can go, through the ground decoder (sbddecode.py) and reassembler
+(reassemble.py).
+
+Reported per fleet size: messages and bytes per second through the
+ground code, ground processing latency of the SBD messages (arrival to
+decoded, batched), and simulated delivery latency of the files (first
+transmission to complete on the ground), loss and retransmissions
+included.
+
+Usage: fleetsim.py [buoys...] (i.e. fleetsim.py 10 50 100)
+"""
+
+import binascii
+import heapq
+import multiprocessing
+import random
+import sys
+import time
+
+import reassemble
+import sbddecode
+
+hours = 24
+# Probability a transmission is lost, and of a lost acknowledge (the
+# buoy sends a part that got through again).
+loss = 0.1
+ackloss = 0.02
+# Extra random delay of every transmission (s), it reorders the parts.
+reorder = 300.0
+# Seconds before the buoy sends a part again (csvme.hkFLIST timeout).
+retry = 600.0
+# RUDICS throughput (bytes/s) and SBD session time (s).
+rudics_rate = 250.0
+sbd_time = 20.0
+mtu = reassemble.mtu
+# Data file of every hour (bytes).
+datafile = (20000, 60000)
+photosize = 21000
+# SBD messages decoded per batch on the ground.
+sbd_batch = 1000
+
+
+def _randbytes(rng, n):
+	"""n random bytes from rng."""
+	return binascii.unhexlify('%0*x' % (2 * n, rng.getrandbits(8 * n)))
+
+
+def _deliveries(rng, t, duration):
+	"""Arrival times of a transmission sent at t, with retransmissions."""
+	ret = []
+	while True:
+		arrive = t + duration + rng.uniform(0, reorder)
+		if rng.random() >= loss:
+			ret.append(arrive)
+			if rng.random() >= ackloss:
+				return ret
+		t += retry
+
+
+def buoy(args):
+	"""
+	Traffic of one buoy.
+	Input:
+		(buoy number, hours, seed)
+	Output:
+		Events sorted by arrival: (arrival, sent, imei, kind, name, data),
+		kind is 'sbd' or 'part'; and the number of files sent.
+	"""
+	n, hours, seed = args
+	rng = random.Random(seed)
+	imei = '3002340107%05d' % n
+	start = 1.45e9
+	events = []
+	files = 0
+	for h in range(hours):
+		t = start + 3600 * h + rng.uniform(0, 60)
+		vals = [rng.uniform(0, 100) for i in range(len(sbddecode.fields))]
+		payload = ''.join(['%.2f ' % v for v in vals]) + ',%.5f %.5f %s' % (
+			rng.uniform(-80, -60), rng.uniform(-180, 180),
+			time.strftime('%H%M%S', time.gmtime(t)))
+		for a in _deliveries(rng, t, sbd_time):
+			events.append((a, t, imei, 'sbd', h, payload))
+		parts = reassemble.split_parts('%s_%05d.dat' % (imei, h),
+			_randbytes(rng, rng.randint(*datafile)), mtu)
+		if h % 12 == 6:
+			parts += reassemble.make_parts('%s_%05d.jpg' % (imei, h),
+				_randbytes(rng, photosize), mtu)
+			files += 1
+		files += 1
+		t += sbd_time
+		for name, data in parts:
+			duration = len(data) / rudics_rate
+			for a in _deliveries(rng, t, duration):
+				events.append((a, t, imei, 'part', name, data))
+			t += duration
+	events.sort()
+	return events, files
+
+
+def ground(streams):
+	"""
+	Plays the merged traffic through the ground code.
+	Output:
+		Dictionary of results.
+	"""
+	r = reassemble.reassembler(mtu)
+	batch = []
+	sbd_lat = []
+	file_lat = []
+	first = {}
+	count = 0
+	nbytes = 0
+	seen = set()
+	t0 = time.time()
+	for arrival, sent, imei, kind, name, data in heapq.merge(*streams):
+		count += 1
+		nbytes += len(data)
+		if kind == 'sbd':
+			# MOMSN is new for every transmission, the hour identifies it.
+			batch.append(((imei, 0, arrival, data), time.time(), (imei, name)))
+			if len(batch) >= sbd_batch:
+				_decode(batch, sbd_lat, seen)
+				batch = []
+			continue
+		fle = name.rpartition('_')[0]
+		first[fle] = min(first.get(fle, sent), sent)
+		try:
+			done = r.add(name, data, arrival)
+		except ValueError:
+			# Corrupted file, counted by the reassembler.
+			continue
+		if done != None:
+			file_lat.append(arrival - first.pop(done[0]))
+	if batch:
+		_decode(batch, sbd_lat, seen)
+	wall = time.time() - t0
+	return {'events': count, 'bytes': nbytes, 'wall': wall, 'sbd': len(seen),
+		'sbd_lat': sbd_lat, 'file_lat': file_lat, 'files': r.completed,
+		'duplicates': r.duplicates, 'bad': r.bad, 'pending': len(r.pending())}
+
+
+def _decode(batch, lat, seen):
+	"""Decodes a batch of SBD messages, keeps their latency."""
+	sbddecode.decode([b[0] for b in batch])
+	now = time.time()
+	for msg, t, key in batch:
+		lat.append(now - t)
+		seen.add(key)
+	return
+
+
+def percentiles(values, ps=(50, 90, 99)):
+	values = sorted(values)
+	if not values:
+		return [float('nan')] * len(ps)
+	return [values[min(len(values) - 1, len(values) * p // 100)] for p in ps]
+
+
+def run(n, pool, hours=hours):
+	"""Simulates a fleet of n buoys, returns the results."""
+	t0 = time.time()
+	out = pool.map(buoy, [(i, hours, i) for i in range(n)])
+	gen = time.time() - t0
+	res = ground([o[0] for o in out])
+	res['sent_files'] = sum([o[1] for o in out])
+	res['generate'] = gen
+	return res
+
+
+if __name__ == '__main__':
+	fleet = [int(a) for a in sys.argv[1:]] or [10, 20, 50]
+	pool = multiprocessing.Pool()
+	print('buoys,events,MB,gen s,ground s,events/s,MB/s,sbd,sbd p50/p90/p99 ms,'
+		'files ok/sent,dups,file p50/p90/p99 s')
+	for n in fleet:
+		res = run(n, pool)
+		s = percentiles(res['sbd_lat'])
+		f = percentiles(res['file_lat'])
+		print('%d,%d,%.1f,%.1f,%.2f,%.0f,%.2f,%d,%.1f/%.1f/%.1f,%d/%d,%d,%.0f/%.0f/%.0f' % (
+			n, res['events'], res['bytes'] / 1e6, res['generate'], res['wall'],
+			res['events'] / res['wall'], res['bytes'] / 1e6 / res['wall'], res['sbd'],
+			1000 * s[0], 1000 * s[1], 1000 * s[2], res['files'], res['sent_files'],
+			res['duplicates'], f[0], f[1], f[2]))
+	pool.close()
+	pool.join()
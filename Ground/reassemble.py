@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+reassemble.py
+
+Ground station reassembly of the files sent by the buoys in transfer
+parts, in any order and with repeated parts (retransmissions):
+
+	* outbox parts (Comms/outbox.py): "<file>_NNN" with a SPT1 header,
+	  the last part is flagged and carries the cksum CRC and size of the
+	  file, which is checked
+	* plain parts (shellme.scomp, split -b MTU): "<file>_NNN", the first
+	  part shorter than the MTU is the last one
+
+and of the payloads sent in several SBD messages (Comms/sbdseg.py,
+segments): 0xA5 header with payload id, segment number and count, the
+CRC32 of the payload at the start of the first segment.
+
+Usage: reassemble.py <output dir> <part file> [...]
+"""
+
+import bz2
+import os
+import struct
+import sys
+import time
+import zlib
+
+mtu = 7000
+
+part_fmt = '<4sHBHI'
+part_size = struct.calcsize(part_fmt)
+part_magic = b'SPT1'
+trailer_fmt = '<II'
+trailer_size = struct.calcsize(trailer_fmt)
+flag_last = 0x01
+flag_bz2 = 0x02
+
+seg_fmt = '<BHBB'
+seg_size = struct.calcsize(seg_fmt)
+seg_magic = 0xA5
+
+
+def _table():
+	"""CRC table of the POSIX cksum polynomial (MSB first)."""
+	t = []
+	for i in range(256):
+		c = i << 24
+		for j in range(8):
+			if c & 0x80000000:
+				c = ((c << 1) ^ 0x04C11DB7) & 0xffffffff
+			else:
+				c = (c << 1) & 0xffffffff
+		t.append(c)
+	return t
+
+crctable = _table()
+
+
+def cksum(data):
+	"""POSIX cksum CRC of a string of bytes, as the buoy computes it."""
+	crc = 0
+	t = crctable
+	for b in bytearray(data):
+		crc = ((crc << 8) & 0xffffffff) ^ t[((crc >> 24) ^ b) & 0xff]
+	n = len(data)
+	while n:
+		crc = ((crc << 8) & 0xffffffff) ^ t[((crc >> 24) ^ n) & 0xff]
+		n >>= 8
+	return (~crc) & 0xffffffff
+
+
+def make_parts(name, data, mtu=mtu, compress=False):
+	"""Outbox parts of a file, [(part name, bytes)], as Comms/outbox.py
+	sends them (for tests and simulations)."""
+	crc, size = cksum(data), len(data)
+	flags = 0
+	if compress:
+		data = bz2.compress(data)
+		name += '.bz2'
+		flags |= flag_bz2
+	# Parts of mtu bytes in all, header and trailer included.
+	room = mtu - part_size
+	lastroom = room - trailer_size
+	chunks = [data[i:i + room] for i in range(0, len(data), room)] or [b'']
+	if len(chunks[-1]) > lastroom:
+		tail = chunks.pop()
+		chunks += [tail[:lastroom], tail[lastroom:]]
+	ret = []
+	for i, payload in enumerate(chunks):
+		fl = flags
+		if i == len(chunks) - 1:
+			fl |= flag_last
+		p = struct.pack(part_fmt, part_magic, i, fl, len(payload),
+			zlib.crc32(payload) & 0xffffffff) + payload
+		if fl & flag_last:
+			p += struct.pack(trailer_fmt, crc, size)
+		ret.append(('%s_%03d' % (name, i), p))
+	return ret
+
+
+def split_parts(name, data, mtu=mtu):
+	"""Plain parts of a file, as shellme.scomp (split -b) leaves them."""
+	return [('%s_%03d' % (name, i // mtu), data[i:i + mtu])
+		for i in range(0, max(len(data), 1), mtu)]
+
+
+class reassembler():
+	"""Collects parts until files are complete."""
+	def __init__(self, mtu=mtu):
+		self.mtu = mtu
+		# File -> {'parts': {n: payload}, 'last': n or None, 'first':
+		# time, 'flags': flags, 'total': (crc, size) or None}
+		self.files = {}
+		# Files already complete, their late retransmissions are repeats.
+		self.done = set()
+		self.duplicates = 0
+		self.bad = 0
+		self.completed = 0
+		return
+
+	def add(self, name, data, now=None):
+		"""
+		Adds a part.
+		Input:
+			name: part name, <file>_NNN
+			data: bytes of the part
+		Output:
+			(file, bytes) if the part completed a file, None otherwise.
+			Raises ValueError for a corrupted file (CRC or size).
+		"""
+		if now == None:
+			now = time.time()
+		fle, sep, n = name.rpartition('_')
+		try:
+			n = int(n)
+		except ValueError:
+			self.bad += 1
+			return None
+		last = None
+		flags = 0
+		total = None
+		if data[:4] == part_magic and len(data) >= part_size:
+			magic, n, flags, length, crc = struct.unpack(part_fmt, data[:part_size])
+			payload = data[part_size:part_size + length]
+			if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+				self.bad += 1
+				return None
+			if flags & flag_last:
+				last = n
+				total = struct.unpack(trailer_fmt,
+					data[part_size + length:part_size + length + trailer_size])
+		else:
+			payload = data
+			if len(payload) < self.mtu:
+				last = n
+		if fle in self.done:
+			self.duplicates += 1
+			return None
+		f = self.files.get(fle)
+		if f == None:
+			f = self.files[fle] = {'parts': {}, 'last': None, 'first': now,
+				'flags': flags, 'total': None}
+		if n in f['parts']:
+			self.duplicates += 1
+			return None
+		f['parts'][n] = payload
+		if last != None:
+			f['last'] = last
+		if total != None:
+			f['total'] = total
+		if f['last'] == None or len(f['parts']) < f['last'] + 1:
+			return None
+		return fle, self._finish(fle)
+
+	def _finish(self, fle):
+		"""Joins a complete file and checks it. A corrupted file is
+		dropped, so a retransmission can complete it."""
+		f = self.files.pop(fle)
+		data = b''.join([f['parts'][i] for i in range(f['last'] + 1)])
+		try:
+			if f['flags'] & flag_bz2:
+				data = bz2.decompress(data)
+		except (IOError, ValueError):
+			data = None
+		if f['total'] != None and data != None:
+			crc, size = f['total']
+			if len(data) != size or cksum(data) != crc:
+				data = None
+		if data == None:
+			self.bad += 1
+			raise ValueError('%s: corrupted file (bz2, CRC or size)' % fle)
+		self.done.add(fle)
+		self.completed += 1
+		return data
+
+	def pending(self):
+		"""Incomplete files: name -> (parts received, last part or None)."""
+		return dict([(k, (len(f['parts']), f['last'])) for k, f in self.files.items()])
+
+	def expire(self, age, now=None):
+		"""Drops incomplete files older than age seconds, returns them."""
+		if now == None:
+			now = time.time()
+		old = [k for k, f in self.files.items() if now - f['first'] > age]
+		for k in old:
+			del self.files[k]
+		return old
+
+
+class segments():
+	"""Collects SBD segments until payloads are complete. With a store
+	directory the segments are kept there until their payload is complete
+	(<imei>/segments/<id>_<n>.seg) and the payloads done are marked
+	(<imei>/segments/<id>.done), so a payload whose segments come in
+	different runs is still put together."""
+	def __init__(self, store=None):
+		# (imei, id) -> {'segs': {n: data}, 'count': n, 'first': time}
+		self.payloads = {}
+		# Payloads already complete -> time, their repeats are ignored
+		# until they expire (ids wrap).
+		self.done = {}
+		self.duplicates = 0
+		self.bad = 0
+		self.completed = 0
+		self.store = store
+		if store != None:
+			self._load()
+		return
+
+	@staticmethod
+	def is_segment(msg):
+		"""True if an SBD message (bytes) is a segment."""
+		if len(msg) < seg_size:
+			return False
+		magic, pid, n, count = struct.unpack(seg_fmt, msg[:seg_size])
+		return magic == seg_magic and n < count
+
+	def add(self, imei, msg, now=None):
+		"""
+		Adds a segment.
+		Input:
+			imei: buoy
+			msg: bytes of the SBD message
+		Output:
+			(imei, payload id, payload) if the segment completed one, None
+			otherwise. Raises ValueError for a corrupted payload (CRC), its
+			segments are dropped so a retransmission can complete it.
+		"""
+		if now == None:
+			now = time.time()
+		if not self.is_segment(msg):
+			self.bad += 1
+			return None
+		magic, pid, n, count = struct.unpack(seg_fmt, msg[:seg_size])
+		key = (imei, pid)
+		if key in self.done:
+			self.duplicates += 1
+			return None
+		p = self.payloads.get(key)
+		if p != None and p['count'] != count:
+			# Same id, another payload: the old one can't be completed.
+			self._drop(key)
+			p = None
+		if p == None:
+			p = self.payloads[key] = {'segs': {}, 'count': count, 'first': now}
+		if n in p['segs']:
+			self.duplicates += 1
+			return None
+		p['segs'][n] = msg[seg_size:]
+		if len(p['segs']) < count:
+			self._keep(imei, pid, n, msg, now)
+			return None
+		self._drop(key)
+		data = b''.join([p['segs'][i] for i in range(count)])
+		crc, = struct.unpack('<I', data[:4])
+		data = data[4:]
+		if zlib.crc32(data) & 0xffffffff != crc:
+			self.bad += 1
+			raise ValueError('%s payload %d: CRC mismatch' % (imei, pid))
+		self.done[key] = now
+		self._mark(imei, pid, now)
+		self.completed += 1
+		return imei, pid, data
+
+	def pending(self):
+		"""Incomplete payloads: (imei, id) -> (segments received, count)."""
+		return dict([(k, (len(p['segs']), p['count'])) for k, p in self.payloads.items()])
+
+	def expire(self, age, now=None):
+		"""Drops incomplete payloads older than age seconds, returns
+		them, and forgets the complete ones as old."""
+		if now == None:
+			now = time.time()
+		old = [k for k, p in self.payloads.items() if now - p['first'] > age]
+		for k in old:
+			self._drop(k)
+		for k in [k for k, t in self.done.items() if now - t > age]:
+			del self.done[k]
+			if self.store != None:
+				self._remove(os.path.join(self.store, k[0], 'segments', '%d.done' % k[1]))
+		return old
+
+	def _load(self):
+		"""Segments and payloads done of the previous runs, from the
+		store."""
+		if not os.path.isdir(self.store):
+			return
+		for imei in sorted(os.listdir(self.store)):
+			d = os.path.join(self.store, imei, 'segments')
+			if not os.path.isdir(d):
+				continue
+			for name in sorted(os.listdir(d)):
+				path = os.path.join(d, name)
+				base, ext = os.path.splitext(name)
+				t = os.path.getmtime(path)
+				try:
+					nums = [int(x) for x in base.split('_')]
+				except ValueError:
+					continue
+				if ext == '.done' and len(nums) == 1:
+					self.done[(imei, nums[0])] = t
+				elif ext == '.seg' and len(nums) == 2:
+					f = open(path, 'rb')
+					msg = f.read()
+					f.close()
+					if not self.is_segment(msg):
+						continue
+					magic, pid, n, count = struct.unpack(seg_fmt, msg[:seg_size])
+					p = self.payloads.get((imei, pid))
+					if p == None:
+						p = self.payloads[(imei, pid)] = {'segs': {}, 'count': count, 'first': t}
+					if p['count'] != count:
+						continue
+					p['segs'][n] = msg[seg_size:]
+					p['first'] = min(p['first'], t)
+		return
+
+	def _keep(self, imei, pid, n, msg, now):
+		"""Stores a segment of an incomplete payload."""
+		if self.store == None:
+			return
+		d = os.path.join(self.store, imei, 'segments')
+		if not os.path.exists(d):
+			os.makedirs(d)
+		path = os.path.join(d, '%d_%d.seg' % (pid, n))
+		f = open(path + '.tmp', 'wb')
+		f.write(msg)
+		f.close()
+		os.utime(path + '.tmp', (now, now))
+		os.rename(path + '.tmp', path)
+		return
+
+	def _mark(self, imei, pid, now):
+		"""Marks a payload done in the store."""
+		if self.store == None:
+			return
+		d = os.path.join(self.store, imei, 'segments')
+		if not os.path.exists(d):
+			os.makedirs(d)
+		path = os.path.join(d, '%d.done' % pid)
+		open(path, 'w').close()
+		os.utime(path, (now, now))
+		return
+
+	def _drop(self, key):
+		"""Forgets an incomplete payload and its stored segments."""
+		p = self.payloads.pop(key, None)
+		if p == None or self.store == None:
+			return
+		d = os.path.join(self.store, key[0], 'segments')
+		for n in p['segs']:
+			self._remove(os.path.join(d, '%d_%d.seg' % (key[1], n)))
+		return
+
+	@staticmethod
+	def _remove(path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+		return
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print(__doc__)
+		sys.exit(1)
+	outdir = sys.argv[1]
+	r = reassembler()
+	for path in sorted(sys.argv[2:]):
+		f = open(path, 'rb')
+		data = f.read()
+		f.close()
+		try:
+			done = r.add(os.path.basename(path), data)
+		except ValueError as e:
+			print(e)
+			continue
+		if done != None:
+			fle, data = done
+			if fle.endswith('.bz2'):
+				fle = fle[:-4]
+			f = open(os.path.join(outdir, fle), 'wb')
+			f.write(data)
+			f.close()
+			print('%s: %d bytes' % (fle, len(data)))
+	for fle, (n, last) in sorted(r.pending().items()):
+		print('%s: incomplete, %d parts' % (fle, n))
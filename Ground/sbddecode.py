@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+sbddecode.py
+
+Ground station bulk decoder of the SBD messages of the buoys. Reads
+directories of .sbd payloads (Iridium attachments, IMEI_MOMSN.sbd) and
+decodes them in batches into NumPy structured arrays, converting all the
+numbers of a batch in one pass, then appends them per buoy as columns.
+
+Payloads sent by the CR1000 (CR1K/SATICEMK32_SBD.CR1):
+	full: the 23 fields of makeCSVstring, space separated, then
+		",<GPSmsg>"
+	housekeeping (LVD mode): "Temp,Volts,BB1,BB2,<GPSmsg>"
+GPSmsg is "lat lon time" as the DMU sent it. Malformed or truncated
+payloads are kept with kind 0 and NaN fields, so nothing is lost silently.
+Payloads sent by the DMU in several SBD messages (Comms/sbdseg.py) are
+joined (reassemble.py) and written as they are.
+
+ Output, one folder per buoy (IMEI):
+           * <column>.col: values of the column, appended batch by batch
+           * columns.json: NumPy dtype of every column
+           * payload_<id>_<time>.bin: segmented payloads, complete
+           * segments/: segments of the incomplete payloads and marks of
+             the complete ones, so the next runs can finish them
+
+Usage:
+	sbddecode.py <output dir> <dir or .sbd file> [...]
+	sbddecode.py bench [messages] (throughput on synthetic payloads)
+	sbddecode.py test (batch decoding against message by message)
+"""
+
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import reassemble
+
+# Same order as makeCSVstring (Sensors/cr1000.py).
+fields = ['APSWdmin', 'APSWdavg', 'APSWdmax', 'APSWsmin', 'APSWsavg',
+	'APSWsmax', 'APSairtemp', 'APSrelhumidity', 'APSairpressure', 'SDSRaw',
+	'SDSTempCorrected', 'SDSQuality', 'SDSFailCounter', 'SLSLevel', 'SLSTemp',
+	'CR1000_Temp', 'CR1000_Volts', 'PWS_BB1', 'PWS_BB2', 'PWS_BB3', 'PWS_BB4',
+	'CTtemp', 'CTconductivity']
+# Fields of the housekeeping message.
+hk_fields = ['CR1000_Temp', 'CR1000_Volts', 'PWS_BB1', 'PWS_BB2']
+
+kind_bad = 0
+kind_full = 1
+kind_hk = 2
+
+dtype = np.dtype([('buoy', 'S16'), ('momsn', '<i4'), ('received', '<f8'),
+	('kind', 'i1')] + [(f, '<f4') for f in fields] +
+	[('lat', '<f4'), ('lon', '<f4'), ('gpstime', 'S8')])
+
+# Messages per batch.
+batch = 50000
+# Seconds the segments of an incomplete payload wait for the rest (and a
+# complete payload ignores repeats, ids wrap).
+seg_age = 30 * 86400
+
+
+def sbd_files(paths):
+	"""Generator of the .sbd files of a list of files and directories."""
+	for p in paths:
+		if os.path.isdir(p):
+			for root, dirs, files in os.walk(p):
+				dirs.sort()
+				for f in sorted(files):
+					if f.endswith('.sbd'):
+						yield os.path.join(root, f)
+		else:
+			yield p
+
+
+def read_messages(paths, segment=None):
+	"""Generator of (imei, momsn, received, payload) for every file,
+	received is the file time. SBD segments go to segment(imei, received,
+	bytes) instead, when given."""
+	for path in sbd_files(paths):
+		name = os.path.basename(path)[:-4]
+		imei, sep, momsn = name.partition('_')
+		try:
+			momsn = int(momsn)
+		except ValueError:
+			momsn = -1
+		f = open(path, 'rb')
+		payload = f.read()
+		f.close()
+		if segment != None and reassemble.segments.is_segment(payload):
+			segment(imei, os.path.getmtime(path), payload)
+			continue
+		yield imei, momsn, os.path.getmtime(path), payload.decode('ascii', 'replace')
+
+
+def _numbers(tokens, n):
+	"""Floats of a list of numeric strings in one pass, None if any of
+	them is not a number."""
+	if not tokens:
+		return np.zeros(0)
+	try:
+		v = np.fromstring(' '.join(tokens), dtype=np.float64, sep=' ')
+	except ValueError:
+		# Newer NumPy raises instead of stopping at the bad token.
+		return None
+	if len(v) != n:
+		return None
+	return v
+
+
+def _split(payload):
+	"""Kind, numeric tokens and GPS tokens (lat, lon, time) of a payload."""
+	payload = payload.strip().rstrip('\0')
+	parts = payload.split(',')
+	if len(parts) == 2:
+		data = parts[0].split()
+		if len(data) == len(fields):
+			return kind_full, data, parts[1].split()
+	elif len(parts) == 5:
+		data = [p.strip() for p in parts[:4]]
+		if '' not in data and ' ' not in ''.join(data):
+			return kind_hk, data, parts[4].split()
+	return kind_bad, [], []
+
+
+def decode(messages):
+	"""
+	Decodes a batch of messages.
+	Input:
+		messages: list of (imei, momsn, received, payload)
+	Output:
+		Structured array (dtype), one row per message.
+	"""
+	n = len(messages)
+	out = np.zeros(n, dtype)
+	for f in fields + ['lat', 'lon']:
+		out[f] = np.nan
+	if n == 0:
+		return out
+	out['buoy'] = [m[0] for m in messages]
+	out['momsn'] = [m[1] for m in messages]
+	out['received'] = [m[2] for m in messages]
+	kinds = np.zeros(n, 'i1')
+	tokens = {kind_full: [], kind_hk: []}
+	rows = {kind_full: [], kind_hk: []}
+	gps = []
+	gpsrows = []
+	gpstime = []
+	for i in range(n):
+		kind, data, pos = _split(messages[i][3])
+		kinds[i] = kind
+		if kind == kind_bad:
+			continue
+		tokens[kind].extend(data)
+		rows[kind].append(i)
+		if len(pos) >= 2:
+			gps.extend(pos[:2])
+			gpsrows.append(i)
+			gpstime.append(pos[2] if len(pos) > 2 else '')
+	for kind, names in ((kind_full, fields), (kind_hk, hk_fields)):
+		r = np.array(rows[kind], dtype=np.intp)
+		v = _numbers(tokens[kind], len(r) * len(names))
+		if v is None:
+			# A bad token somewhere, find it message by message.
+			v, ok = _one_by_one(tokens[kind], len(names))
+			kinds[r[~ok]] = kind_bad
+		v = v.reshape(-1, len(names))
+		for j, name in enumerate(names):
+			out[name][r] = v[:, j]
+	r = np.array(gpsrows, dtype=np.intp)
+	v = _numbers(gps, 2 * len(r))
+	if v is None:
+		v, ok = _one_by_one(gps, 2)
+	v = v.reshape(-1, 2)
+	out['lat'][r] = v[:, 0]
+	out['lon'][r] = v[:, 1]
+	out['gpstime'][r] = gpstime
+	bad = kinds == kind_bad
+	for f in fields + ['lat', 'lon']:
+		out[f][bad] = np.nan
+	out['kind'] = kinds
+	return out
+
+
+def _one_by_one(tokens, width):
+	"""Slow path of _numbers, per message of width tokens. Returns the
+	values (NaN for bad messages) and which messages were good."""
+	m = len(tokens) // width
+	v = np.full(m * width, np.nan)
+	ok = np.zeros(m, bool)
+	for i in range(m):
+		x = _numbers(tokens[i * width:(i + 1) * width], width)
+		if x is not None:
+			v[i * width:(i + 1) * width] = x
+			ok[i] = True
+	return v, ok
+
+
+def write(out, outdir):
+	"""Appends a decoded batch to the per buoy columns."""
+	for buoy in np.unique(out['buoy']):
+		sel = out[out['buoy'] == buoy]
+		d = os.path.join(outdir, buoy.decode('ascii', 'replace'))
+		if not os.path.exists(d):
+			os.makedirs(d)
+		meta = os.path.join(d, 'columns.json')
+		if not os.path.exists(meta):
+			f = open(meta, 'w')
+			json.dump(dict([(name, dtype[name].str) for name in dtype.names if name != 'buoy']), f)
+			f.close()
+		for name in dtype.names:
+			if name == 'buoy':
+				continue
+			f = open(os.path.join(d, name + '.col'), 'ab')
+			f.write(np.ascontiguousarray(sel[name]).tobytes())
+			f.close()
+	return
+
+
+def load(buoydir):
+	"""Columns of a buoy folder, dictionary name -> array."""
+	f = open(os.path.join(buoydir, 'columns.json'), 'r')
+	meta = json.load(f)
+	f.close()
+	return dict([(name, np.fromfile(os.path.join(buoydir, name + '.col'), dtype=str(t)))
+		for name, t in meta.items()])
+
+
+def run(outdir, paths, batchsize=batch):
+	"""Decodes every message of paths into outdir. Returns counts per
+	kind, seconds and the segment reassembler (its counts and pending
+	payloads). The segments of the incomplete payloads are kept in outdir
+	for the next runs, until they are older than seg_age."""
+	t0 = time.time()
+	counts = [0, 0, 0]
+	messages = []
+	seg = reassemble.segments(outdir)
+
+	def segment(imei, received, data):
+		try:
+			done = seg.add(imei, data, received)
+		except ValueError as e:
+			print(e)
+			return
+		if done != None:
+			d = os.path.join(outdir, imei)
+			if not os.path.exists(d):
+				os.makedirs(d)
+			f = open(os.path.join(d, 'payload_%05d_%d.bin' % (done[1], received)), 'wb')
+			f.write(done[2])
+			f.close()
+
+	for m in read_messages(paths, segment):
+		messages.append(m)
+		if len(messages) == batchsize:
+			counts = _flush(messages, outdir, counts)
+			messages = []
+	if messages:
+		counts = _flush(messages, outdir, counts)
+	seg.expire(seg_age)
+	return counts, time.time() - t0, seg
+
+
+def _flush(messages, outdir, counts):
+	out = decode(messages)
+	write(out, outdir)
+	c = np.bincount(out['kind'], minlength=3)
+	return [counts[i] + int(c[i]) for i in range(3)]
+
+
+def synthetic(n, buoys=20):
+	"""Synthetic messages: full, housekeeping and some broken ones."""
+	rng = np.random.RandomState(0)
+	vals = rng.uniform(0, 100, (n, len(fields)))
+	ret = []
+	for i in range(n):
+		gps = '%.5f %.5f %06d' % (rng.uniform(-80, -60), rng.uniform(-180, 180), i % 240000)
+		if i % 50 == 49:
+			payload = '%.2f,%.2f,%.2f,%.2f,%s' % (tuple(vals[i, :4]) + (gps,))
+		elif i % 97 == 96:
+			payload = ' '.join(['%.2f' % x for x in vals[i, :10]])
+		elif i % 101 == 100:
+			# A corrupted character in a field.
+			payload = ''.join(['%.2f ' % x for x in vals[i]]).replace('.', 'x', 1) + ',' + gps
+		else:
+			if i % 103 == 102:
+				# The GPS position is parsed on its own.
+				gps = gps.replace('0', 'O', 1)
+			payload = ''.join(['%.2f ' % x for x in vals[i]]) + ',' + gps
+		ret.append(('3002340107%05d' % (i % buoys), i // buoys, 1.45e9 + 3600 * (i // buoys), payload))
+	return ret
+
+
+def test(n=2000):
+	"""Checks that a batch decodes as every message on its own, bad
+	tokens included."""
+	messages = synthetic(n)
+	out = decode(messages)
+	for i in range(n):
+		one = decode(messages[i:i + 1])
+		for name in dtype.names:
+			a, b = out[name][i], one[name][0]
+			assert a == b or (a != a and b != b), '%d %s: %r != %r' % (i, name, a, b)
+	c = np.bincount(out['kind'], minlength=3)
+	assert c[kind_bad] > 0 and np.isnan(out['lat'][out['kind'] == kind_full]).any()
+	return [int(x) for x in c]
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'test':
+		c = test()
+		print('%d messages: %d full, %d housekeeping, %d malformed, as one by one' % (
+			sum(c), c[kind_full], c[kind_hk], c[kind_bad]))
+		sys.exit(0)
+	if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+		n = 200000
+		if len(sys.argv) > 2:
+			n = int(sys.argv[2])
+		messages = synthetic(n)
+		t0 = time.time()
+		counts = [0, 0, 0]
+		for s in range(0, n, batch):
+			c = np.bincount(decode(messages[s:s + batch])['kind'], minlength=3)
+			counts = [counts[i] + int(c[i]) for i in range(3)]
+		dt = time.time() - t0
+	elif len(sys.argv) > 2:
+		counts, dt, seg = run(sys.argv[1], sys.argv[2:])
+		print('%d segmented payloads, %d incomplete, %d repeated segments, %d bad' % (
+			seg.completed, len(seg.pending()), seg.duplicates, seg.bad))
+	else:
+		print(__doc__)
+		sys.exit(1)
+	total = sum(counts)
+	print('%d messages: %d full, %d housekeeping, %d malformed' % (total, counts[kind_full],
+		counts[kind_hk], counts[kind_bad]))
+	print('%.2f s, %.0f messages/s' % (dt, total / max(dt, 1e-9)))
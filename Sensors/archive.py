@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+archive.py
+
+On board time series archive. Every series is a folder with one append
+only file per column, fixed width little endian values: time.col holds
+the epoch seconds (double) and is the index, the rest one float each.
+Appending is a plain write per column, no NumPy; queries memory map the
+columns with NumPy and binary search the time index, so a range is a
+view of the files and the RAM used doesn't depend on the archive size.
+Downsampling goes through the range in chunks for the same reason.
+
+Times must grow. After a power loss the columns may differ in length,
+the shortest one sets the number of records and the rest are cut back
+to it the next time the series is opened for writing.
+
+Series:
+		cr1000: FBS and housekeeping fields of the CR1000 (cr1000.py)
+		sensors: DMU sensors (sensord.py)
+
+Usage:
+		archive.py info <series>
+		archive.py range <series> <from> <to> [columns...] (CSV)
+		archive.py since <series> <from> [columns...] (CSV, for backfill)
+		archive.py stats <series> <from> <to> <step> <column>
+			(min,max,mean per step seconds)
+"""
+
+import os
+import struct
+import sys
+import time
+
+import cr1000
+
+archivedir = '/home/satice/archive/'
+# Rows per chunk when downsampling.
+chunksize = 65536
+
+series = {'cr1000': cr1000.names,
+	'sensors': ['humidity', 'temperature',
+		'modem_bus', 'modem_current', 'mpu1_bus', 'mpu1_current',
+		'mpu2_bus', 'mpu2_current', 'fox_bus', 'fox_current']}
+
+timecol = 'time'
+
+
+class timeseries():
+	"""One series of the archive."""
+	def __init__(self, name, columns=None, path=archivedir):
+		if columns == None:
+			columns = series[name]
+		self.name = name
+		self.columns = list(columns)
+		self.path = os.path.join(path, name)
+		return
+
+	def _file(self, column):
+		return os.path.join(self.path, column + '.col')
+
+	def _width(self, column):
+		if column == timecol:
+			return 8
+		return 4
+
+	def __len__(self):
+		"""Number of complete records."""
+		n = None
+		for c in [timecol] + self.columns:
+			try:
+				rows = os.path.getsize(self._file(c)) // self._width(c)
+			except OSError:
+				return 0
+			if n == None or rows < n:
+				n = rows
+		return n
+
+	def _repair(self):
+		"""Cuts every column to the number of complete records."""
+		if not os.path.exists(self.path):
+			os.makedirs(self.path)
+		n = len(self)
+		for c in [timecol] + self.columns:
+			size = n * self._width(c)
+			if not os.path.exists(self._file(c)):
+				open(self._file(c), 'ab').close()
+			elif os.path.getsize(self._file(c)) != size:
+				f = open(self._file(c), 'r+b')
+				f.truncate(size)
+				f.close()
+		return n
+
+	def last_time(self):
+		"""Time of the last record, None if the series is empty."""
+		n = len(self)
+		if n == 0:
+			return None
+		f = open(self._file(timecol), 'rb')
+		f.seek((n - 1) * 8)
+		t, = struct.unpack('<d', f.read(8))
+		f.close()
+		return t
+
+	def append(self, rows):
+		"""
+		Appends records.
+		Input:
+			rows: list of (time, {column: value}), missing columns are
+				stored as NaN. Times must be later than the last record.
+		Output:
+			Records appended, older ones are skipped.
+		"""
+		self._repair()
+		last = self.last_time()
+		times = []
+		values = dict([(c, []) for c in self.columns])
+		nan = float('nan')
+		for t, data in rows:
+			if last != None and t <= last:
+				continue
+			last = t
+			times.append(t)
+			for c in self.columns:
+				v = data.get(c)
+				if v == None:
+					v = nan
+				values[c].append(v)
+		if not times:
+			return 0
+		# Time last, a record only counts once every column has it.
+		for c in self.columns:
+			f = open(self._file(c), 'ab')
+			f.write(struct.pack('<%df' % len(times), *values[c]))
+			f.close()
+		f = open(self._file(timecol), 'ab')
+		f.write(struct.pack('<%dd' % len(times), *times))
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+		return len(times)
+
+	def _map(self, column, n):
+		"""Memory map of the first n values of a column."""
+		import numpy as np
+		if column == timecol:
+			dtype = '<f8'
+		else:
+			dtype = '<f4'
+		if n == 0:
+			return np.zeros(0, dtype)
+		return np.memmap(self._file(column), dtype=dtype, mode='r', shape=(n,))
+
+	def _bounds(self, t0, t1, side='left'):
+		"""Index range of the records with t0 <= time < t1 (t0 < time
+		with side 'right')."""
+		n = len(self)
+		t = self._map(timecol, n)
+		i0 = int(t.searchsorted(t0, side))
+		if t1 == None:
+			i1 = n
+		else:
+			i1 = int(t.searchsorted(t1, 'left'))
+		return t, i0, i1
+
+	def range(self, t0, t1=None, columns=None):
+		"""
+		Records with t0 <= time < t1 (to the end if t1 is None).
+		Output:
+			Dictionary column -> array, views of the files (no copy),
+			'time' included.
+		"""
+		return self._slice(self._bounds(t0, t1), columns)
+
+	def since(self, t0, columns=None):
+		"""Records after t0 (not included), for backfill uploads."""
+		return self._slice(self._bounds(t0, None, 'right'), columns)
+
+	def _slice(self, bounds, columns):
+		t, i0, i1 = bounds
+		if columns == None:
+			columns = self.columns
+		ret = {timecol: t[i0:i1]}
+		for c in columns:
+			ret[c] = self._map(c, len(t))[i0:i1]
+		return ret
+
+	def downsample(self, t0, t1, step, column):
+		"""
+		Min, max and mean of a column per step seconds, NaN ignored.
+		Output:
+			Arrays: bucket start time, min, max, mean, count.
+		"""
+		import numpy as np
+		t, i0, i1 = self._bounds(t0, t1)
+		v = self._map(column, len(t))
+		nb = int(np.ceil((t1 - t0) / float(step)))
+		mn = np.full(nb, np.inf)
+		mx = np.full(nb, -np.inf)
+		sm = np.zeros(nb)
+		cnt = np.zeros(nb, dtype=np.int64)
+		for s in range(i0, i1, chunksize):
+			e = min(i1, s + chunksize)
+			vals = np.asarray(v[s:e], dtype=np.float64)
+			b = ((np.asarray(t[s:e]) - t0) // step).astype(np.int64)
+			ok = ~np.isnan(vals)
+			vals = vals[ok]
+			b = b[ok]
+			np.minimum.at(mn, b, vals)
+			np.maximum.at(mx, b, vals)
+			np.add.at(sm, b, vals)
+			np.add.at(cnt, b, 1)
+		empty = cnt == 0
+		mn[empty] = np.nan
+		mx[empty] = np.nan
+		mean = np.where(empty, np.nan, sm / np.maximum(cnt, 1))
+		return t0 + step * np.arange(nb), mn, mx, mean, cnt
+
+
+def _csv(data, columns, out=sys.stdout):
+	"""Writes range() output as CSV."""
+	import numpy as np
+	out.write(','.join([timecol] + columns) + '\n')
+	n = len(data[timecol])
+	for s in range(0, n, chunksize):
+		block = np.column_stack([data[timecol][s:s + chunksize]] +
+			[data[c][s:s + chunksize] for c in columns])
+		np.savetxt(out, block, fmt=['%.3f'] + ['%g'] * len(columns), delimiter=',')
+	return
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print __doc__
+		sys.exit(1)
+	cmd = sys.argv[1]
+	ts = timeseries(sys.argv[2])
+	if cmd == 'info':
+		n = len(ts)
+		print '%s: %d records, %d columns' % (ts.name, n, len(ts.columns))
+		if n:
+			t = ts.range(0)[timecol]
+			print 'From %s to %s UTC' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t[0])),
+				time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t[-1])))
+	elif cmd == 'range':
+		columns = sys.argv[5:] or ts.columns
+		_csv(ts.range(float(sys.argv[3]), float(sys.argv[4]), columns), columns)
+	elif cmd == 'since':
+		columns = sys.argv[4:] or ts.columns
+		_csv(ts.since(float(sys.argv[3]), columns), columns)
+	elif cmd == 'stats':
+		b, mn, mx, mean, cnt = ts.downsample(float(sys.argv[3]), float(sys.argv[4]),
+			float(sys.argv[5]), sys.argv[6])
+		print 'time,min,max,mean,count'
+		for i in range(len(b)):
+			print '%.0f,%g,%g,%g,%d' % (b[i], mn[i], mx[i], mean[i], cnt[i])
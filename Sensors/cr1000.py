@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+cr1000.py
+
+DMU side of the CR1000 link (CR1K/SATICEMK32_SBD.CR1, Com4 9600 8N1).
+The DMU asks for data with "DATA_PLEASE!", the logger measures the
+sensors and answers with the 23 space separated fields of
+makeCSVstring. The DMU also sends " GPS:..." lines, the logger keeps the
+last position for its SBD messages (GPSmsg).
+
+Replies are parsed into records named after the FBSData and
+HouseKeepingData fields and appended to a fixed size binary history
+(and, from the command line, to the archive, see archive.py).
+
+ History file (little endian), one record per poll:
+           * epoch seconds (double), then the 23 fields (float)
+
+Usage:
+		cr1000.py poll [count] [interval] (polls and prints, keeps history)
+		cr1000.py gps <lat> <lon> <satellites> (sends the position)
+		cr1000.py history [records] (prints the last records)
+"""
+
+import collections
+import os
+import struct
+import sys
+import time
+
+# DMU serial port wired to Com4 of the CR1000.
+port = '/dev/ttyS3'
+baudrate = 9600
+# The logger powers and reads every sensor before answering.
+timeout = 60.0
+historyfile = '/home/satice/log/cr1000.bin'
+
+request = 'DATA_PLEASE!'
+
+# makeCSVstring order: field, table, format (FormatFloat), type.
+fields = [('APSWdmin', 'FBSData', '%03.1f', float),
+	('APSWdavg', 'FBSData', '%03.1f', float),
+	('APSWdmax', 'FBSData', '%03.1f', float),
+	('APSWsmin', 'FBSData', '%03.1f', float),
+	('APSWsavg', 'FBSData', '%03.1f', float),
+	('APSWsmax', 'FBSData', '%03.1f', float),
+	('APSairtemp', 'FBSData', '%03.1f', float),
+	('APSrelhumidity', 'FBSData', '%03.1f', float),
+	('APSairpressure', 'FBSData', '%04.1f', float),
+	('SDSRaw', 'FBSData', '%02.2f', float),
+	('SDSTempCorrected', 'FBSData', '%02.2f', float),
+	('SDSQuality', 'FBSData', '%03.0f', int),
+	('SDSFailCounter', 'FBSData', '%02.0f', int),
+	('SLSLevel', 'FBSData', '%02.3f', float),
+	('SLSTemp', 'FBSData', '%02.2f', float),
+	('CR1000_Temp', 'HouseKeepingData', '%02.2f', float),
+	('CR1000_Volts', 'HouseKeepingData', '%02.2f', float),
+	('PWS_BB1', 'HouseKeepingData', '%02.2f', float),
+	('PWS_BB2', 'HouseKeepingData', '%02.2f', float),
+	('PWS_BB3', 'HouseKeepingData', '%02.2f', float),
+	('PWS_BB4', 'HouseKeepingData', '%02.2f', float),
+	('CTtemp', 'FBSData', '%02.2f', float),
+	('CTconductivity', 'FBSData', '%02.3f', float)]
+names = [f[0] for f in fields]
+
+record = collections.namedtuple('record', ['time'] + names)
+
+record_fmt = '<d' + 'f' * len(fields)
+record_size = struct.calcsize(record_fmt)
+
+
+def parse(reply, when=None):
+	"""
+	Parses a reply of the logger.
+	Input:
+		reply: makeCSVstring output, 23 space separated values
+		when: epoch seconds of the poll, now if not given
+	Output:
+		record. Raises ValueError if the reply is not complete.
+	"""
+	values = reply.split()
+	if len(values) != len(fields):
+		raise ValueError('Expected %d fields, got %d' % (len(fields), len(values)))
+	if when == None:
+		when = time.time()
+	# NAN comes as "NAN", float() takes it.
+	return record(when, *[_typed(f[3], v) for f, v in zip(fields, values)])
+
+
+def _typed(kind, value):
+	"""Value of a field, NAN counters stay float."""
+	value = float(value)
+	if kind == int and value == value:
+		return int(value)
+	return value
+
+
+def make_reply(rec):
+	"""Reply string of a record, as makeCSVstring builds it."""
+	return ''.join([f[2] % getattr(rec, f[0]) + ' ' for f in fields])
+
+
+def gps_line(lat, lon, satellites, when=None):
+	"""GPS line for the logger, it keeps items 1, 2 and 4 for GPSmsg
+	(lat, lon and UTC time)."""
+	if when == None:
+		when = time.time()
+	return ' GPS:%.5f %.5f %d %s !' % (lat, lon, satellites,
+		time.strftime('%H%M%S', time.gmtime(when)))
+
+
+class client():
+	"""Polls the CR1000 over the serial line."""
+	def __init__(self, port=port, baudrate=baudrate, timeout=timeout):
+		import hal
+		self.timeout = timeout
+		self.ser = hal.serial_port(port=port, baudrate=baudrate, timeout=0.2)
+		# Seconds of the last poll, request to full reply.
+		self.latency = None
+		return
+
+	def close(self):
+		self.ser.close()
+		return
+
+	def _reply(self):
+		"""Reads a full reply, None on timeout. There is no terminator,
+		the reply is complete after the space that follows field 23."""
+		deadline = time.time() + self.timeout
+		buf = ''
+		while time.time() < deadline:
+			chunk = self.ser.read(self.ser.inWaiting() or 1)
+			buf += chunk
+			if buf.endswith(' ') and len(buf.split()) >= len(fields):
+				return buf
+		return None
+
+	def poll(self):
+		"""Asks for data, returns a record, None if there is no answer."""
+		self.ser.flushInput()
+		t0 = time.time()
+		self.ser.write(request)
+		reply = self._reply()
+		if reply == None:
+			return None
+		self.latency = time.time() - t0
+		return parse(reply, t0)
+
+	def send_gps(self, lat, lon, satellites, when=None):
+		"""Gives the logger the last position, for its SBD messages."""
+		self.ser.write(gps_line(lat, lon, satellites, when))
+		return
+
+
+def save(rec, path=historyfile):
+	"""Appends a record to the history."""
+	d = os.path.dirname(path)
+	if d and not os.path.exists(d):
+		os.makedirs(d)
+	f = open(path, 'ab')
+	f.write(struct.pack(record_fmt, *rec))
+	f.close()
+	return
+
+
+def history(n=None, path=historyfile):
+	"""Last n records of the history (all if n is None), oldest first.
+	Integer fields come back as float."""
+	try:
+		f = open(path, 'rb')
+	except IOError:
+		return []
+	try:
+		f.seek(0, 2)
+		total = f.tell() // record_size
+		if n == None or n > total:
+			n = total
+		f.seek((total - n) * record_size)
+		data = f.read(n * record_size)
+	finally:
+		f.close()
+	return [record(*struct.unpack_from(record_fmt, data, i * record_size))
+		for i in range(n)]
+
+
+def _show(rec):
+	print time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(rec.time)),
+	print ' '.join(['%s=%s' % (k, getattr(rec, k)) for k in names])
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print __doc__
+		sys.exit(1)
+	if sys.argv[1] == 'poll':
+		count = 1
+		interval = 0
+		if len(sys.argv) > 2:
+			count = int(sys.argv[2])
+		if len(sys.argv) > 3:
+			interval = float(sys.argv[3])
+		import archive
+		ts = archive.timeseries('cr1000')
+		c = client()
+		for i in range(count):
+			rec = c.poll()
+			if rec == None:
+				print 'No answer from the CR1000'
+			else:
+				save(rec)
+				ts.append([(rec.time, rec._asdict())])
+				_show(rec)
+				print 'Latency %.3f s' % c.latency
+			time.sleep(interval)
+		c.close()
+	elif sys.argv[1] == 'gps':
+		c = client()
+		c.send_gps(float(sys.argv[2]), float(sys.argv[3]), int(sys.argv[4]))
+		c.close()
+	elif sys.argv[1] == 'history':
+		n = None
+		if len(sys.argv) > 2:
+			n = int(sys.argv[2])
+		for rec in history(n):
+			_show(rec)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+cr1000sim.py
+
+CR1000 simulator on a pseudo terminal, for cr1000.py without hardware.
+Answers "DATA_PLEASE!" like the logger program (CR1K/SATICEMK32_SBD.CR1)
+after a measuring delay, playing back a history file (cr1000.py) or
+synthetic records, and keeps the last " GPS:" line as GPSmsg.
+
+Usage:
+		cr1000sim.py [history file] (runs, prints the port to poll)
+		cr1000sim.py bench [polls] [records] (polling latency and parse
+		                                      throughput)
+"""
+
+import math
+import os
+import pty
+import random
+import select
+import sys
+import threading
+import time
+import tty
+
+import cr1000
+
+# Seconds the logger takes to power and read the sensors. The real one
+# takes several seconds, 0 measures the link and the client alone.
+delay = 0.0
+# Replies are paced to the line speed (10 bits per byte), a pty is not.
+pace = True
+
+
+def synthetic(n=None, start=None, step=600):
+	"""Generator of plausible records, step seconds apart (forever if n
+	is None)."""
+	if start == None:
+		start = time.time()
+	i = 0
+	while n == None or i < n:
+		t = start + i * step
+		day = math.sin(2 * math.pi * (t % 86400) / 86400)
+		wd = random.uniform(0, 360)
+		ws = abs(random.gauss(6, 3))
+		volts = 12.4 + 0.3 * day + random.gauss(0, 0.02)
+		yield cr1000.record(t, (wd - 20) % 360, wd, (wd + 20) % 360, ws * 0.5, ws, ws * 1.6,
+			-15 + 5 * day, random.uniform(70, 95), random.gauss(1005, 8),
+			random.uniform(0.1, 0.5), random.uniform(0.1, 0.5),
+			random.randint(150, 250), 0,
+			random.gauss(1.2, 0.01), -2 + day,
+			-10 + 5 * day, volts, volts, volts - 0.1, float('nan'), float('nan'),
+			-1.8 + random.gauss(0, 0.01), random.gauss(28, 0.1))
+		i += 1
+
+
+class simulator():
+	"""Pseudo terminal playing the CR1000 side of Com4."""
+	def __init__(self, records=None, delay=delay, pace=pace):
+		if records == None:
+			records = synthetic()
+		self.records = iter(records)
+		self.delay = delay
+		self.pace = pace
+		self.master, slave = pty.openpty()
+		tty.setraw(slave)
+		self.port = os.ttyname(slave)
+		self._slave = slave
+		self.gpsmsg = ''
+		self.served = 0
+		self.stop_flag = threading.Event()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.setDaemon(True)
+		return
+
+	def start(self):
+		self.thread.start()
+		return
+
+	def stop(self):
+		self.stop_flag.set()
+		self.thread.join()
+		os.close(self.master)
+		os.close(self._slave)
+		return
+
+	def _word(self, word):
+		"""Handles a "!" terminated word from the DMU."""
+		if word.endswith('DATA_PLEASE!'):
+			try:
+				rec = self.records.next()
+			except StopIteration:
+				# Playback over, the logger would stay quiet.
+				return
+			reply = cr1000.make_reply(rec)
+			wait = self.delay
+			if self.pace:
+				wait += len(reply) * 10.0 / cr1000.baudrate
+			if wait:
+				time.sleep(wait)
+			os.write(self.master, reply)
+			self.served += 1
+		else:
+			# Same split as the logger: ":" then items 1, 2 and 4.
+			parts = word.split(':', 1)
+			if len(parts) == 2 and parts[0].endswith(' GPS'):
+				items = parts[1].split()
+				if len(items) >= 4:
+					self.gpsmsg = ' '.join([items[0], items[1], items[3]])
+		return
+
+	def _run(self):
+		buf = ''
+		while not self.stop_flag.isSet():
+			r, w, x = select.select([self.master], [], [], 0.1)
+			if not r:
+				continue
+			try:
+				buf += os.read(self.master, 512)
+			except OSError:
+				return
+			while '!' in buf:
+				word, buf = buf.split('!', 1)
+				self._word(word + '!')
+		return
+
+
+def bench(polls=50, records=20000):
+	"""Polls the simulator and parses synthetic replies, prints the
+	latency percentiles and the parse rate."""
+	sim = simulator()
+	sim.start()
+	c = cr1000.client(sim.port, timeout=5.0)
+	lat = []
+	for i in range(polls):
+		if c.poll() != None:
+			lat.append(c.latency)
+	c.send_gps(41.38, 2.17, 9)
+	time.sleep(0.2)
+	c.close()
+	sim.stop()
+	lat.sort()
+	print 'Polls: %d answered out of %d' % (len(lat), polls)
+	if lat:
+		for p in (50, 90, 99):
+			print '  p%d latency: %.2f ms' % (p, 1000 * lat[min(len(lat) - 1, len(lat) * p // 100)])
+	print 'GPSmsg: %s' % sim.gpsmsg
+	replies = [cr1000.make_reply(r) for r in synthetic(records)]
+	t0 = time.time()
+	for r in replies:
+		cr1000.parse(r, 0)
+	dt = time.time() - t0
+	print 'Parse: %d replies in %.3f s, %.0f replies/s' % (records, dt, records / dt)
+	return
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+		args = [int(a) for a in sys.argv[2:4]]
+		bench(*args)
+		sys.exit()
+	records = None
+	if len(sys.argv) > 1:
+		records = cr1000.history(path=sys.argv[1])
+	sim = simulator(records)
+	sim.start()
+	print 'CR1000 simulator on %s, poll it with cr1000.client("%s")' % (sim.port, sim.port)
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		sim.stop()
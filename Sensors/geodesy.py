@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+geodesy.py
+
+ECEF (XYZ) to geodetic (latitude, longitude, altitude) conversion over
+NumPy arrays, Bowring's method plus optional iterative refinement, and
+chunked reading of position logs to rebuild a whole drift track.
+
+Usage: geodesy.py <position log> [output csv]
+"""
+
+import sys
+
+import numpy as np
+
+# WGS84 ellipsoid
+a = 6378137.0
+e = 8.1819190842622e-2
+b = a * np.sqrt(1 - e ** 2)
+ep2 = (a ** 2 - b ** 2) / b ** 2
+
+# Lines parsed per chunk when streaming a position log.
+chunksize = 65536
+
+
+def ecef_to_geodetic(xyz, iterations=0):
+	"""
+	Converts ECEF coordinates to geodetic.
+	Input:
+		xyz: N x 3 array of X, Y, Z (m). Rows with X == 0 (no fix) give NaN.
+		iterations: refinement iterations after Bowring, 0 is enough
+			for positions near the surface.
+	Output:
+		lat, lon (degrees) and alt (m), arrays of length N.
+	"""
+	xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+	x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+	p = np.hypot(x, y)
+	th = np.arctan2(a * z, b * p)
+	lon = np.arctan2(y, x)
+	lat = np.arctan2(z + ep2 * b * np.sin(th) ** 3, p - e ** 2 * a * np.cos(th) ** 3)
+	for i in range(iterations):
+		n = a / np.sqrt(1 - (e * np.sin(lat)) ** 2)
+		alt = _altitude(p, z, lat)
+		lat = np.arctan2(z, p * (1 - e ** 2 * n / (n + alt)))
+	alt = _altitude(p, z, lat)
+	nofix = x == 0
+	lat[nofix] = np.nan
+	lon[nofix] = np.nan
+	alt[nofix] = np.nan
+	return np.degrees(lat), np.degrees(lon), alt
+
+
+def _altitude(p, z, lat):
+	"""Height over the ellipsoid, stable at the poles too."""
+	s = np.sin(lat)
+	return p * np.cos(lat) + z * s - a * np.sqrt(1 - (e * s) ** 2)
+
+
+def _parse(lines):
+	"""X, Y, Z of a list of 'X,Y,Z[,...]' lines, N x 3. Malformed lines
+	are dropped or give NaN."""
+	try:
+		return np.loadtxt(lines, delimiter=',', usecols=(0, 1, 2), ndmin=2)
+	except (ValueError, IndexError):
+		return np.atleast_2d(np.genfromtxt(lines, delimiter=',',
+			usecols=(0, 1, 2), invalid_raise=False))
+
+
+def read_positions(path, chunksize=chunksize):
+	"""Yields N x 3 XYZ arrays from a position log, chunksize lines at a
+	time, so memory doesn't grow with the log."""
+	f = open(path, 'r')
+	try:
+		lines = []
+		for line in f:
+			if line.strip():
+				lines.append(line)
+			if len(lines) == chunksize:
+				yield _parse(lines)
+				lines = []
+		if lines:
+			yield _parse(lines)
+	finally:
+		f.close()
+
+
+def track(path, iterations=0, chunksize=chunksize):
+	"""Yields (lat, lon, alt) arrays for a position log, chunk by chunk."""
+	for xyz in read_positions(path, chunksize):
+		yield ecef_to_geodetic(xyz, iterations)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print __doc__
+		sys.exit(1)
+	if len(sys.argv) > 2:
+		out = open(sys.argv[2], 'w')
+	else:
+		out = sys.stdout
+	for lat, lon, alt in track(sys.argv[1]):
+		np.savetxt(out, np.column_stack((lat, lon, alt)), fmt='%.7f,%.7f,%.3f')
+	if out != sys.stdout:
+		out.close()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+hal.py
+
+Hardware abstraction of the DMU: digital outputs, I2C bus and serial
+ports. The board library (fox, ablib, RPi.GPIO, or a simulation for work
+off board) is chosen by configuration and only imported the first time
+a pin, bus or port is used, so scripts that don't touch the hardware,
+or only some of it, don't pay for the rest.
+
+Pins have names, the board maps them to its own numbering.
+
+ Input files:
+           * hal.conf : board, first line header (BOARD), second line
+                        fox, ablib, rpi or sim. SATICE_BOARD in the
+                        environment takes precedence. Default fox.
+
+Usage:
+	hal.pin('modem').on()
+	hal.py bench [repeats] (import and first pin cost of the scripts,
+		every library at import as before, and loaded on first use)
+"""
+
+import os
+import sys
+import time
+
+conffile = '/home/satice/conf/hal.conf'
+boards = ['fox', 'ablib', 'rpi', 'sim']
+# Pin name -> pin of each board (Acme kernel ids, BCM numbers on the Pi).
+pins = {'fox': {'modem': 'J7.35', 'camera': 'J7.4'},
+	'ablib': {'modem': 'J7.35', 'camera': 'J7.4'},
+	'rpi': {'modem': 17, 'camera': 27},
+	'sim': {'modem': 'modem', 'camera': 'camera'}}
+# Simulated hardware: pin levels, and I2C registers (addr, reg) -> word
+# read back. Unknown registers read ready_word, block reads ready_block
+# (conversion ready flags set on INA219 and HIH6130).
+sim_pins = {}
+sim_registers = {}
+ready_word = 0x0202
+ready_block = [0, 0, 0, 0]
+
+_board = None
+_lib = None
+
+
+def board():
+	"""Board in use (environment, then hal.conf, then fox)."""
+	global _board
+	if _board == None:
+		name = os.environ.get('SATICE_BOARD')
+		if name == None and os.path.exists(conffile):
+			f = open(conffile, 'r')
+			f.readline() #Header
+			name = f.readline().strip()
+			f.close()
+		if not name:
+			name = 'fox'
+		if name not in boards:
+			raise ValueError('Unknown board %s' % name)
+		_board = name
+	return _board
+
+
+def _backend():
+	"""Board library, imported on first use."""
+	global _lib
+	if _lib == None:
+		name = board()
+		if name == 'fox':
+			import fox
+			_lib = fox
+		elif name == 'ablib':
+			import ablib
+			_lib = ablib
+		elif name == 'rpi':
+			import RPi.GPIO as GPIO
+			GPIO.setwarnings(False)
+			GPIO.setmode(GPIO.BCM)
+			_lib = GPIO
+		else:
+			# The simulation is this module.
+			_lib = sys.modules[__name__]
+	return _lib
+
+
+class pin():
+	"""Digital output of the board, low when created."""
+	def __init__(self, name):
+		lib = _backend()
+		self.name = name
+		self.id = pins[board()][name]
+		if board() == 'fox':
+			self.p = lib.Pin(self.id, 'low')
+		elif board() == 'ablib':
+			self.p = lib.Pin(self.id, 'OUTPUT')
+			self.p.off()
+		elif board() == 'rpi':
+			lib.setup(self.id, lib.OUT, initial=lib.LOW)
+		else:
+			sim_pins[self.id] = False
+		return
+
+	def on(self):
+		if board() == 'rpi':
+			_lib.output(self.id, _lib.HIGH)
+		elif board() == 'sim':
+			sim_pins[self.id] = True
+		else:
+			self.p.on()
+		return
+
+	def off(self):
+		if board() == 'rpi':
+			_lib.output(self.id, _lib.LOW)
+		elif board() == 'sim':
+			sim_pins[self.id] = False
+		else:
+			self.p.off()
+		return
+
+
+class simbus():
+	"""I2C bus of the simulation, same calls as smbus.SMBus."""
+	def __init__(self, bus):
+		self.bus = bus
+		return
+
+	def write_byte(self, addr, val):
+		return
+
+	def read_i2c_block_data(self, addr, length):
+		return (ready_block * length)[:length]
+
+	def write_word_data(self, addr, reg, val):
+		sim_registers[(addr, reg)] = val
+		return
+
+	def read_word_data(self, addr, reg):
+		return sim_registers.get((addr, reg), ready_word)
+
+	def write_byte_data(self, addr, reg, val):
+		sim_registers[(addr, reg)] = val
+		return
+
+	def read_byte_data(self, addr, reg):
+		return sim_registers.get((addr, reg), ready_word) & 0xff
+
+
+def i2c(bus):
+	"""I2C bus (smbus.SMBus, simbus in the simulation)."""
+	if board() == 'sim':
+		return simbus(bus)
+	import smbus
+	return smbus.SMBus(bus)
+
+
+def serial_port(**kw):
+	"""Serial port, arguments of serial.Serial. pyserial is imported on
+	first use, the simulation uses it as well (pty of cr1000sim.py)."""
+	import serial
+	return serial.Serial(**kw)
+
+
+def _eager():
+	"""Old behaviour, every library at import (for the benchmark)."""
+	_backend()
+	if board() != 'sim':
+		import smbus
+	import serial
+	return
+
+
+if os.environ.get('SATICE_HAL_EAGER') == '1':
+	_eager()
+
+
+def bench(scripts=('sensors', 'ucam', 'sensord', 'cr1000', 'planner'), repeats=5):
+	"""
+	Startup cost of the scripts, in fresh interpreters.
+	Output:
+		List of (script, eager, lazy), each (import s, first pin s) best
+		of repeats, None if the script could not be imported.
+	"""
+	import subprocess
+	here = os.path.dirname(os.path.abspath(__file__))
+	code = ('import time\nt = time.time()\nimport %s\nt1 = time.time()\n'
+		'import hal\ntry:\n\thal.pin("modem")\nexcept Exception:\n\tpass\n'
+		'import sys\nsys.stdout.write("%%f %%f" %% (t1 - t, time.time() - t1))')
+	env = dict(os.environ)
+	# Comms modules, as satice.pth puts them on the path (README.md).
+	env['PYTHONPATH'] = os.pathsep.join([here, os.path.join(here, '..', 'Comms'),
+		env.get('PYTHONPATH', '')])
+	ret = []
+	for s in scripts:
+		best = []
+		for eager in ('1', '0'):
+			env['SATICE_HAL_EAGER'] = eager
+			t = None
+			for i in range(repeats):
+				p = subprocess.Popen([sys.executable, '-c', code % s], env=env,
+					stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=here)
+				out, err = p.communicate()
+				if p.returncode != 0:
+					t = None
+					break
+				dt = tuple([float(x) for x in out.split()])
+				if t == None or sum(dt) < sum(t):
+					t = dt
+			best.append(t)
+		ret.append((s, best[0], best[1]))
+	return ret
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+		repeats = 5
+		if len(sys.argv) > 2:
+			repeats = int(sys.argv[2])
+		print('Board %s, best of %d' % (board(), repeats))
+		print('%-10s %21s %21s' % ('', 'eager (before) ms', 'lazy (after) ms'))
+		print('%-10s %10s %10s %10s %10s' % ('script', 'import', 'first pin',
+			'import', 'first pin'))
+		for s, eager, lazy in bench(repeats=repeats):
+			cells = []
+			for t in (eager, lazy):
+				if t == None:
+					cells += ['%10s' % 'failed'] * 2
+				else:
+					cells += ['%10.1f' % (1000 * x) for x in t]
+			print('%-10s %s' % (s, ' '.join(cells)))
+	else:
+		print(__doc__)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+i2cstats.py
+
+Instrumentation of the I2C bus (sensors.i2c_iface). When enabled every
+bus transfer is timed and counted per device address and register:
+latency histogram (power of two buckets in microseconds), errors,
+retries (a transfer repeated after an error) and bus busy time; and the
+fixed sleeps of i2c_iface are counted apart per address, to tell real
+bus traffic from waiting.
+
+Disabled by default. It is enabled with SATICE_I2CSTATS=1 in the
+environment or enable() before the sensors are opened; disabled,
+i2c_iface talks to smbus directly and there is no cost at all.
+
+Usage:
+	i2cstats.py (table of the running sensord, sensord.py i2c)
+	i2cstats.py <dump.json> (table of a dump)
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+enabled = os.environ.get('SATICE_I2CSTATS') == '1'
+dumpfile = '/home/satice/log/i2cstats.json'
+# Histogram buckets: bucket i counts latencies < 2**i us, the last one
+# everything above (~0.5 s).
+buckets = 20
+
+_lock = threading.Lock()
+# (addr, reg) -> counters, reg None for plain bus transfers.
+_devices = {}
+# addr -> [sleeps, seconds]
+_sleeps = {}
+_failed = set()
+_since = time.time()
+
+
+class counters():
+	"""Statistics of one address and register."""
+	def __init__(self):
+		self.count = 0
+		self.errors = 0
+		self.retries = 0
+		self.busy = 0.0
+		self.worst = 0.0
+		self.hist = [0] * (buckets + 1)
+		return
+
+	def add(self, dt, error):
+		us = int(dt * 1e6)
+		i = 0
+		while us and i < buckets:
+			us >>= 1
+			i += 1
+		self.hist[i] += 1
+		self.count += 1
+		self.busy += dt
+		if dt > self.worst:
+			self.worst = dt
+		if error:
+			self.errors += 1
+		return
+
+	def percentile(self, p):
+		"""Upper bound (us) of the bucket holding the p percentile."""
+		n = 0
+		for i, c in enumerate(self.hist):
+			n += c
+			if n * 100 >= p * self.count:
+				return 2 ** i
+		return 2 ** buckets
+
+
+def enable():
+	"""Turns the instrumentation on for the interfaces opened from now,
+	and dumps it at exit."""
+	global enabled
+	enabled = True
+	atexit.register(dump)
+	return
+
+
+def reset():
+	"""Clears every counter."""
+	global _since
+	_lock.acquire()
+	try:
+		_devices.clear()
+		_sleeps.clear()
+		_failed.clear()
+		_since = time.time()
+	finally:
+		_lock.release()
+	return
+
+
+def record(addr, reg, dt, error):
+	"""Counts one transfer."""
+	key = (addr, reg)
+	_lock.acquire()
+	try:
+		c = _devices.get(key)
+		if c == None:
+			c = _devices[key] = counters()
+		if key in _failed:
+			c.retries += 1
+			_failed.discard(key)
+		if error:
+			_failed.add(key)
+		c.add(dt, error)
+	finally:
+		_lock.release()
+	return
+
+
+class bus():
+	"""Times the transfers of an smbus.SMBus for one device address."""
+	def __init__(self, smb, addr):
+		self.smb = smb
+		self.addr = addr
+		return
+
+	def _call(self, f, reg, *args):
+		t = time.time()
+		try:
+			ret = f(*args)
+		except IOError:
+			record(self.addr, reg, time.time() - t, True)
+			raise
+		record(self.addr, reg, time.time() - t, False)
+		return ret
+
+	def write_byte(self, addr, val):
+		return self._call(self.smb.write_byte, None, addr, val)
+
+	def read_i2c_block_data(self, addr, length):
+		return self._call(self.smb.read_i2c_block_data, None, addr, length)
+
+	def write_word_data(self, addr, reg, val):
+		return self._call(self.smb.write_word_data, reg, addr, reg, val)
+
+	def read_word_data(self, addr, reg):
+		return self._call(self.smb.read_word_data, reg, addr, reg)
+
+	def read_byte_data(self, addr, reg):
+		return self._call(self.smb.read_byte_data, reg, addr, reg)
+
+
+def sleeper(addr):
+	"""time.sleep that counts the fixed waits of an address."""
+	def sleep(s):
+		_lock.acquire()
+		try:
+			c = _sleeps.setdefault(addr, [0, 0.0])
+			c[0] += 1
+			c[1] += s
+		finally:
+			_lock.release()
+		time.sleep(s)
+	return sleep
+
+
+def snapshot():
+	"""
+	Current statistics.
+	Output:
+		Dictionary for JSON: seconds counted, bus busy fraction, and per
+		"0xAA/0xRR" (register '-' for bus transfers) count, errors,
+		retries, busy and worst seconds, p50/p99 bounds and histogram;
+		per address the sleeps and their seconds.
+	"""
+	_lock.acquire()
+	try:
+		wall = time.time() - _since
+		busy = sum([c.busy for c in _devices.values()])
+		devices = {}
+		for (addr, reg), c in _devices.items():
+			if reg == None:
+				name = '0x%02x/-' % addr
+			else:
+				name = '0x%02x/0x%02x' % (addr, reg)
+			devices[name] = {'count': c.count, 'errors': c.errors,
+				'retries': c.retries, 'busy': c.busy, 'worst': c.worst,
+				'p50_us': c.percentile(50), 'p99_us': c.percentile(99),
+				'hist': c.hist}
+		sleeps = dict([('0x%02x' % a, {'count': s[0], 'seconds': s[1]})
+			for a, s in _sleeps.items()])
+	finally:
+		_lock.release()
+	return {'seconds': wall, 'busy': busy, 'utilization': busy / max(wall, 1e-9),
+		'devices': devices, 'sleeps': sleeps}
+
+
+def dump(path=dumpfile):
+	"""Writes the snapshot as JSON."""
+	d = os.path.dirname(path)
+	if d and not os.path.exists(d):
+		os.makedirs(d)
+	f = open(path, 'w')
+	json.dump(snapshot(), f)
+	f.close()
+	return path
+
+
+def report(snap, out=sys.stdout):
+	"""Writes a snapshot as a table."""
+	out.write('%.0f s counted, bus busy %.3f s (%.2f%%)\n' % (snap['seconds'],
+		snap['busy'], 100 * snap['utilization']))
+	out.write('%-10s %8s %6s %7s %9s %9s %9s %9s\n' % ('addr/reg', 'count',
+		'errors', 'retries', 'busy s', 'p50 us', 'p99 us', 'worst us'))
+	for name, d in sorted(snap['devices'].items()):
+		out.write('%-10s %8d %6d %7d %9.3f %9d %9d %9d\n' % (name, d['count'],
+			d['errors'], d['retries'], d['busy'], d['p50_us'], d['p99_us'],
+			int(d['worst'] * 1e6)))
+	for addr, s in sorted(snap['sleeps'].items()):
+		out.write('%s slept %d times, %.3f s\n' % (addr, s['count'], s['seconds']))
+	return
+
+
+if enabled:
+	atexit.register(dump)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		f = open(sys.argv[1], 'r')
+		snap = json.load(f)
+		f.close()
+	else:
+		import sensord
+		snap = sensord.query('i2c')
+		if snap == None or 'error' in snap:
+			print('No statistics from sensord: %s' % snap)
+			sys.exit(1)
+	report(snap)
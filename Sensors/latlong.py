@@ -17,7 +17,10 @@ TBD: Extract from HOURLY RINEX FILE...
 #DEPENDENCES
 import time
 import datetime
-from math import atan2, cos, pi, sin, sqrt, tan, radians, degrees, acos
+import solar #Sunrise and sunset tables
+import geodesy #XYZ to lat long
+import photosched #Photo schedule along the drift
+import state #Shared buoy state
       
 
 #LOAD THE DATA FROM POSITION LOGFILE
@@ -40,39 +43,32 @@ print today
 
 #CONVERTING XYZ TO LAT LONG
 if float(X) != 0:
-     # Constants (WGS ellipsoid)
-     a = 6378137
-     e = 8.1819190842622e-2
-     # Calculation
-     b = sqrt(pow(a,2) * (1-pow(e,2)))
-     ep = sqrt((pow(a,2)-pow(b,2))/pow(b,2))
-     p = sqrt(pow(X,2)+pow(Y,2))
-     th = atan2(a*Z, b*p)
-     lon = atan2(Y, X)
-     lat = atan2((Z+ep*ep*b*pow(sin(th),3)), (p-e*e*a*pow(cos(th),3)))
-     n = a/sqrt(1-e*e*pow(sin(lat),2))
-     alt = p/cos(lat)-n
-     lat = (lat*180)/pi
-     lon = (lon*180)/pi
+     # Bowring's method, WGS ellipsoid (geodesy.py)
+     lats,lons,alts = geodesy.ecef_to_geodetic([X,Y,Z])
+     lat = float(lats[0])
+     lon = float(lons[0])
+     alt = float(alts[0])
      #lat=41.385
      #lon=2.195
      #alt=67.4689
      #print "LATITUDE %s | LONGITUDE %s | ALTITUDE %s" % (lat, lon, alt)
      print "COORDINATES: LATITUDE | LONGITUDE | ALTITUDE " 
      print "%s %s %s" % (lat, lon, alt)
-     j=-tan(radians(lat))*tan(radians(23.44*sin(radians((360*(int(today)+284))/365))))
-     #print j
-     if j>=1:
-       light=0
-     elif j<=-1:
-       light=12
-     else :    
-       light=(degrees(acos(j)))/15
-     timez=(lon/15) #timezone correction
-     rise=(12-light+timez)*3600
-     dusk=(12+light+timez)*3600
-     rise=(datetime.timedelta(seconds=rise))
-     dusk=(datetime.timedelta(seconds=dusk))
+     light=solar.lookup(lat, lon) #NOAA light windows, cached per position
+     photosched.build(time.time(), lat, lon) #Next days for ucam
+     tnow=time.time()
+     midnight=tnow-tnow%86400 #UTC
+     state.update(fix_time=tnow, lat=lat, lon=lon, alt=alt,
+                  sunrise=midnight+60*float(light['sunrise']),
+                  sunset=midnight+60*float(light['sunset']))
+     if light['polar']==1: #Midnight sun, the whole day is available
+       rise=0
+       dusk=23*60+59
+     else: #On polar night sunrise and sunset are both at noon
+       rise=light['sunrise']
+       dusk=light['sunset']
+     rise=(datetime.timedelta(minutes=float(rise)))
+     dusk=(datetime.timedelta(minutes=float(dusk)))
      print "UTC TIME SUNRISE (0.HHmm)"
      #print rise
      #Hours
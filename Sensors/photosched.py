@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+photosched.py
+
+Photo scheduling core for ucam.py. Works in UTC epoch seconds, no
+timezones. Sunrise and sunset are precomputed (solar.py) for the next
+days along the buoy drift, extrapolated from the last two position fixes,
+and stored as fixed size binary records. ucam reads the two records
+around now with a seek, so each cron run decides in constant time.
+
+ Schedule file (little endian):
+           * header: magic, fix time, fix lat, fix lon, first day, days
+           * one record per UTC day: sunrise, sunset (epoch seconds),
+             daylength (minutes), lat, lon, polar flag (see solar.py)
+
+Usage: photosched.py <lat> <lon> (rebuilds the schedule from a new fix)
+"""
+
+import os
+import struct
+import sys
+import time
+
+schedfile = '/home/satice/log/photosched.bin'
+# Days precomputed on each new fix.
+days = 10
+
+header_fmt = '<4sdddd i'
+header_size = struct.calcsize(header_fmt)
+record_fmt = '<ddfffb'
+record_size = struct.calcsize(record_fmt)
+magic = 'PSC1'
+
+# Dawn photo from 10 to 30 minutes after sunrise, dusk photo from 10
+# minutes before to 20 minutes after sunset (seconds).
+dawn_window = (600, 1800)
+dusk_window = (-600, 1200)
+# Dusk photo only on days with 2 to 20 hours of sunlight (minutes).
+dusk_daylength = (120, 1200)
+# Fixes further apart than this don't give a drift (seconds).
+max_drift_age = 10 * 86400
+
+
+def read_header(path=schedfile):
+	"""Returns fix time, fix lat, fix lon, first day and number of days,
+	None if there is no valid schedule."""
+	try:
+		f = open(path, 'rb')
+	except IOError:
+		return None
+	try:
+		h = f.read(header_size)
+	finally:
+		f.close()
+	if len(h) != header_size:
+		return None
+	h = struct.unpack(header_fmt, h)
+	if h[0] != magic:
+		return None
+	return h[1:]
+
+
+def build(fix_time, lat, lon, ndays=days, path=schedfile, start=None):
+	"""
+	Precomputes the schedule from a position fix.
+	Input:
+		fix_time: epoch seconds of the fix
+		lat, lon: position, degrees
+		ndays: UTC days computed, starting the day of the fix
+		start: epoch seconds in the first day instead (fix too old to
+			cover now), the position is not extrapolated that far
+	Output:
+		None, the schedule is written to path (write then rename).
+	"""
+	import numpy as np
+	import solar
+	vlat = 0.0
+	vlon = 0.0
+	prev = read_header(path)
+	if prev != None and 0 < fix_time - prev[0] <= max_drift_age:
+		dt = fix_time - prev[0]
+		vlat = (lat - prev[1]) / dt
+		# Shortest way around the antimeridian.
+		vlon = ((lon - prev[2] + 180) % 360 - 180) / dt
+	if start == None:
+		start = fix_time
+	first = int(start // 86400) * 86400
+	if first - fix_time > max_drift_age:
+		# Too old to extrapolate, keep the last known position.
+		vlat = 0.0
+		vlon = 0.0
+	starts = first + 86400.0 * np.arange(ndays)
+	# Position extrapolated to noon of each day.
+	dt = starts + 43200 - fix_time
+	lats = np.clip(lat + vlat * dt, -90, 90)
+	lons = (lon + vlon * dt + 180) % 360 - 180
+	w = solar.light_windows(solar.julian_day(1970, 1 + starts / 86400), lats, lons)
+	d = os.path.dirname(path)
+	if d and not os.path.exists(d):
+		os.makedirs(d)
+	tmp = path + '.tmp'
+	f = open(tmp, 'wb')
+	f.write(struct.pack(header_fmt, magic, fix_time, lat, lon, first, ndays))
+	for i in range(ndays):
+		f.write(struct.pack(record_fmt, starts[i] + 60 * float(w['sunrise'][i]),
+			starts[i] + 60 * float(w['sunset'][i]), w['daylength'][i],
+			lats[i], lons[i], w['polar'][i]))
+	f.close()
+	os.rename(tmp, path)
+	return
+
+
+def days_around(now, path=schedfile):
+	"""Records (sunrise, sunset, daylength, lat, lon, polar) of the UTC
+	day before now and of today. None if now is out of the schedule."""
+	try:
+		f = open(path, 'rb')
+	except IOError:
+		return None
+	try:
+		h = f.read(header_size)
+		if len(h) != header_size:
+			return None
+		h = struct.unpack(header_fmt, h)
+		if h[0] != magic:
+			return None
+		i = int((now - h[4]) // 86400)
+		if i < 0 or i >= h[5]:
+			return None
+		ret = []
+		for j in (i - 1, i):
+			if j < 0:
+				continue
+			f.seek(header_size + j * record_size)
+			ret.append(struct.unpack(record_fmt, f.read(record_size)))
+	finally:
+		f.close()
+	return ret
+
+
+def decide(records, now, lastdawn=0, lastdusk=0):
+	"""
+	Decides if a photo is due now.
+	Input:
+		records: see days_around
+		now: epoch seconds
+		lastdawn, lastdusk: epoch seconds of the last photos
+	Output:
+		('dawn'|'dusk'|None, reason)
+	"""
+	if not records:
+		return None, 'No schedule'
+	for sunrise, sunset, daylength, lat, lon, polar in records:
+		if polar == -1:
+			continue
+		dawn_taken = lastdawn >= sunrise
+		if not dawn_taken and \
+			dawn_window[0] < now - sunrise < dawn_window[1]:
+			return 'dawn', 'Take dawn photo'
+		if dawn_taken and lastdusk < sunset + dusk_window[0] and \
+			dusk_window[0] < now - sunset < dusk_window[1] and \
+			dusk_daylength[0] <= daylength <= dusk_daylength[1]:
+			return 'dusk', 'Take dusk photo'
+	sunrise, sunset, daylength, lat, lon, polar = records[-1]
+	if polar == -1:
+		return None, 'No sunlight hours available'
+	if lastdawn < sunrise:
+		if now < sunrise + dawn_window[1]:
+			return None, 'Waiting for dawn'
+		return None, 'Dawn photo missed'
+	if daylength < dusk_daylength[0]:
+		return None, 'Only dawn photo available, only %d minutes of sunlight today' % daylength
+	if daylength > dusk_daylength[1]:
+		return None, 'Only dawn photo available, %d minutes of sunlight today, day is too long' % daylength
+	if lastdusk >= sunset + dusk_window[0]:
+		return None, 'All photos taken'
+	if now < sunset:
+		return None, 'Waiting for dusk'
+	return None, 'Done for today'
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print __doc__
+		sys.exit(1)
+	build(time.time(), float(sys.argv[1]), float(sys.argv[2]))
+	for r in days_around(time.time()):
+		print "SUNRISE %s SUNSET %s UTC, %d minutes of light" % (
+			time.strftime('%Y-%m-%d %H:%M', time.gmtime(r[0])),
+			time.strftime('%Y-%m-%d %H:%M', time.gmtime(r[1])), r[2])
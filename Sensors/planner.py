@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+planner.py
+
+Energy budgeted daily plan of the buoy operations. From the battery
+voltage (INA219 power inputs through sensord, or the CR1000 volts), the
+light window of the day (photosched.py) and the recent Iridium link
+history, it spends the energy the battery can give today on the
+operations that deliver most bytes per joule, in the UTC hours where the
+link has worked best (photos in the dawn and dusk windows). Costs per
+operation come from the power log (powerprof.py) once there is one,
+defaults otherwise.
+
+The plan is a JSON file; scripts ask allowed(<operation>) before they
+run (jacs.py for SBD and RUDICS sessions, ucam.py for photos). With no
+plan, or an old one, everything is allowed (as before). When the data
+waiting to be sent grows past the one planned for, the rest of the day
+is planned again.
+
+Usage:
+		planner.py [volts] (builds today's plan and prints it)
+		planner.py <operation> (exit status 0 if it is allowed now)
+		planner.py test (checks a plan built late in the day)
+"""
+
+import json
+import os
+import sys
+import time
+
+planfile = '/home/satice/log/plan.json'
+linkfile = '/home/satice/log/link.log'
+powerlog = '/home/satice/log/power.log'
+# Files waiting for a RUDICS session without a queue entry (RINEX,
+# CR1000 tables), sent by jacs.py as they are.
+spooldirs = ['/home/satice/new/shortlist']
+
+# Battery, volts to state of charge (linear, lead acid at rest). Empty is
+# the CR1000 LVD threshold.
+empty_volts = 11.0
+full_volts = 12.7
+capacity_wh = 400.0
+# Energy never planned, and days the rest has to last.
+reserve = 0.2
+horizon = 30
+# Charging power in daylight (W), 0 if the buoy has no panel.
+panel_watts = 0.0
+# Link history used (days) and the CSQ (0-5) taken as usable.
+link_days = 7
+min_csq = 2
+
+# Operation -> joules per run (default), bytes delivered per run, needs
+# the link, only in the photo windows, runs per day (min, max).
+ops = {'sbd': {'joules': 60.0, 'bytes': 340, 'link': True, 'light': False, 'runs': (1, 24)},
+	'rudics': {'joules': 900.0, 'bytes': 60000, 'link': True, 'light': False, 'runs': (0, 6)},
+	'photo': {'joules': 30.0, 'bytes': 21000, 'link': False, 'light': True, 'runs': (0, 2)}}
+
+
+def state_of_charge(volts):
+	"""Fraction of charge (0-1) of a battery voltage."""
+	return min(1.0, max(0.0, (volts - empty_volts) / (full_volts - empty_volts)))
+
+
+def battery_volts():
+	"""Battery voltage, the highest of the power inputs over the last 10
+	minutes (sensord), None if the daemon is not running."""
+	import sensord
+	volts = []
+	for name in ('mpu1', 'mpu2'):
+		r = sensord.query('avg %s 600' % name)
+		if r != None and 'bus' in r['data']:
+			volts.append(r['data']['bus'])
+	if not volts:
+		return None
+	return max(volts)
+
+
+def costs(path=powerlog):
+	"""Joules per run of every operation, measured ones (powerprof log:
+	date op,count,units,joules,...) over the defaults."""
+	c = dict([(op, o['joules']) for op, o in ops.items()])
+	runs = {}
+	try:
+		f = open(path, 'r')
+	except IOError:
+		return c
+	for line in f:
+		try:
+			op, count, units, joules = line.split()[1].split(',')[:4]
+			count, joules = int(count), float(joules)
+		except (IndexError, ValueError):
+			continue
+		if op in ops and count > 0:
+			n, j = runs.get(op, (0, 0.0))
+			runs[op] = (n + count, j + joules)
+	f.close()
+	for op, (n, j) in runs.items():
+		c[op] = j / n
+	return c
+
+
+def record_link(csq, ok, now=None, path=linkfile):
+	"""Appends a link attempt (CSQ and if it worked) to the history."""
+	if now == None:
+		now = time.time()
+	f = open(path, 'a')
+	f.write('%d,%d,%d\n' % (now, int(csq), int(bool(ok))))
+	f.close()
+	return
+
+
+def link_quality(now=None, path=linkfile):
+	"""Probability of a working link per UTC hour (24 values), from the
+	last link_days of history; 0.5 for hours without history."""
+	if now == None:
+		now = time.time()
+	since = now - link_days * 86400
+	good = [1.0] * 24
+	total = [2.0] * 24
+	try:
+		f = open(path, 'r')
+	except IOError:
+		return [g / t for g, t in zip(good, total)]
+	for line in f:
+		try:
+			t, csq, ok = [int(x) for x in line.split(',')]
+		except ValueError:
+			continue
+		if t < since:
+			continue
+		h = int(t % 86400) // 3600
+		total[h] += 1
+		if ok and csq >= min_csq:
+			good[h] += 1
+	f.close()
+	return [g / t for g, t in zip(good, total)]
+
+
+def light(now):
+	"""Hours of daylight today and the UTC hours of the photo windows
+	(photosched), all day if there is no schedule."""
+	import photosched
+	records = photosched.days_around(now)
+	if not records:
+		return 12.0, range(24)
+	sunrise, sunset, daylength, lat, lon, polar = records[-1]
+	if polar == -1:
+		return 0.0, []
+	if polar == 1:
+		return 24.0, range(24)
+	day = int(now // 86400) * 86400
+	hours = []
+	for start, end in ((sunrise + photosched.dawn_window[0], sunrise + photosched.dawn_window[1]),
+		(sunset + photosched.dusk_window[0], sunset + photosched.dusk_window[1])):
+		for h in range(24):
+			if day + h * 3600 < end and day + (h + 1) * 3600 > start and h not in hours:
+				hours.append(h)
+	return daylength / 60.0, hours
+
+
+def build(volts, now=None, backlog=0, path=planfile, previous=None):
+	"""
+	Plans today's operations, from the current hour on.
+	Input:
+		volts: battery voltage
+		now: epoch seconds, the plan covers the rest of its UTC day
+		backlog: bytes waiting in the outbox
+		previous: plan of the same day to plan again from now on, its
+			runs before the current hour are kept
+	Output:
+		The plan (dictionary), also written to path.
+	"""
+	if now == None:
+		now = time.time()
+	day = int(now // 86400) * 86400
+	link = link_quality(now)
+	daylight, photohours = light(now)
+	cost = costs()
+	soc = state_of_charge(volts)
+	stored = max(0.0, soc - reserve) * capacity_wh * 3600
+	budget = stored / horizon + panel_watts * daylight * 3600
+	plan = dict([(op, []) for op in ops])
+	# Hours already gone are not planned.
+	first = int(now % 86400) // 3600
+	spent = 0.0
+	if previous != None and previous['day'] == day:
+		for op in ops:
+			plan[op] = [h for h in previous['ops'].get(op, []) if h < first]
+			spent += cost[op] * len(plan[op])
+	# Runs per day at most, lowered by the ground (mtcmd.py).
+	import mtcmd
+	settings = mtcmd.load()
+	most = dict([(op, min(o['runs'][1], settings.get(op + '_max', o['runs'][1])))
+		for op, o in ops.items()])
+	delivered = 0.0
+	# Bytes waiting for a RUDICS session.
+	pending = float(backlog)
+	rudics = ops['rudics']
+
+	def value(op, h):
+		"""Expected bytes delivered by one more run of op at hour h."""
+		if op == 'rudics':
+			left = pending - rudics['bytes'] * len(plan['rudics'])
+			return min(rudics['bytes'], max(0.0, left)) * link[h]
+		if ops[op]['link']:
+			return ops[op]['bytes'] * link[h]
+		return ops[op]['bytes']
+
+	def candidates(op):
+		"""Hours op can still run at."""
+		o = ops[op]
+		if len(plan[op]) >= most[op]:
+			return []
+		hours = [h for h in range(first, 24) if h not in plan[op]]
+		if o['light']:
+			hours = [h for h in hours if h in photohours]
+		return hours
+
+	# Minimum runs first, at the best hours, whatever the budget.
+	for op, o in ops.items():
+		for i in range(o['runs'][0] - len(plan[op])):
+			hours = candidates(op)
+			if not hours:
+				break
+			h = max(hours, key=lambda h: (value(op, h), -h))
+			plan[op].append(h)
+			spent += cost[op]
+			delivered += value(op, h)
+	# Then the most bytes per joule while the budget lasts. A photo is
+	# only worth its bytes if they are sent, so it carries the share of
+	# a RUDICS session it needs.
+	per_byte = cost['rudics'] / (rudics['bytes'] * max(link))
+	while True:
+		best = None
+		for op in ops:
+			j = cost[op]
+			if op == 'photo':
+				j += ops['photo']['bytes'] * per_byte
+			for h in candidates(op):
+				v = value(op, h)
+				if v <= 0 or spent + cost[op] > budget:
+					continue
+				if best == None or v / j > best[0]:
+					best = (v / j, op, h)
+		if best == None:
+			break
+		ratio, op, h = best
+		if op == 'photo':
+			pending += ops['photo']['bytes']
+		else:
+			delivered += value(op, h)
+		plan[op].append(h)
+		spent += cost[op]
+	for op in plan:
+		plan[op].sort()
+	ret = {'created': now, 'day': day, 'volts': volts, 'soc': soc,
+		'budget': budget, 'joules': spent, 'bytes': delivered,
+		'backlog': backlog, 'ops': plan}
+	d = os.path.dirname(path)
+	if d and not os.path.exists(d):
+		os.makedirs(d)
+	f = open(path + '.tmp', 'w')
+	json.dump(ret, f)
+	f.close()
+	os.rename(path + '.tmp', path)
+	return ret
+
+
+def read(path=planfile):
+	"""The plan, None if there is none."""
+	try:
+		f = open(path, 'r')
+	except IOError:
+		return None
+	try:
+		try:
+			return json.load(f)
+		except ValueError:
+			return None
+	finally:
+		f.close()
+
+
+def allowed(op, now=None, path=planfile):
+	"""
+	Asks the plan if op can run now. For a RUDICS session, the rest of
+	the day is planned again first if more data is waiting than planned.
+	Output:
+		(True|False, reason)
+	"""
+	if now == None:
+		now = time.time()
+	plan = read(path)
+	if plan == None or plan['day'] != int(now // 86400) * 86400:
+		return True, 'No plan for today'
+	if op not in plan['ops']:
+		return True, 'Operation not planned'
+	if op == 'rudics':
+		backlog = backlog_bytes()
+		if backlog > plan.get('backlog', 0):
+			plan = build(plan['volts'], now, backlog, path, plan)
+	h = int(now % 86400) // 3600
+	if h in plan['ops'][op]:
+		return True, 'Planned at %02d UTC' % h
+	return False, 'Not planned at %02d UTC, planned at %s' % (h,
+		','.join(['%02d' % x for x in plan['ops'][op]]) or 'no hour')
+
+
+def backlog_bytes(dirs=spooldirs):
+	"""Bytes waiting to be sent: the transfer queue not acknowledged
+	yet (outbox.py), plus the files of dirs it doesn't list."""
+	import csv
+	import outbox
+	total = 0
+	queued = set()
+	try:
+		f = open(outbox.queue, 'r')
+		for row in csv.DictReader(f):
+			try:
+				queued.add(os.path.basename(row['PATH']))
+				if not int(row['ACK']):
+					total += int(row['SIZE'])
+			except (KeyError, TypeError, ValueError):
+				continue
+		f.close()
+	except IOError:
+		pass
+	for d in dirs:
+		try:
+			names = os.listdir(d)
+		except OSError:
+			continue
+		for name in names:
+			p = os.path.join(d, name)
+			if name not in queued and os.path.isfile(p):
+				total += os.path.getsize(p)
+	return total
+
+
+def test(path):
+	"""Checks that a plan built late in the day (18:30 UTC) only has
+	hours still to come, and that the link is allowed in them."""
+	day = int(time.time() // 86400) * 86400
+	now = day + 18 * 3600 + 1800
+	plan = build(full_volts, now, ops['rudics']['bytes'], path)
+	for op in ('sbd', 'rudics'):
+		hours = plan['ops'][op]
+		assert hours and min(hours) >= 18, '%s planned at %s' % (op, hours)
+		assert allowed(op, day + hours[0] * 3600 + 1800, path)[0]
+		print '%s: %s' % (op, ','.join(['%02d' % h for h in hours]))
+	return
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'test':
+		import tempfile
+		fd, path = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			test(path)
+		finally:
+			os.remove(path)
+		sys.exit(0)
+	if len(sys.argv) > 1 and sys.argv[1] in ops:
+		ok, why = allowed(sys.argv[1])
+		print why
+		sys.exit(int(not ok))
+	if len(sys.argv) > 1:
+		volts = float(sys.argv[1])
+	else:
+		volts = battery_volts()
+	if volts == None:
+		print 'No battery voltage, sensord is not running'
+		sys.exit(1)
+	plan = build(volts, backlog=backlog_bytes())
+	print 'Battery %.2f V (%d%%), budget %.0f J, planned %.0f J, %.0f bytes' % (
+		plan['volts'], 100 * plan['soc'], plan['budget'], plan['joules'], plan['bytes'])
+	for op in sorted(plan['ops']):
+		print '%s: %s' % (op, ','.join(['%02d' % h for h in plan['ops'][op]]))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+Licensed under MIT (../LICENSE)
+
+powerprof.py
+
+Power profiling with the on board INA219 channels. The sensors are left
+in continuous conversion with on chip averaging and a background thread
+samples the power register of every channel at a fixed rate, integrating
+the energy as it goes. Operations (a SBD message, a RUDICS transfer, a
+photo) are bracketed with begin()/end() and the energy spent on their
+channel is reported per operation and per unit (message, KB, photo).
+
+Usage: powerprof.py <operation> <channel> <units> <command...>
+		i.e. powerprof.py photo fox 1 python ucam.py
+		     powerprof.py rudics modem 42 python jacs.py
+
+Current channels definition:
+		0x40 -> Modem Iridium
+		0x44 -> MPU1, first power input
+		0x41 -> MPU2, second power input
+		0x45 -> Fox & GPS for new boards.
+"""
+
+import subprocess
+import sys
+import threading
+import time
+
+import sensors #Custom library for SATICE on board payload
+
+channels = {'modem': 0x40, 'mpu1': 0x44, 'mpu2': 0x41, 'fox': 0x45}
+logfile = '/home/satice/log/power.log'
+
+
+class profiler():
+	"""Samples the power of several INA219 and integrates their energy."""
+	def __init__(self, channels=channels, rate=10, samples=16):
+		"""rate: samples per second and channel, the I2C bus limits it to
+		about 20/len(channels). samples: on chip averaging (1-128)."""
+		self.period = 1.0 / rate
+		self.samples = samples
+		self.sensors = {}
+		for name, addr in channels.items():
+			self.sensors[name] = sensors.ina_219(addr)
+		self.lock = threading.Lock()
+		# Per channel: energy so far (J), last power (W) and time.
+		self.energy = dict([(n, 0.0) for n in self.sensors])
+		self.last = {}
+		self.ticks = 0
+		# Operations running: name -> (channel, start time, start energy)
+		self.running = {}
+		# Finished: name -> [count, units, joules, seconds]
+		self.report = {}
+		self.stop_flag = threading.Event()
+		self.thread = None
+		return
+
+	def start(self):
+		"""Starts continuous conversions and the sampling thread."""
+		for s in self.sensors.values():
+			s.continuous(self.samples)
+		self.stop_flag.clear()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return
+
+	def stop(self):
+		"""Stops sampling and powers the sensors down."""
+		self.stop_flag.set()
+		if self.thread != None:
+			self.thread.join()
+		for s in self.sensors.values():
+			s._switch_off()
+		return
+
+	def _tick(self):
+		"""Reads the power of every channel, trapezoid integration."""
+		for name, s in self.sensors.items():
+			p = s._read_power()
+			t = time.time()
+			self.lock.acquire()
+			if name in self.last:
+				p0, t0 = self.last[name]
+				self.energy[name] += (p + p0) / 2 * (t - t0)
+			self.last[name] = (p, t)
+			self.lock.release()
+		self.ticks += 1
+		return
+
+	def _run(self):
+		nextrun = time.time()
+		while not self.stop_flag.isSet():
+			self._tick()
+			nextrun += self.period
+			delay = nextrun - time.time()
+			if delay > 0:
+				self.stop_flag.wait(delay)
+			else:
+				# Bus too slow for the rate, don't try to catch up.
+				nextrun = time.time()
+		return
+
+	def begin(self, op, channel):
+		"""Marks the start of an operation powered from channel."""
+		self.lock.acquire()
+		self.running[op] = (channel, time.time(), self.energy[channel])
+		self.lock.release()
+		return
+
+	def end(self, op, units=1):
+		"""Marks the end of an operation, units is what it delivered
+		(messages, KB, photos). Returns the joules it took."""
+		self.lock.acquire()
+		channel, t0, e0 = self.running.pop(op)
+		joules = self.energy[channel] - e0
+		r = self.report.setdefault(op, [0, 0, 0.0, 0.0])
+		r[0] += 1
+		r[1] += units
+		r[2] += joules
+		r[3] += time.time() - t0
+		self.lock.release()
+		return joules
+
+	def get_report(self):
+		"""Returns a list of (op, count, units, joules, joules per unit,
+		average watts)."""
+		ret = []
+		self.lock.acquire()
+		for op, (count, units, joules, secs) in sorted(self.report.items()):
+			per_unit = 0.0
+			if units > 0:
+				per_unit = joules / units
+			watts = 0.0
+			if secs > 0:
+				watts = joules / secs
+			ret.append((op, count, units, joules, per_unit, watts))
+		self.lock.release()
+		return ret
+
+	def save_report(self, path=logfile):
+		"""Appends the report to the power log."""
+		now = time.strftime('%Y-%m-%d_%H:%M:%S', time.gmtime())
+		f = open(path, 'a')
+		for r in self.get_report():
+			f.write(now + ' %s,%d,%g,%.3f,%.3f,%.3f\n' % r)
+		f.close()
+		return
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 5:
+		print __doc__
+		sys.exit(1)
+	op, channel, units = sys.argv[1], sys.argv[2], float(sys.argv[3])
+	prof = profiler()
+	prof.start()
+	prof.begin(op, channel)
+	ret = subprocess.call(sys.argv[4:])
+	prof.end(op, units)
+	prof.stop()
+	prof.save_report()
+	print "op,count,units,joules,joules/unit,watts"
+	for r in prof.get_report():
+		print "%s,%d,%g,%.3f,%.3f,%.3f" % r
+	sys.exit(ret)
@@ -11,29 +11,34 @@ V0. Daniel Peyrolon & Oriol Sanchez,ICM-CSIC
 
 Current channels definition:
 		0x40 -> Modem Iridium
-		0x41 -> MPU1, first power input
-		0x44 -> MPU2, second power input
+		0x44 -> MPU1, first power input
+		0x41 -> MPU2, second power input
 		0x45 -> Fox & GPS for new boards.
 
 """
 
 
-import sensors #Custom library for SATICE on board payload
-import time
+import sensord
+
+# Channels in output order, see sensord.channels.
+order = ['modem', 'mpu1', 'mpu2', 'fox']
 
 def print_fields(data):
 	return "%.2f,%.2f" % (data['bus'], data['current'])
 
+def read_direct():
+	"""Reads the sensors when sensord is not running."""
+	import sensors #Custom library for SATICE on board payload
+	ret = []
+	for name in order:
+		s = sensors.ina_219(sensord.channels[name][1])
+		ret.append(s.get_data())
+	return ret
+
 if __name__ == "__main__":
-	modem = sensors.ina_219(0x40)
-	d1 = print_fields(modem.get_data())
-	
-	mpu1 = sensors.ina_219(0x44)
-	d2 = print_fields(mpu1.get_data())
-	
-	mpu2 = sensors.ina_219(0x41)
-	d3 = print_fields(mpu2.get_data())
-	
-	fox = sensors.ina_219(0x45)
-	d4 = print_fields(fox.get_data())
-	print d1+','+d2+','+d3+','+d4
+	data = [sensord.query('latest ' + name) for name in order]
+	if None in data:
+		data = read_direct()
+	else:
+		data = [d["data"] for d in data]
+	print ','.join(map(print_fields, data))
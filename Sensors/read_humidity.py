@@ -5,21 +5,30 @@ Licensed under MIT (../LICENSE)
 
 read_humidity.py
 
-Accesses on board temperature and humidity sensor through I2C port
+Accesses on board temperature and humidity sensor through I2C port.
+Asks sensord for the last sample, reads the sensor if it is not running.
+Usage: read_humidity.py [samples]
 
 V0. Daniel Peyrolon, ICM-CSIC
 """
 
-import sensors #Custom library for SATICE on board payload
-import time
-
-def avg(l):
-	"""Calculate the average of the data."""
-	return reduce(lambda x,y: x + y, l) / len(l)
+import sensord
+import sys
 
 if __name__ == "__main__":
-	s = sensors.hih_6130(0x27)
-	data = [s.get_data() for i in range(10)]
-	hum = map(lambda d:d["humidity"], data)
-	temp = map(lambda d:d["temperature"], data)
-	print "%.2f,%.2f" % (avg(hum), avg(temp))
+	data = sensord.query('latest humidity')
+	if data != None:
+		data = data["data"]
+	else:
+		import sensors #Custom library for SATICE on board payload
+		samples = 10
+		if len(sys.argv) > 1:
+			samples = int(sys.argv[1])
+		s = sensors.hih_6130(0x27)
+		d = s.sample(samples)
+		if d["humidity"] == None:
+			sys.stderr.write("No valid conversion in %d samples\n" % samples)
+			sys.exit(1)
+		data = {"humidity": d["humidity"]["clipped"],
+			"temperature": d["temperature"]["clipped"]}
+	print "%.2f,%.2f" % (data["humidity"], data["temperature"])
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+rinex.py
+
+Streaming reader for the hourly RINEX files of the buoy GPS (i.e.
+SI941200.16f.bz2). Files are decompressed on the fly (.bz2, .gz, .Z
+through gzip -dc, or plain) and read record by record with generators, so memory stays
+constant whatever the size of the file. Observation records are not
+decoded, only counted, which is what the hourly summary needs.
+
+Supports observation and navigation files, RINEX 2.x and 3.x. Other
+types (meteorological, clock) are summarized from the header only.
+
+Usage: rinex.py <file> [file...]
+"""
+
+import bz2
+import calendar
+import gzip
+import subprocess
+import sys
+
+# Lines following the first line of a navigation record, per system.
+nav_lines = {'G': 7, 'E': 7, 'C': 7, 'J': 7, 'I': 7, 'R': 3, 'S': 3}
+# RINEX 2 navigation file type -> system.
+nav_types = {'N': 'G', 'G': 'R', 'H': 'S', 'L': 'E'}
+
+
+class _uncompress():
+	"""Output of gzip -dc, read as a file. Unix compress (.Z) is LZW,
+	the gzip module can't read it."""
+	def __init__(self, path):
+		try:
+			self.p = subprocess.Popen(['gzip', '-dc', path],
+				stdout=subprocess.PIPE)
+		except OSError:
+			raise IOError('gzip is needed to read %s' % path)
+		self.path = path
+		self.readline = self.p.stdout.readline
+		return
+
+	def close(self):
+		self.p.stdout.close()
+		if self.p.wait() > 0:
+			raise IOError('gzip -dc %s failed' % self.path)
+		return
+
+
+def open_rinex(path):
+	"""Opens a RINEX file, decompressing on the fly."""
+	if path.endswith('.bz2'):
+		return bz2.BZ2File(path, 'r')
+	if path.endswith('.gz'):
+		return gzip.open(path, 'r')
+	if path.endswith('.Z'):
+		return _uncompress(path)
+	return open(path, 'r')
+
+
+def _float(s, default=None):
+	"""Float of a fixed width field, accepts Fortran D exponents."""
+	s = s.strip().replace('D', 'E').replace('d', 'e')
+	if not s:
+		return default
+	try:
+		return float(s)
+	except ValueError:
+		return default
+
+
+def _epoch(year, month, day, hour, minute, sec):
+	"""UTC epoch seconds. Two digit years are 1980-2079."""
+	if year < 100:
+		year += 1900
+		if year < 1980:
+			year += 100
+	return calendar.timegm((year, month, day, hour, minute, 0)) + sec
+
+
+def _satid(s):
+	"""Satellite id of a RINEX 2 list entry, blank system is GPS."""
+	s = s.ljust(3)
+	system = s[0]
+	if system == ' ':
+		system = 'G'
+	return system + s[1:].replace(' ', '0')
+
+
+def read_header(f):
+	"""
+	Reads the header, leaves f at the first record.
+	Input:
+		f: open RINEX file (see open_rinex)
+	Output:
+		Dictionary with version, type, system, marker, position (X,Y,Z
+		or None), obs_types (number of observation types per system,
+		' ' for RINEX 2), interval and first (epoch seconds or None).
+	"""
+	h = {'version': 0.0, 'type': '', 'system': '', 'marker': '',
+		'position': None, 'obs_types': {}, 'interval': None, 'first': None}
+	# readline() everywhere, iterating the file would read ahead.
+	while True:
+		line = f.readline()
+		if not line:
+			break
+		label = line[60:80].strip()
+		if label == 'RINEX VERSION / TYPE':
+			h['version'] = _float(line[0:9], 0.0)
+			h['type'] = line[20:21].upper()
+			h['system'] = line[40:41].upper()
+		elif label == 'MARKER NAME':
+			h['marker'] = line[0:60].strip()
+		elif label == 'APPROX POSITION XYZ':
+			xyz = [_float(line[i:i + 14]) for i in (0, 14, 28)]
+			if None not in xyz:
+				h['position'] = xyz
+		elif label == '# / TYPES OF OBSERV':
+			# RINEX 2, continuation lines have a blank count.
+			n = line[0:6].strip()
+			if n:
+				h['obs_types'][' '] = int(n)
+		elif label == 'SYS / # / OBS TYPES':
+			# RINEX 3, continuation lines have a blank system.
+			if line[0] != ' ':
+				h['obs_types'][line[0]] = int(line[3:6])
+		elif label == 'INTERVAL':
+			h['interval'] = _float(line[0:10])
+		elif label == 'TIME OF FIRST OBS':
+			fields = line[0:43].split()
+			if len(fields) >= 6:
+				h['first'] = _epoch(int(fields[0]), int(fields[1]),
+					int(fields[2]), int(fields[3]), int(fields[4]),
+					float(fields[5]))
+		elif label == 'END OF HEADER':
+			break
+	return h
+
+
+def _skip(f, n):
+	"""Skips n lines."""
+	for i in range(n):
+		if not f.readline():
+			break
+	return
+
+
+def obs_epochs(f, header):
+	"""
+	Generator of the epochs of an observation file, after read_header.
+	Yields dictionaries with time (epoch seconds), flag and sats (list of
+	satellite ids, i.e. 'G01'). Special event records (flags 2-5) and
+	cycle slip records (flag 6) are skipped, observations are skipped
+	without decoding.
+	"""
+	v3 = header['version'] >= 3
+	# Lines of observations per satellite in RINEX 2.
+	obslines = (header['obs_types'].get(' ', 0) + 4) // 5
+	while True:
+		line = f.readline()
+		if not line:
+			return
+		if not line.strip():
+			continue
+		try:
+			if v3:
+				if line[0] != '>':
+					continue
+				t = line[1:].split()
+				when = _epoch(int(t[0]), int(t[1]), int(t[2]), int(t[3]),
+					int(t[4]), float(t[5]))
+				flag = int(t[6])
+				n = int(t[7])
+			else:
+				flag = int(line[26:29])
+				n = int(line[29:32])
+				if flag < 2 or flag == 6:
+					when = _epoch(int(line[1:3]), int(line[4:6]),
+						int(line[7:9]), int(line[10:12]),
+						int(line[13:15]), float(line[15:26]))
+		except (ValueError, IndexError):
+			# Not an epoch line (corrupted file), look for the next one.
+			continue
+		if 2 <= flag <= 5:
+			_skip(f, n)
+			continue
+		sats = []
+		if v3:
+			for i in range(n):
+				sats.append(f.readline()[0:3].replace(' ', '0'))
+		else:
+			satlist = line[32:68].rstrip()
+			sats = [satlist[i:i + 3] for i in range(0, len(satlist), 3)]
+			# More than 12 satellites go on continuation lines.
+			while len(sats) < n:
+				satlist = f.readline()[32:68].rstrip()
+				if not satlist:
+					break
+				sats.extend([satlist[i:i + 3] for i in range(0, len(satlist), 3)])
+			sats = [_satid(sat) for sat in sats[:n]]
+			_skip(f, n * obslines)
+		if flag == 6:
+			# Observations of an epoch already yielded, repeated.
+			continue
+		yield {'time': when, 'flag': flag, 'sats': sats}
+
+
+def nav_records(f, header):
+	"""
+	Generator of the records of a navigation file, after read_header.
+	Yields (satellite id, epoch seconds of the clock). Orbits are skipped.
+	"""
+	v3 = header['version'] >= 3
+	while True:
+		line = f.readline()
+		if not line:
+			return
+		if not line.strip():
+			continue
+		try:
+			if v3:
+				sat = line[0:3].replace(' ', '0')
+				t = line[3:23].split()
+				when = _epoch(int(t[0]), int(t[1]), int(t[2]), int(t[3]),
+					int(t[4]), float(t[5]))
+				system = sat[0]
+			else:
+				system = nav_types.get(header['type'], 'G')
+				sat = system + '%02d' % int(line[0:2])
+				when = _epoch(int(line[3:5]), int(line[6:8]), int(line[9:11]),
+					int(line[12:14]), int(line[15:17]), float(line[17:22]))
+		except (ValueError, IndexError):
+			continue
+		_skip(f, nav_lines.get(system, 7))
+		yield sat, when
+
+
+def summary(path):
+	"""
+	Summary of a RINEX file, in one pass.
+	Output:
+		Dictionary with the header fields, plus for observation files:
+		epochs, start, end, sats_min, sats_max, sats_mean and systems
+		(satellite observations per system); for navigation files:
+		records and sats (records per satellite); nothing else for the
+		other types. When the header has an
+		approximate position, lat, lon and alt too.
+	"""
+	f = open_rinex(path)
+	try:
+		h = read_header(f)
+		s = dict(h)
+		if h['type'] == 'O':
+			s.update({'epochs': 0, 'start': None, 'end': None,
+				'sats_min': None, 'sats_max': 0, 'sats_mean': 0.0, 'systems': {}})
+			total = 0
+			for e in obs_epochs(f, h):
+				n = len(e['sats'])
+				if s['start'] == None:
+					s['start'] = e['time']
+				s['end'] = e['time']
+				s['epochs'] += 1
+				total += n
+				s['sats_max'] = max(s['sats_max'], n)
+				if s['sats_min'] == None or n < s['sats_min']:
+					s['sats_min'] = n
+				for sat in e['sats']:
+					s['systems'][sat[0]] = s['systems'].get(sat[0], 0) + 1
+			if s['epochs']:
+				s['sats_mean'] = float(total) / s['epochs']
+		elif h['type'] in nav_types:
+			s.update({'records': 0, 'sats': {}})
+			for sat, when in nav_records(f, h):
+				s['records'] += 1
+				s['sats'][sat] = s['sats'].get(sat, 0) + 1
+	finally:
+		f.close()
+	if h['position'] != None:
+		import geodesy
+		lat, lon, alt = geodesy.ecef_to_geodetic(h['position'])
+		s['lat'], s['lon'], s['alt'] = float(lat[0]), float(lon[0]), float(alt[0])
+	return s
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print __doc__
+		sys.exit(1)
+	for path in sys.argv[1:]:
+		s = summary(path)
+		print path
+		for k in sorted(s.keys()):
+			print '\t%s: %s' % (k, s[k])
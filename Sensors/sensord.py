@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""
+Licensed under MIT (../LICENSE)
+
+sensord.py
+
+Sensor acquisition daemon. Owns the on board I2C sensors, samples them
+on its own schedule into ring buffers and answers queries through a
+Unix domain socket, so cron scripts don't pay for imports, bus setup
+and sensor calibration on every reading.
+
+Requests are one line, answers are one JSON line:
+		latest <channel> (with its age, an error once stale)
+		avg <channel> <seconds>
+		channels
+		i2c (I2C statistics, with SATICE_I2CSTATS=1, i2cstats.py)
+
+Usage:
+		sensord.py (runs the daemon)
+		sensord.py <request> (prints the answer)
+"""
+
+import json
+import os
+import socket
+import sys
+import time
+
+# Channel name -> (sensor, I2C address)
+channels = {'humidity': ('hih6130', 0x27),
+	'modem': ('ina219', 0x40),
+	'mpu1': ('ina219', 0x44),
+	'mpu2': ('ina219', 0x41),
+	'fox': ('ina219', 0x45)}
+sockpath = '/home/satice/run/sensord.sock'
+# Seconds between samples (PERIOD of mtcmd.py once running), and samples
+# kept per channel (a day).
+period = 60
+depth = 1440
+# Periods after which the last sample of a channel is stale, not served.
+stale = 3
+# Conversions averaged on each humidity sample.
+hih_samples = 10
+
+
+def query(request, path=sockpath, timeout=2.0):
+	"""
+	Sends a request to the daemon.
+	Input:
+		request: request line, i.e. 'latest humidity'
+		path: socket of the daemon
+		timeout: seconds to wait for the answer
+	Output:
+		Decoded answer (dictionary), None if the daemon is not running.
+	"""
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	s.settimeout(timeout)
+	answer = ''
+	try:
+		try:
+			s.connect(path)
+			s.sendall(request + '\n')
+			while not answer.endswith('\n'):
+				chunk = s.recv(4096)
+				if not chunk:
+					break
+				answer += chunk
+		except socket.error:
+			return None
+	finally:
+		s.close()
+	if not answer:
+		return None
+	answer = json.loads(answer)
+	if 'error' in answer:
+		return None
+	return answer
+
+
+def average(records):
+	"""Averages the numeric fields of a list of (time, data) records."""
+	sums = {}
+	for t, data in records:
+		for k, v in data.items():
+			if isinstance(v, (int, float)):
+				sums[k] = sums.get(k, 0.0) + v
+	n = len(records)
+	ret = {}
+	for k, v in sums.items():
+		ret[k] = v / n
+	return ret
+
+
+class acquisition():
+	"""Opens the sensors once and samples them into ring buffers."""
+	def __init__(self, period=period, depth=depth):
+		# Imported here so clients of this module stay light.
+		import collections
+		import threading
+		import archive
+		import sensors
+		self.period = period
+		self.archive = archive.timeseries('sensors')
+		self.lock = threading.Lock()
+		self.sensors = {}
+		self.buffers = {}
+		for name, (kind, addr) in channels.items():
+			if kind == 'hih6130':
+				self.sensors[name] = sensors.hih_6130(addr)
+			else:
+				self.sensors[name] = sensors.ina_219(addr)
+			self.buffers[name] = collections.deque(maxlen=depth)
+		self.thread = threading.Thread(target=self._run)
+		self.thread.setDaemon(True)
+		return
+
+	def start(self):
+		"""Starts sampling in the background."""
+		self.thread.start()
+		return
+
+	def _read(self, name):
+		"""Takes one sample of a channel, None if the sensor gave none."""
+		s = self.sensors[name]
+		if channels[name][0] == 'hih6130':
+			d = s.sample(hih_samples)
+			if d["humidity"] == None:
+				return None
+			return {"humidity": d["humidity"]["clipped"],
+				"temperature": d["temperature"]["clipped"]}
+		return s.get_data()
+
+	def sample_all(self):
+		"""Samples every channel once."""
+		for name in self.sensors:
+			try:
+				data = self._read(name)
+			except IOError:
+				# Bus error, keep the last good sample.
+				continue
+			if data == None:
+				sys.stderr.write('%s: every conversion failed\n' % name)
+				continue
+			self.lock.acquire()
+			self.buffers[name].append((time.time(), data))
+			self.lock.release()
+		return
+
+	def save(self):
+		"""Appends the last sample of every channel to the archive
+		(archive.py), one record."""
+		row = {}
+		when = 0
+		self.lock.acquire()
+		try:
+			for name, buf in self.buffers.items():
+				if not buf:
+					continue
+				t, data = buf[-1]
+				when = max(when, t)
+				if channels[name][0] == 'hih6130':
+					row.update(data)
+				else:
+					row[name + '_bus'] = data['bus']
+					row[name + '_current'] = data['current']
+		finally:
+			self.lock.release()
+		if row:
+			try:
+				self.archive.append([(when, row)])
+			except (IOError, OSError):
+				pass
+		return
+
+	def _run(self):
+		import mtcmd
+		nextrun = time.time()
+		while True:
+			# The ground may change it (mtcmd.py).
+			self.period = mtcmd.get('period')
+			nextrun += self.period
+			time.sleep(max(0, nextrun - time.time()))
+			self.sample_all()
+			self.save()
+
+	def latest(self, name):
+		"""Last sample of a channel and its age (s), None if there is
+		none yet."""
+		self.lock.acquire()
+		try:
+			if not self.buffers[name]:
+				return None
+			t, data = self.buffers[name][-1]
+		finally:
+			self.lock.release()
+		return {"time": t, "age": time.time() - t, "data": data}
+
+	def window(self, name, seconds):
+		"""Average of the samples of the last seconds of a channel."""
+		since = time.time() - seconds
+		self.lock.acquire()
+		try:
+			records = [r for r in self.buffers[name] if r[0] >= since]
+		finally:
+			self.lock.release()
+		if not records:
+			return None
+		return {"time": records[-1][0], "samples": len(records),
+			"data": average(records)}
+
+	def answer(self, line):
+		"""Answers a request line."""
+		req = line.split()
+		if req == ['channels']:
+			return {"channels": sorted(channels.keys())}
+		if req == ['i2c']:
+			import i2cstats
+			if not i2cstats.enabled:
+				return {"error": "i2c statistics disabled"}
+			return i2cstats.snapshot()
+		if len(req) < 2 or req[1] not in self.buffers:
+			return {"error": "bad request"}
+		if req[0] == 'latest':
+			ret = self.latest(req[1])
+			if ret != None and ret["age"] > stale * self.period:
+				return {"error": "stale", "age": ret["age"]}
+		elif req[0] == 'avg' and len(req) == 3:
+			try:
+				seconds = float(req[2])
+			except ValueError:
+				return {"error": "bad window"}
+			if not seconds > 0:
+				return {"error": "bad window"}
+			ret = self.window(req[1], seconds)
+		else:
+			return {"error": "bad request"}
+		if ret == None:
+			return {"error": "no data"}
+		return ret
+
+
+def serve(acq, path=sockpath):
+	"""Answers queries on the socket, forever."""
+	import SocketServer
+
+	class handler(SocketServer.StreamRequestHandler):
+		def handle(self):
+			line = self.rfile.readline().strip()
+			self.wfile.write(json.dumps(acq.answer(line)) + '\n')
+
+	d = os.path.dirname(path)
+	if not os.path.exists(d):
+		os.makedirs(d)
+	if os.path.exists(path):
+		os.remove(path)
+	server = SocketServer.UnixStreamServer(path, handler)
+	try:
+		server.serve_forever()
+	finally:
+		os.remove(path)
+
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1:
+		print json.dumps(query(' '.join(sys.argv[1:])))
+		sys.exit()
+	acq = acquisition()
+	# First samples before answering anything.
+	acq.sample_all()
+	acq.start()
+	serve(acq)
+	sys.exit()
@@ -19,10 +19,9 @@ V0. Daniel Peyrolon & Oriol Sanchez,ICM-CSIC
 
 
 import ctypes as ct
-import fox
+import hal #Board libraries, smbus and pyserial, loaded on first use
+import i2cstats
 import os
-import serial
-import smbus
 import time
 
 #V1 Daniel Peyrolon - March 2015
@@ -37,7 +36,12 @@ class i2c_iface():
 		assert(addr >= 0)
 		self.addr = addr
 		self.invert = invert_endian
-		self.b = smbus.SMBus(bus)
+		self.b = hal.i2c(bus)
+		self.sleep = time.sleep
+		if i2cstats.enabled:
+			# Timed transfers and counted sleeps (i2cstats.py).
+			self.b = i2cstats.bus(self.b, addr)
+			self.sleep = i2cstats.sleeper(addr)
 
 	def _invert_endianness(self, val):
 		"""Invert the world (ushort16) endianness if needed."""
@@ -50,42 +54,42 @@ class i2c_iface():
 
 	def write_bus(self, val):
 		"""Write only to the bus."""
-		time.sleep(0.01)
+		self.sleep(0.01)
 		return self.b.write_byte(self.addr, val)
 
 	def read_bus(self, length):
 		"""Write data from bus."""
-		time.sleep(0.01)
+		self.sleep(0.01)
 		return self.b.read_i2c_block_data(self.addr, length)
 
 	def write_register(self, reg, val):
 		"""Write any value at the addr"""
 		# Invert if neeeded.
 		val = self._invert_endianness(val)
-		time.sleep(0.01)
+		self.sleep(0.01)
 		self.b.write_word_data(self.addr, reg, val)
 		return
 
 	def read_register(self, addrh, addrl=None):
 		"""Read any value from the sensor. If two addresses, merge data."""
-		time.sleep(0.01)
+		self.sleep(0.01)
 		if (addrl == None):
 			val = self.b.read_word_data(self.addr, addrh)
 		else:
 			h = self.b.read_word_data(self.addr, addrh)
-			time.sleep(0.01)
+			self.sleep(0.01)
 			l = self.b.read_word_data(self.addr, addrl)
 			val = ((h << 8) | l)
 		return self._invert_endianness(val)
 
 	def read_register_byte(self, addrh, addrl=None):
 		"""Read any value from the sensor. If two addresses, merge data."""
-		time.sleep(0.01)
+		self.sleep(0.01)
 		if (addrl == None):
 			val = self.b.read_byte_data(self.addr, addrh)
 		else:
 			h = self.b.read_byte_data(self.addr, addrh)
-			time.sleep(0.01)
+			self.sleep(0.01)
 			l = self.b.read_byte_data(self.addr, addrl)
 			val = ((h << 8) | l)
 		return self._invert_endianness(val)
@@ -112,11 +116,33 @@ class ina_219():
 	config_on = 0x199f
 	# config_off is the configuration needed to power down the sensor.
 	config_off = 0x1998
-
-	def __init__(self, addr):
+	# Config fields: 16V bus range and /8 gain (as config_on), the ADC
+	# setting goes to BADC (bits 10-7) and SADC (bits 6-3), mode to bits 2-0.
+	config_base = 0x1800
+	mode_mask = 0x7
+	mode_off = 0x0
+	mode_triggered = 0x3
+	mode_continuous = 0x7
+	adc_12bit = 0x3
+	# Samples averaged on chip -> ADC setting.
+	adc_averaging = {1: 0x8, 2: 0x9, 4: 0xa, 8: 0xb, 16: 0xc, 32: 0xd,
+			64: 0xe, 128: 0xf}
+	# ADC setting -> conversion time (s), from the datasheet.
+	adc_time = {0x3: 532e-6, 0x8: 532e-6, 0x9: 1.06e-3, 0xa: 2.13e-3,
+			0xb: 4.26e-3, 0xc: 8.51e-3, 0xd: 17.02e-3, 0xe: 34.05e-3,
+			0xf: 68.10e-3}
+	# Bus voltage register flags.
+	bus_cnvr = 0x2
+	bus_ovf = 0x1
+	# Polling for CNVR gives up after this many conversion times.
+	ready_timeout = 4
+
+	def __init__(self, addr, samples=1):
 		"""Create the connection. Starts up the sensor,
-		configure, calibrates it."""
+		configure, calibrates it. samples are averaged on chip on
+		every triggered conversion (1-128, power of 2)."""
 		self.iface = i2c_iface(0, addr, invert_endian=True)
+		self.adc = self.adc_averaging[samples]
 
 		# Make it sleep.
 		self.iface.write_register(self.ina219_conf, self.config_off)
@@ -140,20 +166,59 @@ class ina_219():
 		self.iface.write_register(self.ina219_conf, self.config_off)
 		return
 
+	def _config(self, mode, adc=adc_12bit):
+		"""Configuration word for a mode and ADC setting."""
+		return self.config_base | (adc << 7) | (adc << 3) | mode
+
+	def continuous(self, samples=1):
+		"""Starts continuous conversions averaging samples (1-128, power
+		of 2) on chip. Returns the time (s) between fresh registers."""
+		adc = self.adc_averaging[samples]
+		self.iface.write_register(self.ina219_conf,
+				self._config(self.mode_continuous, adc))
+		# Shunt and bus are converted one after the other.
+		return 2 * self.adc_time[adc]
+
 	def _read_shunt(self):
 		"""Reads shunt tension (V)."""
 		# Note the division by 100000 this is a division by 100 to get the
 		# actual value.
 		return float(self.iface.read_register(self.ina219_tension)) / 100000
 
+	def _bus_volts(self, ret):
+		"""Bus voltage register to volts."""
+		ret = ret >> 3
+		return ret * 0.004
+
 	def _read_bus(self):
 		"""Reads bus tension (V)."""
-		ret = 0
-		# Check last bit to know if the sensor has good data.
-		while ret << 14 == 0:
+		return self._bus_volts(self.iface.read_register(self.ina219_bus_tension))
+
+	def conversion_time(self):
+		"""Time (s) of a shunt plus bus conversion with the ADC setting."""
+		return 2 * self.adc_time[self.adc]
+
+	def _trigger(self):
+		"""Starts a single shunt and bus conversion."""
+		self.iface.write_register(self.ina219_conf,
+				self._config(self.mode_triggered, self.adc))
+		return
+
+	def _wait_ready(self):
+		"""Waits a conversion time, then polls the CNVR bit backing off.
+		Returns the bus voltage register, raises IOError on timeout."""
+		conv = self.conversion_time()
+		deadline = time.time() + self.ready_timeout * conv
+		time.sleep(conv)
+		wait = conv / 4
+		while True:
 			ret = self.iface.read_register(self.ina219_bus_tension)
-		ret = ret >> 3
-		return ret * 0.004
+			if ret & self.bus_cnvr:
+				return ret
+			if time.time() > deadline:
+				raise IOError('INA219 conversion not ready')
+			time.sleep(wait)
+			wait = min(wait * 2, conv)
 
 	def _read_power(self):
 		"""Reads power register  (Vbus * Current) (W)."""
@@ -165,34 +230,124 @@ class ina_219():
 
 	def get_data(self):
 		"""Main function used to get all the real data."""
-		# Swith on and off the sensor as needed.
-		self._switch_on()
-		ret = {"shunt": self._read_shunt(),
-			  "bus": self._read_bus(),
-			  "power bus": self._read_power(),
-			  "current": self._read_current()}
-		self._switch_off()
+		# Left in continuous mode by someone else (powerprof.py): read
+		# the last conversion and leave it running.
+		conf = self.iface.read_register(self.ina219_conf)
+		if conf & self.mode_mask == self.mode_continuous:
+			bus = self.iface.read_register(self.ina219_bus_tension)
+			return {"shunt": self._read_shunt(),
+				  "bus": self._bus_volts(bus),
+				  "power bus": self._read_power(),
+				  "current": self._read_current()}
+		# One triggered conversion, registers are read once it is ready.
+		# Reading power clears CNVR. Power down afterwards.
+		self._trigger()
+		try:
+			bus = self._wait_ready()
+			ret = {"shunt": self._read_shunt(),
+				  "bus": self._bus_volts(bus),
+				  "power bus": self._read_power(),
+				  "current": self._read_current()}
+		finally:
+			self._switch_off()
 		return ret
 
+class running_stats():
+	"""Streaming mean and standard deviation (Welford), plus an average
+	that rejects samples further than k standard deviations from the
+	running mean. Everything is updated in one pass, nothing is stored."""
+	def __init__(self, k=2.0, warmup=3):
+		self.k = k
+		# Samples needed before the running deviation is trusted.
+		self.warmup = warmup
+		self.n = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.kept = 0
+		self.kept_mean = 0.0
+		self.rejected = 0
+		return
+
+	def add(self, x):
+		"""Adds a sample."""
+		x = float(x)
+		# Check against the deviation seen so far, before updating.
+		if self.n >= self.warmup and abs(x - self.mean) > self.k * self.std():
+			self.rejected += 1
+		else:
+			self.kept += 1
+			self.kept_mean += (x - self.kept_mean) / self.kept
+		self.n += 1
+		delta = x - self.mean
+		self.mean += delta / self.n
+		self.m2 += delta * (x - self.mean)
+		return
+
+	def std(self):
+		"""Sample standard deviation."""
+		if self.n < 2:
+			return 0.0
+		return (self.m2 / (self.n - 1)) ** 0.5
+
+	def get_data(self):
+		"""Returns all the statistics, None if no sample was kept."""
+		if self.kept == 0:
+			return None
+		return {"mean": self.mean,
+			"std": self.std(),
+			"clipped": self.kept_mean,
+			"samples": self.n,
+			"rejected": self.rejected}
+
 class hih_6130():
 	"""Class to manage the humidity sensor."""
+	# Status bits, two MSB of the first byte.
+	status_valid = 0
+	status_stale = 1
+	status_command = 2
+	status_diag = 3
+	# Measurement cycle is 36.65ms typ (datasheet), then poll the status.
+	conversion_time = 0.037
+	poll_time = 0.005
+	timeout = 0.2
+
 	def __init__(self, addr):
 		"""Create the connection. Starts up the sensor, sets
 		everything, calibrates it."""
 		self.iface = i2c_iface(0, addr, invert_endian=True)
 		return
 
-	def _read_data(self):
-		"""Reads humidity and temperature."""
+	def _request(self):
+		"""Issues a measurement request."""
 		self.iface.write_bus(4)
+		return
+
+	def _fetch(self):
+		"""Reads the output registers. Returns status, humidity and
+		temperature."""
 		val = self.iface.read_bus(4)
+		status = (val[0] >> 6) & 0x03
 		hum = ((val[0] & 0x3f) << 8) | val[1]
 		hum = (float(hum)/16383)*100
 
 		temp = (val[2] << 8) | val[3]
 		temp = temp >> 2
 		temp = ((((float(temp))/16383)*165) - 40)
-		return hum, temp
+		return status, hum, temp
+
+	def _read_data(self):
+		"""Reads humidity and temperature of a new conversion. Stale
+		frames are discarded, returns None, None on timeout."""
+		self._request()
+		time.sleep(self.conversion_time)
+		deadline = time.time() + self.timeout
+		while True:
+			status, hum, temp = self._fetch()
+			if status == self.status_valid:
+				return hum, temp
+			if status != self.status_stale or time.time() > deadline:
+				return None, None
+			time.sleep(self.poll_time)
 
 	def get_data(self):
 		"""Main function used to get all the real data."""
@@ -200,6 +355,24 @@ class hih_6130():
 		return {"humidity": hum,
 			"temperature": temp}
 
+	def sample(self, samples=10, k=2.0):
+		"""Averages several conversions. Returns the running_stats data
+		for humidity and temperature (None if every conversion failed),
+		failed conversions are counted."""
+		hum_stats = running_stats(k)
+		temp_stats = running_stats(k)
+		failed = 0
+		for i in range(samples):
+			hum, temp = self._read_data()
+			if hum == None:
+				failed += 1
+				continue
+			hum_stats.add(hum)
+			temp_stats.add(temp)
+		return {"humidity": hum_stats.get_data(),
+			"temperature": temp_stats.get_data(),
+			"failed": failed}
+
 class vc0706():
 	"""Class to handle the camera. Will present a very high level user
 	interface."""
@@ -220,16 +393,47 @@ class vc0706():
 	cmd_takephoto = 0x36
 	cmd_readbuff = 0x32
 	cmd_getbufflen = 0x34
+	cmd_readdata = 0x30
+	cmd_writedata = 0x31
+	cmd_downsize = 0x54
+	cmd_getdownsize = 0x55
 
 	fbuf_currentframe = 0x00
 	fbuf_nextframe = 0x01
 	fbuf_stopcurrentframe = 0x00
+	fbuf_resumeframe = 0x03
+
+	# Image sizes, as downsize ratios of the 640x480 frame (DOWNSIZE_CTRL).
+	# Register 0x0019 would be the I2C EEPROM, only read after a reset.
+	imagesize_640x480 = 0x00
+	imagesize_320x240 = 0x11
+	imagesize_160x120 = 0x22
+	imagesize_pixels = {imagesize_640x480: 640*480,
+			imagesize_320x240: 320*240,
+			imagesize_160x120: 160*120}
+	# Default compression ratio (0x00 best quality, 0xff smallest file).
+	compression_default = 0x36
+
+	# Resolution and compression ratio pairs tried, in order, when the
+	# photo has to fit a byte budget. Best quality first.
+	budget_ladder = [(imagesize_640x480, compression_default),
+			(imagesize_640x480, 0x80),
+			(imagesize_320x240, compression_default),
+			(imagesize_320x240, 0x80),
+			(imagesize_160x120, compression_default),
+			(imagesize_160x120, 0xc0)]
 
 	getversioncommand = [commandsend, serialnum, cmd_getversion, commandend]
 	resetcommand = [commandsend, serialnum, cmd_reset, commandend]
 	takephotocommand = [commandsend, serialnum, cmd_takephoto, 0x01, fbuf_stopcurrentframe]
+	resumeframecommand = [commandsend, serialnum, cmd_takephoto, 0x01, fbuf_resumeframe]
 	getbufflencommand = [commandsend, serialnum, cmd_getbufflen, 0x01, fbuf_currentframe]
 	readphotocommand = [commandsend, serialnum, cmd_readbuff, 0x0C, fbuf_currentframe, 0x0a]
+	# The value to write is appended to the set commands.
+	getimagesizecommand = [commandsend, serialnum, cmd_getdownsize, 0x00]
+	setimagesizecommand = [commandsend, serialnum, cmd_downsize, 0x01]
+	getcompressioncommand = [commandsend, serialnum, cmd_readdata, 0x04, 0x01, 0x01, 0x12, 0x04]
+	setcompressioncommand = [commandsend, serialnum, cmd_writedata, 0x05, 0x01, 0x01, 0x12, 0x04]
 
 	def __init__(self):
 		"""Set up everything, the camera has to be switched on previously."""
@@ -240,7 +444,7 @@ class vc0706():
 
 	def _switch_on(self):
 		"""Create connections with camera."""
-		self.ser = serial.Serial(baudrate = self.baudrate,
+		self.ser = hal.serial_port(baudrate = self.baudrate,
 		                         port = self.port,
 		                         timeout = self.timeout)
 		time.sleep(0.5)
@@ -261,6 +465,8 @@ class vc0706():
 	def _checkreply(self, r, b):
 		"""Compares the command of the received message, checks status."""
 		r = map(ord, list(r))
+		if len(r) < 4:
+			return False
 		return r[0] == 0x76 and r[1] == self.serialnum and r[2] == b and r[3] == 0x00
 
 	def _take_snapshot(self):
@@ -270,12 +476,50 @@ class vc0706():
 		r = list(self.ser.read(5))
 		return self._checkreply(r, self.cmd_takephoto) and r[3] == chr(0x0)
 
-	def _photo_data(self):
-		"""Fetches the data from the camera."""
-		# Get the length of the photography.
+	def _resume_frame(self):
+		"""Release the frozen frame so a new snapshot can be taken."""
+		cmd = ''.join(map(chr, self.resumeframecommand))
+		self.ser.write(cmd)
+		return self._checkreply(self.ser.read(5), self.cmd_takephoto)
+
+	def _read_setting(self, command):
+		"""Reads a one byte camera setting, None if the reply is wrong."""
+		self.ser.write(''.join(map(chr, command)))
+		r = self.ser.read(6)
+		if not self._checkreply(r, command[2]) or len(r) < 6:
+			return None
+		return ord(r[5])
+
+	def _write_setting(self, command, val):
+		"""Writes a one byte camera setting."""
+		self.ser.write(''.join(map(chr, command + [val & 0xff])))
+		return self._checkreply(self.ser.read(5), command[2])
+
+	def get_image_size(self):
+		"""Gets the resolution of the next frames (imagesize_*)."""
+		return self._read_setting(self.getimagesizecommand)
+
+	def set_image_size(self, size):
+		"""Sets the resolution of the next frames (imagesize_*), the
+		camera downsizes the 640x480 frame from the next snapshot on.
+		It is back to 640x480 when the camera is powered off."""
+		return self._write_setting(self.setimagesizecommand, size)
+
+	def get_compression(self):
+		"""Gets the JPEG compression ratio (0x00-0xff)."""
+		return self._read_setting(self.getcompressioncommand)
+
+	def set_compression(self, ratio):
+		"""Sets the JPEG compression ratio, higher means smaller files.
+		It is reset to default when the camera is powered off."""
+		return self._write_setting(self.setcompressioncommand, ratio)
+
+	def _buffer_length(self):
+		"""Length in bytes of the frame held in the buffer, 0 if unknown."""
 		self.ser.write(''.join(map(chr, self.getbufflencommand)))
 		r = list(self.ser.read(9))
-		if self._checkreply(r, self.cmd_getbufflen) and r[4] == chr(0x4):
+		bytes = 0
+		if self._checkreply(r, self.cmd_getbufflen) and len(r) == 9 and r[4] == chr(0x4):
 			bytes = ord(r[5])
 			bytes <<= 8
 			bytes += ord(r[6])
@@ -283,9 +527,42 @@ class vc0706():
 			bytes += ord(r[7])
 			bytes <<= 8
 			bytes += ord(r[8])
+		return bytes
+
+	def _snapshot_within(self, budget):
+		"""Takes snapshots going down budget_ladder until the frame fits
+		in budget bytes. Size and compression apply to the very next
+		snapshot, no reset needed. Only the buffer length is read for the
+		discarded frames. Returns the length of the frame kept in the buffer (the
+		smallest one if none fits)."""
+		last = len(self.budget_ladder) - 1
+		i = 0
+		while True:
+			size, ratio = self.budget_ladder[i]
+			self.set_image_size(size)
+			self.set_compression(ratio)
+			self._take_snapshot()
+			length = self._buffer_length()
+			if (length > 0 and length <= budget) or i == last:
+				return length
+			self._resume_frame()
+			i += 1
+			# Compression alone rarely halves a JPEG, skip the resolutions
+			# that would still be too big after that.
+			while i < last and length > 0 and \
+				length * self.imagesize_pixels[self.budget_ladder[i][0]] > \
+				2 * budget * self.imagesize_pixels[size]:
+				i += 1
+
+	def _photo_chunks(self):
+		"""Generator of the data of the frame in the buffer, in chunks of
+		bytes (strings) as they arrive from the camera."""
+		# Get the length of the photography.
+		bytes = self._buffer_length()
+		if bytes == 0:
+			raise IOError('VC0706 frame buffer length unknown')
 
 		addr = 0   # the initial offset into the frame buffer
-		photo = []
 
 		# bytes to read each time (must be a mutiple of 4)
 		inc = 8192
@@ -315,34 +592,51 @@ class vc0706():
 
 			# The reply is a 5-byte header, followed by the image data
 			# followed by the 5-byte header again.
-			r = list(self.ser.read(5+chunk+5))
+			r = self.ser.read(5+chunk+5)
 			if len(r) != 5+chunk+5:
 				# retry the read if we didn't get enough bytes back.
 				continue
 
 			if not self._checkreply(r, self.cmd_readbuff):
-				print "ERROR READING PHOTO"
-				return
+				raise IOError('VC0706 bad reply reading the frame at %d' % addr)
 
-			# Append the data between the header data to photo
-			photo += r[5:chunk+5]
+			# The data between the header data.
+			yield r[5:chunk+5]
 
 			# advance the offset into the frame buffer
 			addr += chunk
-		return photo
 
+	def _photo_data(self):
+		"""Fetches the data from the camera."""
+		photo = []
+		for chunk in self._photo_chunks():
+			photo += list(chunk)
+		return photo
 
-	def take_photo(self, path=None, time=None):
+	def stream_photo(self, budget=None):
+		"""Takes a photography and yields its bytes in chunks as they are
+		read from the camera, so they can be written and checked on the
+		way (see Comms/outbox.py). Budget as in take_photo."""
+		self._switch_on()
+		try:
+			# Take a snapshot.
+			if budget == None:
+				self._take_snapshot()
+			else:
+				self._snapshot_within(budget)
+			for chunk in self._photo_chunks():
+				yield chunk
+		finally:
+			self._switch_off()
+
+	def take_photo(self, path=None, time=None, budget=None):
 		"""Take a photography write if the path is given, at the
 		indicated time if given, take the photography at the moment
-		otherwise. Returns the stream of bytes."""
-		self._switch_on()
-		# Take a snapshot.
-		self._take_snapshot()
+		otherwise. If a budget (bytes) is given, resolution and quality
+		are lowered until the photo fits in it. Returns the stream of bytes."""
 		# Get the actual photo..
-		photo = ''.join(self._photo_data())
+		photo = ''.join(self.stream_photo(budget))
 
-		self._switch_off()
 		if path != None:
 			# If we need to create the directory, create it.
 			dir = os.path.dirname(path)
@@ -353,7 +647,7 @@ class vc0706():
 			f.write(photo)
 			f.close()
 
-		return ''.join(photo)
+		return photo
 
 
 class mpu9150():
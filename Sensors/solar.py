@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+solar.py
+
+Sunrise, sunset, civil twilight and golden hour windows with the NOAA
+solar position algorithm, vectorized with NumPy over arrays of days and
+positions. Yearly tables are cached on disk keyed by a rounded position,
+so later runs only do a lookup.
+
+Times are minutes UTC from 00:00 UTC of the date, they may fall outside
+[0, 1440) when the event happens on the previous or next UTC day.
+Polar day and night come out of the hour angle: when the sun never
+crosses an elevation the window collapses at solar noon (polar night,
+daylength 0) or spans the 24 hours around it (polar day, daylength 1440).
+The polar field flags them: 1 polar day, -1 polar night, 0 otherwise.
+
+Usage: solar.py <lat> <lon> [year]
+"""
+
+import datetime
+import os
+import sys
+import time
+
+import numpy as np
+
+# Sun elevations (degrees) defining the events.
+elev_sunrise = -0.833
+elev_civil = -6.0
+elev_golden_low = -4.0
+elev_golden_high = 6.0
+
+fields = ['noon', 'sunrise', 'sunset', 'dawn', 'dusk',
+	'golden_am_start', 'golden_am_end', 'golden_pm_start', 'golden_pm_end',
+	'daylength', 'polar']
+window_dtype = np.dtype([(f, np.float32) for f in fields[:-1]] + [('polar', np.int8)])
+
+cachedir = '/home/satice/cache/'
+# Position resolution (degrees) of the cached tables.
+key_resolution = 0.5
+
+
+def julian_day(year, doy):
+	"""Julian day at 00:00 UTC of day of year doy (1 based, array ok)."""
+	jan1 = datetime.date(int(year), 1, 1).toordinal() + 1721424.5
+	return jan1 + np.asarray(doy, dtype=np.float64) - 1
+
+
+def _sun(jd):
+	"""Declination (rad) and equation of time (minutes) at Julian days jd."""
+	jc = (jd - 2451545.0) / 36525.0
+	l0 = np.radians(np.mod(280.46646 + jc * (36000.76983 + jc * 0.0003032), 360.0))
+	m = np.radians(357.52911 + jc * (35999.05029 - 0.0001537 * jc))
+	e = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+	c = (np.sin(m) * (1.914602 - jc * (0.004817 + 0.000014 * jc)) +
+		np.sin(2 * m) * (0.019993 - 0.000101 * jc) +
+		np.sin(3 * m) * 0.000289)
+	omega = np.radians(125.04 - 1934.136 * jc)
+	app_long = np.radians(np.degrees(l0) + c - 0.00569 - 0.00478 * np.sin(omega))
+	obliq0 = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+	obliq = np.radians(obliq0 + 0.00256 * np.cos(omega))
+	dec = np.arcsin(np.sin(obliq) * np.sin(app_long))
+	y = np.tan(obliq / 2) ** 2
+	eot = 4 * np.degrees(y * np.sin(2 * l0) - 2 * e * np.sin(m) +
+		4 * e * y * np.sin(m) * np.cos(2 * l0) -
+		0.5 * y * y * np.sin(4 * l0) - 1.25 * e * e * np.sin(2 * m))
+	return dec, eot
+
+
+def _hour_angle(lat, dec, elev):
+	"""Hour angle (minutes of time) at which the sun crosses elevation
+	elev, and the raw cosine (>1 never reached, <-1 never left)."""
+	cosha = ((np.sin(np.radians(elev)) - np.sin(lat) * np.sin(dec)) /
+		(np.cos(lat) * np.cos(dec)))
+	return 4 * np.degrees(np.arccos(np.clip(cosha, -1, 1))), cosha
+
+
+def light_windows(jd, lat, lon):
+	"""
+	Light windows for arrays of days and positions, broadcast together.
+	Input:
+		jd: Julian days at 00:00 UTC (see julian_day)
+		lat: latitude, degrees north
+		lon: longitude, degrees east
+	Output:
+		Structured array (window_dtype) with the broadcast shape.
+	"""
+	jd, lat, lon = np.broadcast_arrays(np.asarray(jd, np.float64),
+		np.asarray(lat, np.float64), np.asarray(lon, np.float64))
+	# Solar noon, then the sun at solar noon (one refinement is enough).
+	noon = 720 - 4 * lon
+	for i in range(2):
+		dec, eot = _sun(jd + noon / 1440.0)
+		noon = 720 - 4 * lon - eot
+	latr = np.radians(lat)
+	out = np.empty(jd.shape, window_dtype)
+	out['noon'] = noon
+	ha, cosha = _hour_angle(latr, dec, elev_sunrise)
+	out['sunrise'] = noon - ha
+	out['sunset'] = noon + ha
+	out['daylength'] = 2 * ha
+	out['polar'] = np.where(cosha < -1, 1, np.where(cosha > 1, -1, 0))
+	ha, cosha = _hour_angle(latr, dec, elev_civil)
+	out['dawn'] = noon - ha
+	out['dusk'] = noon + ha
+	low, cosha = _hour_angle(latr, dec, elev_golden_low)
+	high, cosha = _hour_angle(latr, dec, elev_golden_high)
+	out['golden_am_start'] = noon - low
+	out['golden_am_end'] = noon - high
+	out['golden_pm_start'] = noon + high
+	out['golden_pm_end'] = noon + low
+	return out
+
+
+def year_table(year, lat, lon):
+	"""Light windows for every day of year at each position. lat and lon
+	may be arrays, the table has shape positions x days."""
+	ndays = datetime.date(int(year), 12, 31).timetuple().tm_yday
+	jd = julian_day(year, np.arange(1, ndays + 1))
+	lat = np.atleast_1d(np.asarray(lat, np.float64))[:, np.newaxis]
+	lon = np.atleast_1d(np.asarray(lon, np.float64))[:, np.newaxis]
+	return light_windows(jd[np.newaxis, :], lat, lon)
+
+
+def _key(lat, lon):
+	"""Rounded position used to key the cached tables."""
+	r = key_resolution
+	return round(lat / r) * r, round(lon / r) * r
+
+
+def cached_table(year, lat, lon, path=cachedir):
+	"""Year table (days) at the rounded position, loaded from the cache
+	or computed and saved."""
+	klat, klon = _key(lat, lon)
+	fname = os.path.join(path, 'solar_%d_%+.2f_%+.2f.npy' % (int(year), klat, klon))
+	if os.path.isfile(fname):
+		try:
+			return np.load(fname)
+		except (IOError, ValueError):
+			pass
+	table = year_table(year, klat, klon)[0]
+	if not os.path.exists(path):
+		os.makedirs(path)
+	# Write then rename, a half written table is never loaded.
+	tmp = fname + '.tmp'
+	f = open(tmp, 'wb')
+	np.save(f, table)
+	f.close()
+	os.rename(tmp, fname)
+	return table
+
+
+def lookup(lat, lon, t=None, path=cachedir):
+	"""Light windows of the UTC day of epoch t (now by default)."""
+	if t == None:
+		t = time.time()
+	day = time.gmtime(t)
+	return cached_table(day.tm_year, lat, lon, path)[day.tm_yday - 1]
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print __doc__
+		sys.exit(1)
+	lat, lon = float(sys.argv[1]), float(sys.argv[2])
+	if len(sys.argv) > 3:
+		year = int(sys.argv[3])
+	else:
+		year = time.gmtime().tm_year
+	table = year_table(year, lat, lon)[0]
+	print 'doy,' + ','.join(fields)
+	for i in range(len(table)):
+		print '%d,' % (i + 1) + ','.join(['%g' % table[i][f] for f in fields])
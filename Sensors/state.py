@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Licensed under MIT (../LICENSE)
+
+state.py
+
+Shared buoy state (buoy name, last position, today's light window, last
+photo times) in a small fixed layout binary file, memory-mapped for
+reading. Updates write a new copy, fsync it and rename it over the old
+one, so after a power loss readers see either the old or the new state,
+never a mix. A CRC guards against anything else.
+
+Replaces the reads of timelog.log, lastphoto.log and tplogger.conf; the
+first read imports them if the store doesn't exist yet, or if it is
+corrupted (reported on stderr).
+
+Usage:
+		state.py (prints the state)
+		state.py <field> <value> [<field> <value>...] (updates it)
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+statefile = '/home/satice/log/state.bin'
+# Legacy files imported on first use.
+timelog = '/home/satice/log/timelog.log'
+lastphoto = '/home/satice/log/lastphoto.log'
+tplogger = '/home/satice/conf/tplogger.conf'
+
+magic = 'SST1'
+# Field name, struct format, default. Times are UTC epoch seconds.
+fields = [('buoy', '8s', ''),
+	('fix_time', 'd', 0.0),
+	('lat', 'd', 0.0),
+	('lon', 'd', 0.0),
+	('alt', 'd', 0.0),
+	('sunrise', 'd', 0.0),
+	('sunset', 'd', 0.0),
+	('lastdawn', 'd', 0.0),
+	('lastdusk', 'd', 0.0)]
+# Magic, generation, fields, CRC32 of everything before it.
+body_fmt = '<4sI' + ''.join([f[1] for f in fields])
+body_size = struct.calcsize(body_fmt)
+size = body_size + 4
+
+
+def defaults():
+	"""State with every field at its default."""
+	return dict([(f[0], f[2]) for f in fields] + [('generation', 0)])
+
+
+def _decode(buf):
+	"""State of a raw buffer, None if it is not valid."""
+	if len(buf) < size:
+		return None
+	crc, = struct.unpack_from('<I', buf, body_size)
+	if zlib.crc32(buf[:body_size]) & 0xffffffff != crc:
+		return None
+	vals = struct.unpack_from(body_fmt, buf, 0)
+	if vals[0] != magic:
+		return None
+	s = {'generation': vals[1]}
+	for i in range(len(fields)):
+		s[fields[i][0]] = vals[i + 2]
+	s['buoy'] = s['buoy'].rstrip('\0')
+	return s
+
+
+def _encode(s):
+	"""Raw buffer of a state."""
+	vals = [magic, s['generation']] + [s[f[0]] for f in fields]
+	body = struct.pack(body_fmt, *vals)
+	return body + struct.pack('<I', zlib.crc32(body) & 0xffffffff)
+
+
+def read(path=statefile):
+	"""Returns the state (dictionary). Imports the legacy files when the
+	store doesn't exist or is corrupted."""
+	try:
+		f = open(path, 'rb')
+	except IOError:
+		s = _from_legacy()
+		try:
+			_write(s, path)
+		except (IOError, OSError):
+			pass
+		return s
+	try:
+		try:
+			m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+		except (ValueError, mmap.error, EnvironmentError):
+			# Shorter than the layout.
+			m = None
+		s = None
+		if m != None:
+			try:
+				s = _decode(m[:size])
+			finally:
+				m.close()
+	finally:
+		f.close()
+	if s == None:
+		sys.stderr.write('%s is corrupted, importing the legacy files\n' % path)
+		return _from_legacy()
+	return s
+
+
+def _write(s, path):
+	"""Writes a full copy and renames it over the store."""
+	tmp = path + '.tmp'
+	d = os.path.dirname(path)
+	if d and not os.path.exists(d):
+		os.makedirs(d)
+	f = open(tmp, 'wb')
+	f.write(_encode(s))
+	f.flush()
+	os.fsync(f.fileno())
+	f.close()
+	os.rename(tmp, path)
+	# The rename itself survives a power loss once the directory is synced.
+	fd = os.open(d or '.', os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+	return
+
+
+def update(path=statefile, **values):
+	"""
+	Updates some fields of the state atomically.
+	Input:
+		path: state store
+		values: field=value, see fields
+	Output:
+		The new state.
+	"""
+	for k in values:
+		if k not in [f[0] for f in fields]:
+			raise KeyError(k)
+	# Writers are serialized, readers never wait.
+	lock = open(path + '.lock', 'a')
+	try:
+		fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+		s = read(path)
+		s.update(values)
+		s['generation'] = (s['generation'] + 1) & 0xffffffff
+		_write(s, path)
+	finally:
+		lock.close()
+	return s
+
+
+def _from_legacy():
+	"""State from the old text files, whatever is readable."""
+	s = defaults()
+	try:
+		cfile = open(tplogger, 'r')
+		cfile.readline()
+		s['buoy'] = cfile.readline().strip()[:8]
+		cfile.close()
+	except IOError:
+		pass
+	try:
+		cfile = open(timelog, 'r')
+		for i in range(3):
+			cfile.readline()
+		coord = cfile.readline().split()
+		cfile.close()
+		s['lat'], s['lon'], s['alt'] = [float(c) for c in coord[:3]]
+		s['fix_time'] = os.path.getmtime(timelog)
+	except (IOError, ValueError, OSError):
+		pass
+	try:
+		cfile = open(lastphoto, 'r')
+		s['lastdawn'] = float(cfile.readline())
+		s['lastdusk'] = float(cfile.readline())
+		cfile.close()
+	except (IOError, ValueError):
+		pass
+	return s
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 2:
+		values = {}
+		types = dict([(f[0], f[1]) for f in fields])
+		for i in range(1, len(sys.argv) - 1, 2):
+			k = sys.argv[i]
+			if types.get(k) == 'd':
+				values[k] = float(sys.argv[i + 1])
+			else:
+				values[k] = sys.argv[i + 1]
+		update(**values)
+	s = read()
+	for k in ['generation'] + [f[0] for f in fields]:
+		print '%s: %s' % (k, s[k])
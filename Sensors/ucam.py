@@ -10,80 +10,46 @@ at golden hours (within 10 minutes close to them).
 
 
  Input files:
-           * timelog.log : for the current coordinates, doy, golden hours
-           * photoday.log : stores the last doy where a photo was taken, 
-                            and an hourly id identifier per photo (max 2)
+           * photosched.bin : sunrise and sunset of the next days along the
+                              drift (photosched.py), rebuilt from today
+                              at the last known position when out of date
+           * state.bin : buoy name, last fix and last dawn and dusk photo
+                         times (state.py)
 
 V0. Daniel Peyrolon & Oriol Sanchez, ICM-CSIC
 """
-import fox #Specific library to access serial ports on fox board kernel 2.7
-import os
+import hal #Board GPIO (fox, ablib, RPi.GPIO or simulated), loaded on first use
 import time
 from sensors import vc0706 #Custom library for SATICE on board payload
-import math
+import photosched #Sunrise and sunset along the drift, UTC
+import state #Shared buoy state
+import outbox #Hand-off to the outbox and transfer queue (Comms)
+import planner #Daily energy plan
+import mtcmd #Remote settings
+
+#Photos are sent as 7kB transfer parts (MTU on coms.conf), keep them to 3 parts.
+photobudget = 3*(outbox.mtu-outbox.part_size)-outbox.trailer_size
+
+def lastPhoto(st):
+    '''UTC epoch seconds of the last dawn and dusk photos, 0 if none'''
+    return (st['lastdawn'],st['lastdusk'])
+
+
+def currentPosition(st):
+    '''Time and coordinates of the last fix'''
+    return (st['fix_time'],st['lat'],st['lon'])
 
-def newDay():
-#    cfile = open("lastphoto.log",'w')
-    cfile = open("/home/satice/log/lastphoto.log",'w')
-    now = time.localtime()
-    cfile.write(time.strftime("%j", now)+'\n')
-    hnow=int(time.strftime("%H", now))
-#    print "local time %s" %(tzone+hnow)
-    if ((hnow+tzone)<12): #Dawn never happens after local noon
-        cfile.write('10.0\n')
-    else: #Consider dawn at 4 in case system is restarted after local noon
-        cfile.write('.04\n')
-    cfile.write('10.0')
-    cfile.close()
-
-
-def formatime(t):
-    if t<10.0: 
-        (tm,th)=math.modf(float(t)*100)
-        tm=int(tm*100)
-        th=int(th)
-    else:
-        tm='1000'
-        th='1000'
-#    print "T %s Hm %s:%s" %(t,th,tm)
-    return (tm,th)
-
-def lastPhoto():
-    '''Checks if last photos log file exists, loads the information of the last photos taken by the system'''
-#    logfile="lastphoto.log"
-    logfile="/home/satice/log/lastphoto.log"
-    if (os.path.isfile(logfile) == False): #If file doesn't exist
-        newDay()
-    cfile = open(logfile,'r')
-    doy=cfile.readline().strip()
-    p1=cfile.readline().strip()
-    p2=cfile.readline().strip()
-    cfile.close()
-    print "last photo log loaded"
-    return (int(doy),p1,p2)
-
-
-def currentDay():
-	'''Loads data from current position and current golden hour settings'''
-#        cfile = open("timelog.log",'r')
-        cfile = open("/home/satice/log/timelog.log",'r')
-        cfile.readline()
-        doy=cfile.readline().strip()
-#        print "Srise %s" % doy
-        cfile.readline()
-        coord=cfile.readline().strip()
-        cfile.readline()
-        srise=cfile.readline().strip()
-#        print "Srise %s" % srise
-        cfile.readline()
-        sdown=cfile.readline().strip()
-#        print "Sdown %s" % sdown
-        cfile.close()
-        coord=coord.split()
-#        print "--------> longtidue %s" %coord[1]
-        timez=int((float(coord[1])/15))
-#        print "Timezone correction %s" %timez
-        return (int(doy),float(srise),float(sdown),timez)
+
+def currentDay(now,st):
+    '''Loads sunrise and sunset of today and yesterday, rebuilds the schedule from today at the last fix position if it is out of date'''
+    records=photosched.days_around(now)
+    if records==None:
+        print "Schedule out of date, rebuilding"
+        (tfix,lat,lon)=currentPosition(st)
+        #From yesterday, a dusk after 0h UTC belongs to it.
+        photosched.build(tfix,lat,lon,start=now-86400)
+        records=photosched.days_around(now)
+    return records
 
 
 def timepostfix():
@@ -98,118 +64,53 @@ def timepostfix():
     hour_rep = hours_l[int(hour)]
     return ((doy + hour_rep + '.' + year[2:] + 'i'),int(hour),int(minute))
 
-def getbuoyname():
-	"""Fetch the buoy name from the configuration (i.e. SI06)."""
-	cfile = open("/home/satice/conf/tplogger.conf",'r')
-	# The first line contains comments.
-	cfile.readline()
-	# Take out the last '\n'.
-	return cfile.readline().strip()
-
-def savetime(p1,tstamp,ldoy):
-#    cfile = open("lastphoto.log",'w+')
-    cfile = open("/home/satice/log/lastphoto.log",'w+')
-    cfile.write(str(ldoy) +'\n')
-    if (p1>1.0):
-        #Save on P1
+def getbuoyname(st):
+	"""Fetch the buoy name from the state store (i.e. SI06)."""
+	return st['buoy']
+
+def savetime(shot,now):
+    '''Saves the time of the photo as last dawn or dusk photo'''
+    if shot=='dawn':
         print "Save dawn time"
-        cfile.write(str(tstamp)+'\n')
-        cfile.write('10.0')
-    else:        
-        #Save on P2
+        state.update(lastdawn=now)
+    else:
         print "Save dusk time"
-        cfile.write(str(p1) +'\n')
-        cfile.write(str(tstamp))
-    cfile.close()
+        state.update(lastdusk=now)
 
 def takephoto(photoname):
     #Switch on the relay.
-    relay = fox.Pin('J7.4', 'low')
+    relay = hal.pin('camera')
     relay.on()
     time.sleep(0.5)
-    camera = vc0706()
-    camera.take_photo(photoname)
-    relay.off()
-    #Photo now is copied to new folder, from there the chk_tpl will sort it.
-    os.system('cp ' + photoname + ' /home/satice/new')
-    print "Photo %s taken" % photoname 
+    try:
+        camera = vc0706()
+        #Photo is archived and cut in transfer parts while it is read,
+        #each part is queued as soon as it is written.
+        (crc,size,parts)=outbox.send(camera.stream_photo(photobudget), photoname, compress=mtcmd.get('compress'))
+    finally:
+        relay.off()
+    print "Photo %s taken, %d bytes, CRC %d, %d parts" % (photoname,size,crc,parts)
  
    
 if __name__ == '__main__':
-    shoot=0 #flag that indicates a photo can be taken
     #Data initialization
+    st=state.read()
     name,hour,minute=timepostfix()
-    nowtime=(hour*60+minute)/10000
-    photoname = '/home/satice/img/'+ getbuoyname() + name
+    photoname = '/home/satice/img/'+ getbuoyname(st) + name
 #   photoname= 'SI94'+name    
-    (doy,srise,sdown,tzone)= currentDay()
-#    (doy,srise,sdown)= (int(53),0.1150,0.1150)
-#    hour=18
-#    minute=9
-    #dawn and dusk divided into HH mm
-    (rim, rih)= formatime(srise)
-    (sdm, sdh)= formatime(sdown)
+    now=time.time()
+    records=currentDay(now,st)
     #last photos taken by the system
-    (ldoy,p1,p2)=lastPhoto()    
-    #format times to HH mm
-    p1=float(p1)
-    p2=float(p2)
-    (p1m,p1h) = formatime(p1)
-    (p2m,p2h) = formatime(p2)
-#    print "P1h %s P2h %s Now %s:%s, rise %s:%s, down %s:%s" %(p1h, p2h, hour, minute, rih, rim, sdh, sdm)
-    delta=(((hour-rih)*60)+(minute-rim)) #I'd rather take a photo after dawn, therefore delta is always positive
-    velta=(((hour-sdh)*60)+(minute-sdm)) #I'd rather take a photo before dusk, therefore velta can be negative
-    lighttime=abs((sdh-rih)*60-(sdm-rim)) #Only interested in how many sunlight minutes I have
-    wnight=(srise==sdown)#Logic flag indicating winter night
-    #Conditions to take the photos
-    if ((ldoy-doy)!=0):
-        print "Day is incorrect"
-        print doy
-        print ldoy
-        newDay()  
-    else:
-#        print "Time off dawn %s minutes" %delta
-#        print "Time off dusk %s minutes" %velta
-        print "Day is correct"
-#        if p1<1: print "Dawn photo already taken"
-#        if p2<1: print "Dusk photo already taken"
-        #Takes the 1st photo 10 minutes after the rising golden hour
-        if ((int(p1)>1) and ((delta>10) and (delta<30)) and not(wnight)):
-            print "Take dawn photo"
-            print "p1 %s" %p1
-            print "p2 %s" %p2
-            print "Time off dawn %s" %delta
-            shoot=1
-        #Takes the 2nd photo 10 minutes before down golden hour
-        #Only if golden hour happens at least four hours from sunrise or in a day with less than 20 hours of sunlight. 
-        elif ((int(p1)<1) and (p2>1) and ((velta<20) and (velta>-10)) and (lighttime>=120) and (lighttime<=1200) and not(wnight)):
-            print "Take dusk photo"
-            print "p1 %s" %p1
-            print "p2 %s" %p2
-            print "Time off dusk %s" %velta
-            shoot=1
-        elif (p1<1) and ((p2<1) or (lighttime<120) or (lighttime>1200)) or (wnight):
-            print "Done for today because..."
-            if (wnight):
-                print "No sunlight hours available"
-            elif not(lighttime>=120):
-                print "Only dawn photo available, only %s minutes of sunlight today" %(lighttime)
-            elif not(1200>=lighttime):
-                print "Only dawn photo available, %s minutes of sunlight today, day is too long" %(lighttime)
-            else: 
-                print "All photos taken"
-        else  :
-            print "Not yet"
-            if (nowtime-srise)>0:
-                print "Waiting for dawn"
-            else:
-                print "Waiting for dusk"
- 
+    (p1,p2)=lastPhoto(st)
+    (shot,why)=photosched.decide(records,now,p1,p2)
+    print why
+    #Photo due, but only if today's energy plan has room for it.
+    if shot!=None:
+          (ok,why)=planner.allowed('photo',now)
+          print why
+          if not ok:
+                shot=None
     #If everything is under limits, take photo and store
-    if shoot==1:
+    if shot!=None:
           takephoto(photoname)
-          tstamp= float(hour*100 + minute)/10000
-          savetime(p1,tstamp,ldoy)
-          #Save timestamp to first or second line...
-
-    
\ No newline at end of file
+          savetime(shot,now)